@@ -14,13 +14,11 @@
 
 import os
 import pytest
-import re
 import requests
-import subprocess
-import tempfile
 import uuid
 
 from testutils.api.client import ApiClient
+from testutils.benchmark import run_download_benchmark
 from testutils.api import (
     deployments,
     useradm,
@@ -34,6 +32,7 @@ from testutils.common import (
     get_mender_artifact,
     make_accepted_device,
 )
+from testutils.util.artifact import ArtifactReader
 
 
 class TestUploadArtifactBase:
@@ -185,24 +184,12 @@ class TestUploadArtifactBase:
         assert r.status_code == 200
         #
         data = r.json()
-        r = requests.get(data["artifact"]["source"]["uri"], verify=False)
+        r = requests.get(data["artifact"]["source"]["uri"], verify=False, stream=True)
         assert r.status_code == 200
 
-        f = tempfile.NamedTemporaryFile(delete=False)
-        try:
-            f.write(r.content)
-            f.close()
-            #
-            p = subprocess.Popen(
-                ["mender-artifact", "read", f.name], stdout=subprocess.PIPE
-            )
-            stdout = p.stdout.read().decode("utf-8")
-            m_size = re.search(r".*size: *([0-9]+).*", stdout, re.M | re.I)
-            assert m_size is not None
-            size = int(m_size.group(1))
-            assert size == 256
-        finally:
-            os.unlink(f.name)
+        artifact = ArtifactReader(r.raw).read()
+        size = list(artifact.payload_sizes.values())[0]
+        assert size == 256
 
 
 class TestUploadArtifactEnterprise(TestUploadArtifactBase):
@@ -403,24 +390,12 @@ class TestUploadArtifactEnterprise(TestUploadArtifactBase):
         assert r.status_code == 200
         #
         data = r.json()
-        r = requests.get(data["artifact"]["source"]["uri"], verify=False)
+        r = requests.get(data["artifact"]["source"]["uri"], verify=False, stream=True)
         assert r.status_code == 200
 
-        f = tempfile.NamedTemporaryFile(delete=False)
-        try:
-            f.write(r.content)
-            f.close()
-            #
-            p = subprocess.Popen(
-                ["mender-artifact", "read", f.name], stdout=subprocess.PIPE
-            )
-            stdout = p.stdout.read().decode("utf-8")
-            m_size = re.search(r".*size: *([0-9]+).*", stdout, re.M | re.I)
-            assert m_size is not None
-            size = int(m_size.group(1))
-            assert size == 1024
-        finally:
-            os.unlink(f.name)
+        artifact = ArtifactReader(r.raw).read()
+        size = list(artifact.payload_sizes.values())[0]
+        assert size == 1024
 
     @pytest.mark.parametrize("plan", ["os", "professional", "enterprise"])
     def test_upload_artifact_depends_provides_valid(self, mongo, clean_mongo, plan):
@@ -586,28 +561,16 @@ class TestUploadArtifactEnterprise(TestUploadArtifactBase):
         )
         assert r.status_code == 200
         data = r.json()
-        r = requests.get(data["artifact"]["source"]["uri"], verify=False)
+        r = requests.get(data["artifact"]["source"]["uri"], verify=False, stream=True)
         assert r.status_code == 200
 
-        f = tempfile.NamedTemporaryFile(delete=False)
-        try:
-            f.write(r.content)
-            f.close()
-            #
-            p = subprocess.Popen(
-                ["mender-artifact", "read", f.name], stdout=subprocess.PIPE
-            )
-            stdout = p.stdout.read().decode("utf-8")
-            m_size = re.search(r".*size: *([0-9]+).*", stdout, re.M | re.I)
-            assert m_size is not None
-            size = int(m_size.group(1))
+        artifact = ArtifactReader(r.raw).read()
+        size = list(artifact.payload_sizes.values())[0]
 
-            # if provides/depends wasn't ignored - the matching, larger
-            # artifact should have been selected
-            # that's not the case, and we selected 'smallest of all'
-            assert size == 256
-        finally:
-            os.unlink(f.name)
+        # if provides/depends wasn't ignored - the matching, larger
+        # artifact should have been selected
+        # that's not the case, and we selected 'smallest of all'
+        assert size == 256
 
 
 class TestUploadArtifactOpenSource(TestUploadArtifactBase):
@@ -715,25 +678,39 @@ class TestUploadArtifactOpenSource(TestUploadArtifactBase):
         )
         assert r.status_code == 200
         data = r.json()
-        r = requests.get(data["artifact"]["source"]["uri"], verify=False)
+        r = requests.get(data["artifact"]["source"]["uri"], verify=False, stream=True)
         assert r.status_code == 200
 
-        f = tempfile.NamedTemporaryFile(delete=False)
-        try:
-            f.write(r.content)
-            f.close()
-            #
-            p = subprocess.Popen(
-                ["mender-artifact", "read", f.name], stdout=subprocess.PIPE
-            )
-            stdout = p.stdout.read().decode("utf-8")
-            m_size = re.search(r".*size: *([0-9]+).*", stdout, re.M | re.I)
-            assert m_size is not None
-            size = int(m_size.group(1))
-
-            # if provides/depends wasn't ignored - the matching, larger
-            # artifact should have been selected
-            # that's not the case, and we selected 'smallest of all'
-            assert size == 256
-        finally:
-            os.unlink(f.name)
+        artifact = ArtifactReader(r.raw).read()
+        size = list(artifact.payload_sizes.values())[0]
+
+        # if provides/depends wasn't ignored - the matching, larger
+        # artifact should have been selected
+        # that's not the case, and we selected 'smallest of all'
+        assert size == 256
+
+
+class TestDownloadBenchmarkOpenSource:
+    def test_download_benchmark(self, mongo, clean_mongo):
+        """Devices download artifacts concurrently through deployments/next.
+        DOWNLOAD_BENCHMARK_SIZES and DOWNLOAD_BENCHMARK_CONCURRENCY (comma
+        separated) set the artifact sizes in bytes and numbers of devices,
+        the results are written as JSON to DOWNLOAD_BENCHMARK_OUTPUT."""
+        uuidv4 = str(uuid.uuid4())
+        user = create_user("some.user+" + uuidv4 + "@example.com", "secretsecret")
+        r = ApiClient(useradm.URL_MGMT).call(
+            "POST", useradm.URL_LOGIN, auth=(user.name, user.pwd)
+        )
+        assert r.status_code == 200
+
+        sizes = os.getenv("DOWNLOAD_BENCHMARK_SIZES", "1048576")
+        concurrency = os.getenv("DOWNLOAD_BENCHMARK_CONCURRENCY", "1,4")
+        results = run_download_benchmark(
+            r.text,
+            sizes=[int(size) for size in sizes.split(",")],
+            concurrency=[int(n) for n in concurrency.split(",")],
+            output=os.getenv("DOWNLOAD_BENCHMARK_OUTPUT"),
+        )
+        for result in results["results"]:
+            assert result["errors"] == []
+            assert result["downloads"] == result["concurrency"]
@@ -44,6 +44,7 @@ from testutils.common import (
     Tenant,
 )
 from testutils.infra.container_manager.kubernetes_manager import isK8S
+from testutils.util.multipart import MultipartEncoder
 
 
 WAITING_MULTIPLIER = 8 if isK8S() else 1
@@ -53,15 +54,20 @@ WAITING_TIME_K8S = 5.0
 def upload_image(filename, auth_token, description="abc"):
     api_client = ApiClient(deployments.URL_MGMT)
     api_client.headers = {}
-    r = api_client.with_auth(auth_token).call(
-        "POST",
-        deployments.URL_DEPLOYMENTS_ARTIFACTS,
-        files=(
-            ("description", (None, description)),
-            ("size", (None, str(os.path.getsize(filename)))),
-            ("artifact", (filename, open(filename, "rb"), "application/octet-stream")),
-        ),
+    body = MultipartEncoder(
+        [
+            ("description", description),
+            ("size", str(os.path.getsize(filename))),
+            ("artifact", (filename, filename, "application/octet-stream")),
+        ]
     )
+    with body:
+        r = api_client.with_auth(auth_token).call(
+            "POST",
+            deployments.URL_DEPLOYMENTS_ARTIFACTS,
+            data=body,
+            headers={"Content-Type": body.content_type},
+        )
     assert r.status_code == 201
 
 
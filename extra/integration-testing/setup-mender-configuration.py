@@ -21,6 +21,7 @@
 # partition is overwritten.
 
 import argparse
+import errno
 import json
 import os
 import stat
@@ -28,42 +29,141 @@ import sys
 import subprocess
 from pathlib import PurePath
 
+SECTOR_SIZE = 512
 
-def get(remote_path, local_path, rootfs):
-    subprocess.check_call(
-        ["debugfs", "-R", "dump -p %s %s" % (remote_path, local_path), rootfs],
-        stderr=subprocess.STDOUT,
-    )
+# Partitions are copied in blocks of this size, aligned on their start
+BLOCK_SIZE = 4 * 1024 * 1024
 
 
-def put(local_path, remote_path, rootfs, remote_path_mkdir_p=False):
-    proc = subprocess.Popen(
-        ["debugfs", "-w", rootfs], stdin=subprocess.PIPE, stderr=subprocess.STDOUT
-    )
-    if remote_path_mkdir_p:
-        # Create parent directories sequencially, to simulate a "mkdir -p" on the final dir
-        parent_dirs = list(PurePath(remote_path).parents)[::-1][1:]
-        for parent in parent_dirs:
-            proc.stdin.write(("mkdir %s\n" % parent).encode())
-    proc.stdin.write(("cd %s\n" % os.path.dirname(remote_path)).encode())
-    proc.stdin.write(("rm %s\n" % os.path.basename(remote_path)).encode())
-    proc.stdin.write(
-        ("write %s %s\n" % (local_path, os.path.basename(remote_path))).encode()
-    )
-    proc.stdin.close()
-    ret = proc.wait()
-    assert ret == 0
+class Debugfs:
+    """
+    Batches the writes into an ext4 image, which are then all done by a
+    single debugfs session on commit().
+    """
 
+    def __init__(self, rootfs):
+        self.rootfs = rootfs
+        self.cmds = []
 
-def extract_ext4(img, rootfs):
-    return _manipulate_ext4(img=img, rootfs=rootfs, write=False)
+    def get(self, remote_path, local_path):
+        """Reads are done immediately, with a single debugfs call each"""
+        subprocess.check_call(
+            ["debugfs", "-R", "dump -p %s %s" % (remote_path, local_path), self.rootfs],
+            stderr=subprocess.STDOUT,
+        )
 
+    def put(self, local_path, remote_path, remote_path_mkdir_p=False):
+        if remote_path_mkdir_p:
+            # Create parent directories sequencially, to simulate a "mkdir -p" on the final dir
+            parent_dirs = list(PurePath(remote_path).parents)[::-1][1:]
+            for parent in parent_dirs:
+                self.cmds.append("mkdir %s" % parent)
+        self.cmds.append("cd %s" % os.path.dirname(remote_path))
+        self.cmds.append("rm %s" % os.path.basename(remote_path))
+        self.cmds.append("write %s %s" % (local_path, os.path.basename(remote_path)))
 
-def insert_ext4(img, rootfs):
-    return _manipulate_ext4(img=img, rootfs=rootfs, write=True)
+    def commit(self):
+        if len(self.cmds) == 0:
+            return
+        proc = subprocess.Popen(
+            ["debugfs", "-w", self.rootfs],
+            stdin=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        proc.stdin.write(("\n".join(self.cmds) + "\n").encode())
+        proc.stdin.close()
+        ret = proc.wait()
+        assert ret == 0
+        self.cmds = []
+
+
+def _data_ranges(fd, start, end):
+    """
+    Yields the (start, end) ranges holding data between start and end in
+    the file, skipping its holes. The whole range is data if the filesystem
+    does not support hole detection.
+    """
+    pos = start
+    while pos < end:
+        try:
+            data = os.lseek(fd, pos, os.SEEK_DATA)
+            hole = os.lseek(fd, data, os.SEEK_HOLE)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # only a hole left
+                return
+            if e.errno != errno.EINVAL:
+                raise
+            data, hole = pos, end
+        if data >= end:
+            return
+        yield data, min(hole, end)
+        pos = hole
+
+
+def copy_range(src, src_offset, dst, dst_offset, length):
+    """
+    Copies length bytes of file descriptor src at src_offset to dst at
+    dst_offset, preserving the holes of src: dst is expected to be zeroed
+    (e.g. a new file) there. The data is copied in the kernel with
+    copy_file_range() when available, which reflinks it on filesystems
+    supporting it, otherwise all-zero blocks are skipped as well.
+    """
+    copy_file_range = getattr(os, "copy_file_range", None)
+    for start, end in _data_ranges(src, src_offset, src_offset + length):
+        pos = start
+        while pos < end:
+            size = min(BLOCK_SIZE - (pos - src_offset) % BLOCK_SIZE, end - pos)
+            target = dst_offset + pos - src_offset
+            if copy_file_range is not None:
+                try:
+                    copied = copy_file_range(src, dst, size, pos, target)
+                    if copied > 0:
+                        pos += copied
+                        continue
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL):
+                        raise
+                copy_file_range = None
+            block = os.pread(src, size, pos)
+            if block.count(0) != len(block):
+                os.pwrite(dst, block, target)
+            pos += len(block)
+    if os.fstat(dst).st_size < dst_offset + length:
+        os.ftruncate(dst, dst_offset + length)
+
+
+def sync_range(src, src_offset, dst, dst_offset, length):
+    """
+    Makes the length bytes of file descriptor dst at dst_offset equal to
+    the ones of src at src_offset, only writing the blocks which differ:
+    when the two rootfs partitions share most of their content, most of
+    the image is only read. Blocks which are holes in both are skipped.
+    :returns: the number of bytes written
+    """
+    src_data = list(_data_ranges(src, src_offset, src_offset + length))
+    dst_data = list(_data_ranges(dst, dst_offset, dst_offset + length))
+
+    def has_data(ranges, start, end):
+        return any(s < end and e > start for s, e in ranges)
+
+    written = 0
+    pos = 0
+    while pos < length:
+        size = min(BLOCK_SIZE, length - pos)
+        if has_data(src_data, src_offset + pos, src_offset + pos + size) or has_data(
+            dst_data, dst_offset + pos, dst_offset + pos + size
+        ):
+            block = os.pread(src, size, src_offset + pos)
+            if block != os.pread(dst, size, dst_offset + pos):
+                os.pwrite(dst, block, dst_offset + pos)
+                written += size
+        pos += size
+    return written
 
 
-def _manipulate_ext4(img, rootfs, write):
+def rootfs_partitions(img):
+    """Returns the (offset, size) in bytes of the rootfs partitions 2 and 3"""
     # calls partx with --show --bytes --noheadings, sample output:
     #
     # $ partx -sbg core-image-full-cmdline-vexpress-qemu.sdimg
@@ -73,56 +173,53 @@ def _manipulate_ext4(img, rootfs, write):
     # 3 294912 507903  212992 109051904      a38e337d-03
     # 4 507904 770047  262144 134217728      a38e337d-04
     output = subprocess.check_output(["partx", "-sbg", img])
-    done = False
+    partitions = {}
     for line in output.decode().split("\n"):
         columns = line.split()
         # This blindly assumes that rootfs is on partition 2 and 3.
-        if write:
-            if columns[0] in ["2", "3"]:
-                subprocess.check_call(
-                    [
-                        "dd",
-                        "if=%s" % rootfs,
-                        "of=%s" % img,
-                        "seek=%s" % columns[1],
-                        "count=%d" % (int(columns[3])),
-                        "conv=notrunc",
-                    ],
-                    stderr=subprocess.STDOUT,
-                )
-                if done:
-                    break
-                else:
-                    done = not done
-        elif columns[0] == "2":
-            subprocess.check_call(
-                [
-                    "dd",
-                    "if=%s" % img,
-                    "of=%s" % rootfs,
-                    "skip=%s" % columns[1],
-                    "count=%d" % (int(columns[3])),
-                ],
-                stderr=subprocess.STDOUT,
+        if len(columns) > 3 and columns[0] in ["2", "3"]:
+            partitions[columns[0]] = (
+                int(columns[1]) * SECTOR_SIZE,
+                int(columns[3]) * SECTOR_SIZE,
             )
-            break
-    else:
+    if len(partitions) != 2:
         raise Exception("%s not found in partx output: %s" % (img, output))
+    return partitions["2"], partitions["3"]
 
 
-def update_config(rootfs, key, value, filename="mender.conf"):
-    get(
-        local_path=filename, remote_path="/etc/mender/" + filename, rootfs=rootfs,
-    )
-    with open(filename) as fd:
-        conf = json.load(fd)
-    conf[key] = value
+def extract_ext4(img, rootfs):
+    (offset, size), _ = rootfs_partitions(img)
+    src = os.open(img, os.O_RDONLY)
+    dst = os.open(rootfs, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        copy_range(src, offset, dst, 0, size)
+    finally:
+        os.close(dst)
+        os.close(src)
+
+
+def insert_ext4(img, rootfs):
+    src = os.open(rootfs, os.O_RDONLY)
+    dst = os.open(img, os.O_RDWR)
+    try:
+        for offset, size in rootfs_partitions(img):
+            sync_range(src, 0, dst, offset, size)
+    finally:
+        os.close(dst)
+        os.close(src)
+
+
+def update_config(debugfs, conf, filename="mender.conf"):
+    """Writes the configuration conf, read with read_config(), back"""
     with open(filename, "w") as fd:
         json.dump(conf, fd, indent=4, sort_keys=True)
-    put(
-        local_path=filename, remote_path="/etc/mender/" + filename, rootfs=rootfs,
-    )
-    os.unlink(filename)
+    debugfs.put(local_path=filename, remote_path="/etc/mender/" + filename)
+
+
+def read_config(debugfs, filename="mender.conf"):
+    debugfs.get(local_path=filename, remote_path="/etc/mender/" + filename)
+    with open(filename) as fd:
+        return json.load(fd)
 
 
 def main():
@@ -145,25 +242,28 @@ def main():
     rootfs = "%s.ext4" % args.img
     extract_ext4(img=args.img, rootfs=rootfs)
 
+    debugfs = Debugfs(rootfs)
+    config = {}
+    local_files = []
+
     if args.tenant_token:
-        update_config(rootfs, "TenantToken", args.tenant_token)
+        config["TenantToken"] = args.tenant_token
 
     if args.server_crt:
-        put(
+        debugfs.put(
             local_path=args.server_crt,
             remote_path="/etc/ssl/certs/docker.mender.io.crt",
-            rootfs=rootfs,
         )
 
     if args.server_url:
-        update_config(rootfs, "ServerURL", args.server_url)
+        config["ServerURL"] = args.server_url
 
     if args.verify_key:
         key_img_location = "/etc/mender/artifact-verify-key.pem"
         if not os.path.exists(args.verify_key):
             raise SystemExit("failed to load file: " + args.verify_key)
-        put(local_path=args.verify_key, remote_path=key_img_location, rootfs=rootfs)
-        update_config(rootfs, "ArtifactVerifyKey", key_img_location)
+        debugfs.put(local_path=args.verify_key, remote_path=key_img_location)
+        config["ArtifactVerifyKey"] = key_img_location
 
     if args.docker_ip:
         with open("mender-inventory-docker-ip", "w") as fd:
@@ -180,12 +280,22 @@ EOF
             "mender-inventory-docker-ip",
             stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH,
         )
-        put(
+        debugfs.put(
             local_path="mender-inventory-docker-ip",
             remote_path="/usr/share/mender/inventory/mender-inventory-docker-ip",
-            rootfs=rootfs,
         )
-        os.unlink("mender-inventory-docker-ip")
+        local_files.append("mender-inventory-docker-ip")
+
+    if len(config) > 0:
+        conf = read_config(debugfs)
+        conf.update(config)
+        update_config(debugfs, conf)
+        local_files.append("mender.conf")
+
+    # All the writes in a single debugfs session
+    debugfs.commit()
+    for local_file in local_files:
+        os.unlink(local_file)
 
     # Put back ext4 image into img.
     insert_ext4(img=args.img, rootfs=rootfs)
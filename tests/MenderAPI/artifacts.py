@@ -12,12 +12,20 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import json
 import os
-import shutil
 import subprocess
+import tempfile
+
+from testutils.util.artifact_cache import cache
+from testutils.util.image import copy_image, patch_image, read_file
 
 from . import logger
 
+# stands for the image in the commands of _make_image_artifact, replaced by
+# the path of the copy of the image it runs against
+_IMAGE_PLACEHOLDER = "@MENDER_TEST_IMAGE@"
+
 
 class Artifacts:
     artifacts_tool_path = "mender-artifact"
@@ -49,10 +57,11 @@ class Artifacts:
             assert os.path.exists(private_key), "private key for testing doesn't exist"
             signed_arg = "-k %s" % (private_key)
 
+        # the image is filled in by _make_image_artifact
         cmd = "%s %s  write rootfs-image -f %s -t %s -n %s -o %s %s %s" % (
             self.artifacts_tool_path,
             global_flags,
-            image,
+            _IMAGE_PLACEHOLDER,
             device_type,
             artifact_name,
             artifact_filename,
@@ -68,10 +77,7 @@ class Artifacts:
         for key, value in provides.items():
             cmd += " -p %s:%s" % (key, value)
 
-        logger.info("Running: " + cmd)
-        subprocess.check_call(cmd, shell=True)
-
-        return artifact_filename
+        return self._make_image_artifact(cmd, artifact_filename, image)
 
     def make_module_artifact(
         self,
@@ -121,9 +127,74 @@ class Artifacts:
         for key, value in provides.items():
             cmd += " -p %s:%s" % (key, value)
 
-        logger.info("Running: " + cmd)
-        subprocess.check_call(cmd, shell=True)
+        inputs = {
+            "type": module_type,
+            "device_type": device_type,
+            "files": [os.path.basename(file) for file in files],
+            "meta_data": meta_data is not None,
+            "scripts": [os.path.basename(script) for script in scripts],
+            "global_flags": global_flags,
+            "version": version,
+            "depends": depends,
+            "provides": provides,
+            "signed": signed,
+        }
+        files = (
+            files
+            + ([meta_data] if meta_data else [])
+            + scripts
+            + ([private_key] if signed else [])
+        )
+        return self._make_artifact(
+            cmd, artifact_name, artifact_filename, inputs, files, signed, version
+        )
+
+    def _make_artifact(
+        self, cmd, artifact_name, artifact_filename, inputs, files, signed, version
+    ):
+        """
+        Runs the mender-artifact command cmd, unless the artifact cache has
+        an artifact built from the same inputs and files already.
+        """
+
+        def build(output):
+            logger.info("Running: " + cmd)
+            subprocess.check_call(cmd, shell=True)
+
+        if signed or version not in (None, 3):
+            # cannot be renamed, the name is part of the key
+            inputs["artifact_name"] = artifact_name
+            artifact_name = None
+        return cache.get(
+            artifact_filename,
+            build,
+            inputs,
+            files,
+            artifact_name,
+            tools=(self.artifacts_tool_path,),
+        )
+
+    def _make_image_artifact(self, cmd, artifact_filename, image):
+        """
+        Runs the mender-artifact command cmd writing an artifact of image.
 
+        Such artifacts are not cached: mender-artifact writes the artifact
+        name into the /etc/mender/artifact_info of the image, so they could
+        not be renamed, and most are built under a random name.
+
+        mender-artifact may modify the image it writes into the artifact,
+        hence cmd is run against a private copy-on-write copy of image: the
+        image can then be shared by concurrent tests without any locking.
+        """
+        # same directory, so that the copy can be a reflink
+        with tempfile.TemporaryDirectory(
+            dir=os.path.dirname(os.path.abspath(image))
+        ) as d:
+            image_copy = os.path.join(d, os.path.basename(image))
+            copy_image(image, image_copy)
+            image_cmd = cmd.replace(_IMAGE_PLACEHOLDER, image_copy)
+            logger.info("Running: " + image_cmd)
+            subprocess.check_call(image_cmd, shell=True)
         return artifact_filename
 
     def get_mender_conf(self, image):
@@ -131,41 +202,15 @@ class Artifacts:
         Get the /etc/mender/mender.conf from the artifact rootfs as a
         python dictionary.
         """
-        conf = {}
-
-        output = subprocess.check_output(
-            "debugfs -R 'cat /etc/mender/mender.conf' " + "%s" % image, shell=True,
-        ).decode()
-        import json
-
-        conf = json.loads(output)
-
-        return conf
+        return json.loads(read_file(image, "/etc/mender/mender.conf"))
 
     def replace_mender_conf(self, image, conf):
         """
-        Get the /etc/mender/mender.conf from the artifact rootfs as a
-        python dictionary.
+        Replace the /etc/mender/mender.conf of the artifact rootfs with the
+        python dictionary conf.
         """
-        tmp_conf_dir = os.path.join(os.path.curdir, "tmp_conf")
-        try:
-            os.mkdir(tmp_conf_dir)
-            tmp_conf_path = os.path.join(tmp_conf_dir, "mender.conf")
-            import json
-
-            with open(tmp_conf_path, "w") as f:
-                json.dump(conf, f, indent=2, sort_keys=True)
-            debugfs_cmd = (
-                "cd /etc/mender/\n"
-                + "rm mender.conf\n"
-                + "write %s mender.conf\n" % tmp_conf_path
-                + "close\n"
-            )
-
-            cmd = "cat << EOF | debugfs -w %s\n%sEOF\n" % (image, debugfs_cmd)
-            retcode = subprocess.call(cmd, shell=True)
-            if retcode != 0:
-                logger.fatal("debugfs returned status code: %s." % retcode)
-        finally:
-            shutil.rmtree(tmp_conf_dir)
+        patch_image(
+            image,
+            {"/etc/mender/mender.conf": json.dumps(conf, indent=2, sort_keys=True)},
+        )
         return conf
@@ -15,6 +15,7 @@
 import time
 import json
 import os
+import threading
 import requests
 import pytest
 
@@ -23,6 +24,116 @@ from . import api_version
 from . import get_container_manager
 from .requests_helpers import requests_retry
 
+from testutils.api import deployments
+from testutils.util.multipart import MultipartEncoder, progress_reporter
+
+
+class DeploymentWatcher:
+    """
+    Polls deployments by ID until they reach a given state. The polling
+    interval starts short and grows with every poll, and concurrent waiters
+    of the same deployment share its polls: while one of them fetches it,
+    the others wait for the result. Every change of the status or the
+    statistics of a watched deployment is recorded with its time.
+    """
+
+    def __init__(self, deploy, min_interval=0.2, max_interval=2.0, backoff=1.5):
+        self.deploy = deploy
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        # deployment id: list of (time.monotonic(), status, non zero statistics)
+        self.transitions = {}
+        self._cond = threading.Condition()
+        self._polling = set()
+        self._polls = {}
+        self._snapshots = {}
+        self._local = threading.local()
+
+    def _get(self, url):
+        # one session (connection pool) per thread
+        if getattr(self._local, "session", None) is None:
+            self._local.session = requests_retry()
+        r = self._local.session.get(
+            url, headers=self.deploy.auth.get_auth_token(), verify=False
+        )
+        assert r.status_code == requests.status_codes.codes.ok, r.text
+        return r.json()
+
+    def _fetch(self, deployment_id):
+        base_url = self.deploy.get_deployments_base_path() + "deployments/"
+        deployment = self._get(base_url + deployment_id)
+        statistics = self._get(base_url + deployment_id + "/statistics")
+        return deployment, statistics
+
+    def poll(self, deployment_id):
+        """
+        Returns the deployment and its statistics, fetched now, or by
+        another waiter polling them at the same time.
+        """
+        with self._cond:
+            if deployment_id in self._polling:
+                polls = self._polls.get(deployment_id, 0)
+                self._cond.wait_for(lambda: self._polls.get(deployment_id, 0) != polls)
+                if deployment_id in self._snapshots:
+                    return self._snapshots[deployment_id]
+            self._polling.add(deployment_id)
+
+        snapshot = None
+        try:
+            snapshot = self._fetch(deployment_id)
+        finally:
+            with self._cond:
+                self._polling.discard(deployment_id)
+                self._polls[deployment_id] = self._polls.get(deployment_id, 0) + 1
+                if snapshot is not None:
+                    self._snapshots[deployment_id] = snapshot
+                    self._record(deployment_id, *snapshot)
+                else:
+                    self._snapshots.pop(deployment_id, None)
+                self._cond.notify_all()
+        return snapshot
+
+    def _record(self, deployment_id, deployment, statistics):
+        counts = {k: v for k, v in statistics.items() if v}
+        transitions = self.transitions.setdefault(deployment_id, [])
+        if len(transitions) == 0 or transitions[-1][1:] != (
+            deployment["status"],
+            counts,
+        ):
+            transitions.append((time.monotonic(), deployment["status"], counts))
+            logger.info(
+                "deployment %s: %s %s" % (deployment_id, deployment["status"], counts)
+            )
+
+    def wait(self, deployment_id, done, max_wait=60 * 60, min_interval=None):
+        """
+        Polls the deployment until done(deployment, statistics) is true.
+        :returns: the deployment and its statistics
+        """
+        interval = min_interval or self.min_interval
+        timeout = time.monotonic() + max_wait
+        while True:
+            deployment, statistics = self.poll(deployment_id)
+            if done(deployment, statistics):
+                return deployment, statistics
+            remaining = timeout - time.monotonic()
+            if remaining <= 0:
+                return None
+            time.sleep(min(interval, remaining))
+            interval = min(interval * self.backoff, self.max_interval)
+
+    def first_seen(self, deployment_id):
+        """
+        Returns when (time.monotonic()) every device status of the
+        statistics of the deployment was first seen.
+        """
+        seen = {}
+        for timestamp, _, counts in self.transitions.get(deployment_id, []):
+            for device_status in counts:
+                seen.setdefault(device_status, timestamp)
+        return seen
+
 
 class Deployments:
     # track the last statistic for a deployment id
@@ -36,6 +147,7 @@ class Deployments:
     def reset(self):
         # Reset all temporary values.
         self.last_statistic = Deployments.last_statistic
+        self.watcher = DeploymentWatcher(self)
 
     def get_deployments_base_path(self):
         return "https://%s/api/management/%s/deployments/" % (
@@ -43,32 +155,98 @@ class Deployments:
             api_version,
         )
 
-    def upload_image(self, filename, description="abc"):
+    def upload_image(self, filename, description="abc", direct=False):
+        """
+        Uploads the artifact filename, streaming it with constant memory
+        usage whatever its size. With direct, the artifact is uploaded
+        straight to the storage through a presigned link, bypassing the
+        deployments service.
+        """
+        if direct:
+            return self._direct_upload_image(filename)
+
         image_path_url = self.get_deployments_base_path() + "artifacts"
 
-        r = requests_retry().post(
-            image_path_url,
-            verify=False,
-            headers=self.auth.get_auth_token(),
-            files=(
-                ("description", (None, description)),
-                ("size", (None, str(os.path.getsize(filename)))),
-                (
-                    "artifact",
-                    (filename, open(filename, "rb"), "application/octet-stream"),
-                ),
-            ),
+        body = MultipartEncoder(
+            [
+                ("description", description),
+                ("size", str(os.path.getsize(filename))),
+                ("artifact", (filename, filename, "application/octet-stream")),
+            ],
+            progress=progress_reporter(logger.debug, filename),
         )
+        headers = dict(
+            self.auth.get_auth_token(), **{"Content-Type": body.content_type}
+        )
+        try:
+            r = requests_retry().post(
+                image_path_url, verify=False, headers=headers, data=body,
+            )
+        finally:
+            body.close()
 
         logger.info(
             "Received image upload status code: "
             + str(r.status_code)
             + " with payload: "
             + str(r.text)
+            + " (%d bytes at %.1f MiB/s)" % (len(body), body.throughput())
         )
         assert r.status_code == requests.status_codes.codes.created
         return r.headers["location"]
 
+    def _direct_upload_image(self, filename):
+        base_url = self.get_deployments_base_path().rstrip("/")
+        r = requests_retry().post(
+            base_url + deployments.URL_DEPLOYMENTS_ARTIFACTS_DIRECT_UPLOAD,
+            verify=False,
+            headers=self.auth.get_auth_token(),
+        )
+        assert r.status_code == requests.status_codes.codes.ok, r.text
+        link = r.json()
+
+        started = time.monotonic()
+        with open(filename, "rb") as f:
+            r = requests_retry().put(
+                link["uri"],
+                verify=False,
+                headers={"Content-Type": "application/octet-stream"},
+                data=f,
+            )
+        elapsed = max(time.monotonic() - started, 1e-6)
+        logger.info(
+            "Direct upload of %s: status code %d (%.1f MiB/s)"
+            % (
+                filename,
+                r.status_code,
+                os.path.getsize(filename) / elapsed / 1024 / 1024,
+            )
+        )
+        assert r.status_code < 300, r.text
+
+        r = requests_retry().post(
+            base_url
+            + deployments.URL_DEPLOYMENTS_ARTIFACTS_DIRECT_UPLOAD_COMPLETE.format(
+                id=link["id"]
+            ),
+            verify=False,
+            headers=self.auth.get_auth_token(),
+        )
+        assert r.status_code == requests.status_codes.codes.accepted, r.text
+
+        # the artifact is processed asynchronously once the upload completes
+        location = base_url + deployments.URL_DEPLOYMENTS_ARTIFACTS_GET.format(
+            id=link["id"]
+        )
+        for _ in range(60):
+            r = requests_retry().get(
+                location, verify=False, headers=self.auth.get_auth_token()
+            )
+            if r.status_code == requests.status_codes.codes.ok:
+                return location
+            time.sleep(1)
+        pytest.fail("artifact %s was not processed after its upload" % link["id"])
+
     def trigger_deployment(
         self, name, artifact_name, devices, retries=0, update_control_map=None
     ):
@@ -155,21 +333,17 @@ class Deployments:
     def check_expected_status(
         self, expected_status, deployment_id, max_wait=60 * 60, polling_frequency=0.2
     ):
-        timeout = time.time() + max_wait
-
-        while time.time() <= timeout:
-            data = self.get_status(status=expected_status)
-
-            for deployment in data:
-                if deployment["id"] == deployment_id:
-                    logger.info(
-                        "got expected deployment status (%s) for: %s"
-                        % (expected_status, deployment_id)
-                    )
-                    return
-            else:
-                time.sleep(polling_frequency)
-                continue
+        if self.watcher.wait(
+            deployment_id,
+            lambda deployment, _: deployment["status"] == expected_status,
+            max_wait,
+            polling_frequency,
+        ):
+            logger.info(
+                "got expected deployment status (%s) for: %s"
+                % (expected_status, deployment_id)
+            )
+            return
 
         pytest.fail(
             "Never found status: %s for %s after %d seconds"
@@ -179,21 +353,17 @@ class Deployments:
     def check_not_in_status(
         self, expected_status, deployment_id, max_wait=60 * 60, polling_frequency=0.2
     ):
-        timeout = time.time() + max_wait
-
-        while time.time() <= timeout:
-            data = self.get_status(status=expected_status)
-
-            for deployment in data:
-                if deployment["id"] == deployment_id:
-                    time.sleep(polling_frequency)
-                    continue
-            else:
-                logger.info(
-                    "left deployment status (%s) as expected for: %s"
-                    % (expected_status, deployment_id)
-                )
-                return
+        if self.watcher.wait(
+            deployment_id,
+            lambda deployment, _: deployment["status"] != expected_status,
+            max_wait,
+            polling_frequency,
+        ):
+            logger.info(
+                "left deployment status (%s) as expected for: %s"
+                % (expected_status, deployment_id)
+            )
+            return
 
         pytest.fail(
             "Never left status: %s for %s after %d seconds"
@@ -208,15 +378,7 @@ class Deployments:
         max_wait=60 * 60,
         polling_frequency=0.2,
     ):
-        timeout = time.time() + max_wait
-        seen = set()
-
-        while time.time() <= timeout:
-            time.sleep(polling_frequency)
-
-            data = self.get_statistics(deployment_id)
-            seen.add(str(data))
-
+        def done(_, data):
             if int(data["failure"]) > 0 and expected_status != "failure":
                 all_failed_logs = ""
                 for device in self.devauth.get_devices():
@@ -232,15 +394,16 @@ class Deployments:
                     % (all_failed_logs)
                 )
 
-            if data[expected_status] == expected_count:
-                return
-            continue
+            return data[expected_status] == expected_count
 
-        if time.time() > timeout:
-            pytest.fail(
-                "Never found: %s:%s, only seen: %s after %d seconds"
-                % (expected_status, expected_count, str(seen), max_wait)
-            )
+        if self.watcher.wait(deployment_id, done, max_wait, polling_frequency):
+            return
+
+        seen = [counts for _, _, counts in self.watcher.transitions[deployment_id]]
+        pytest.fail(
+            "Never found: %s:%s, only seen: %s after %d seconds"
+            % (expected_status, expected_count, str(seen), max_wait)
+        )
 
     def get_deployment_overview(self, deployment_id):
         deployments_overview_url = self.get_deployments_base_path() + "deployments/%s/devices" % (
@@ -16,6 +16,7 @@ import time
 import json
 import requests
 import pytest
+from concurrent.futures import ThreadPoolExecutor
 
 from . import logger
 from . import get_container_manager
@@ -45,54 +46,69 @@ class DeviceAuthV2:
     def get_devices(self, expected_devices=1):
         return self.get_devices_status(expected_devices=expected_devices)
 
-    # return devices with the specified status
+    def iter_devices(self, status=None, per_page=500):
+        """
+        Yields the devices, fetched page by page, with the given status if
+        any (filtered by the server).
+        """
+        device_status_path = self.get_devauth_base_path() + "devices"
+        session = requests_retry()
+        page = 1
+        while True:
+            params = {"page": page, "per_page": per_page}
+            if status:
+                params["status"] = status
+            r = session.get(
+                device_status_path,
+                params=params,
+                headers=self.auth.get_auth_token(),
+                verify=False,
+            )
+            r.raise_for_status()
+            devices = r.json()
+            yield from devices
+            if len(devices) < per_page:
+                return
+            page += 1
+
+    # return devices with the specified status, once there are at least
+    # expected_devices devices (whatever their status)
     def get_devices_status(
         self, status=None, expected_devices=1, max_wait=10 * 60, no_assert=False
     ):
-        device_status_path = self.get_devauth_base_path() + "devices"
-        devices = None
         starttime = time.time()
-        sleeptime = 5
+        sleeptime = 1
+        matching = []
 
         got_devices = False
-        while starttime + max_wait >= time.time():
-            time.sleep(sleeptime)
-            # Linear backoff
-            sleeptime += 5
-            logger.info("getting all devices from: %s" % (device_status_path))
-            devices = requests_retry().get(
-                device_status_path, headers=self.auth.get_auth_token(), verify=False
-            )
-            if (
-                devices.status_code == requests.status_codes.codes.ok
-                and len(devices.json()) >= expected_devices
-            ):
-                got_devices = True
+        while True:
+            logger.info("getting devices with status: %s" % (status or "any"))
+            try:
+                matching = list(self.iter_devices(status))
+                if len(matching) >= expected_devices or (
+                    status and sum(1 for _ in self.iter_devices()) >= expected_devices
+                ):
+                    got_devices = True
+                    break
+                logger.info(
+                    "got %d devices, will try for at least %d more seconds"
+                    % (len(matching), starttime + max_wait - time.time())
+                )
+            except requests.RequestException as e:
+                logger.info(
+                    "failed to get devices (%s), will try for at least %d more seconds"
+                    % (e, starttime + max_wait - time.time())
+                )
+            remaining = starttime + max_wait - time.time()
+            if remaining <= 0:
                 break
-            else:
-                if devices is not None and getattr(devices, "text"):
-                    logger.info(
-                        "fail to get devices (payload: %s), will try for at least %d more seconds"
-                        % (devices.text, starttime + max_wait - time.time())
-                    )
-                else:
-                    logger.info(
-                        "failed to get devices, will try for at least %d more seconds"
-                        % (starttime + max_wait - time.time())
-                    )
+            time.sleep(min(sleeptime, remaining))
+            # Exponential backoff
+            sleeptime = min(sleeptime * 2, 30)
 
         if not no_assert:
             assert got_devices, "Not able to get devices"
 
-        devices_json = devices.json()
-
-        if not status:
-            return devices_json
-
-        matching = []
-        for d in devices_json:
-            if d["status"] == status:
-                matching.append(d)
         return matching
 
     def set_device_auth_set_status(self, device_id, auth_set_id, status):
@@ -142,25 +158,28 @@ class DeviceAuthV2:
         ) == len(get_container_manager().get_mender_clients()):
             return
 
-        # iterate over devices and accept them
-        for d in self.get_devices(expected_devices=expected_devices):
-            self.set_device_auth_set_status(
-                d["id"], d["auth_sets"][0]["id"], "accepted"
+        # accept all the devices at once
+        devices = [
+            d
+            for d in self.get_devices(expected_devices=expected_devices)
+            if d["status"] != "accepted"
+        ]
+        with ThreadPoolExecutor(max_workers=min(len(devices), 16) or 1) as executor:
+            list(
+                executor.map(
+                    lambda d: self.set_device_auth_set_status(
+                        d["id"], d["auth_sets"][0]["id"], "accepted"
+                    ),
+                    devices,
+                )
             )
 
         # block until devices are actually accepted
         timeout = time.time() + 30
         while time.time() <= timeout:
-            time.sleep(1)
-            if (
-                len(
-                    self.get_devices_status(
-                        status="accepted", expected_devices=expected_devices
-                    )
-                )
-                == expected_devices
-            ):
+            if len(list(self.iter_devices("accepted"))) == expected_devices:
                 break
+            time.sleep(0.5)
 
         if time.time() > timeout:
             pytest.fail("wasn't able to accept device after 30 seconds")
@@ -14,9 +14,13 @@
 
 import pytest
 import ssl
+from concurrent.futures import ThreadPoolExecutor
 
 from testutils.util import websockets
 from testutils.api import deviceconnect
+from testutils.api.proto_playback import Playback
+from testutils.api.proto_portforward import PortForward
+from testutils.api.proto_session import SessionManager
 from . import api_version
 from . import get_container_manager
 
@@ -31,25 +35,45 @@ class DeviceConnect:
         # Reset all temporary values.
         pass
 
-    def get_websocket_url(self):
-        auth_json = self.devauth.get_devices()
-        dev_id = auth_json[0]["id"]
+    def get_websocket_url(self, dev_id=None):
+        if dev_id is None:
+            auth_json = self.devauth.get_devices()
+            dev_id = auth_json[0]["id"]
         url_path = deviceconnect.URL_MGMT + deviceconnect.URL_MGMT_CONNECT.format(
             id=dev_id
         )
         host_uri = "wss://" + get_container_manager().get_mender_gateway()
         return host_uri + url_path
 
-    def get_websocket(self):
+    def get_websocket(self, dev_id=None):
         headers = {}
         headers.update(self.auth.get_auth_token())
 
         ws = websockets.Websocket(
-            self.get_websocket_url(), headers=headers, insecure=True
+            self.get_websocket_url(dev_id), headers=headers, insecure=True
         )
 
         return ws
 
+    def get_port_forward(self, dev_id, mappings, **kwargs):
+        """
+        Returns a PortForward of the local ports to the device, see
+        PortForward for mappings and the other arguments.
+        """
+        headers = {}
+        headers.update(self.auth.get_auth_token())
+
+        return PortForward(self.get_websocket_url(dev_id), headers, mappings, **kwargs)
+
+    def get_session_manager(self, max_connecting=50):
+        """Returns a SessionManager, to run many sessions to devices at once"""
+        headers = {}
+        headers.update(self.auth.get_auth_token())
+
+        return SessionManager(
+            get_container_manager().get_mender_gateway(), headers, max_connecting
+        )
+
     def get_playback_url(self, session_id, sleep_ms=None):
         url_path = deviceconnect.URL_MGMT + deviceconnect.URL_MGMT_PLAYBACK.format(
             session_id=session_id
@@ -68,3 +92,16 @@ class DeviceConnect:
             self.get_playback_url(session_id, sleep_ms), headers=headers, insecure=True
         )
         return ws
+
+    def get_playback(self, session_id, timeout=5):
+        """Reads the recording of the session, played back at full speed"""
+        with self.get_playback_websocket(session_id, sleep_ms=0) as ws:
+            return Playback(ws).read(timeout)
+
+    def get_playbacks(self, session_ids, max_workers=16, timeout=5):
+        """Reads the recordings of many sessions concurrently, by session ID"""
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            playbacks = executor.map(
+                lambda session_id: self.get_playback(session_id, timeout), session_ids
+            )
+            return dict(zip(session_ids, playbacks))
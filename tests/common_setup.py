@@ -13,6 +13,7 @@
 #    limitations under the License.
 
 import json
+import os
 import pytest
 import uuid
 
@@ -27,13 +28,42 @@ from testutils.infra.container_manager import factory
 
 container_factory = factory.get_factory()
 
+# Number of pre-started namespaces kept per setup type, 0 disables pooling
+ENV_POOL_SIZE = int(os.getenv("ENV_POOL_SIZE", "0"))
+# Number of pooled namespaces running at once across all setup types, idle
+# namespaces of other setup types are torn down beyond it
+ENV_POOL_MAX_RUNNING = int(os.getenv("ENV_POOL_MAX_RUNNING", str(ENV_POOL_SIZE)))
+
+# Snapshot of the backend data with the tenant of create_tenant(), and the
+# tenant and user it holds, by name of the pooled namespace
+TENANT_SNAPSHOT = "tenant"
+_tenant_snapshots = {}
+
+
+def get_setup(request, setup, **kwargs):
+    """Returns a namespace which is set up, created with the given factory
+    method of container_factory (e.g. "getStandardSetup") and kwargs.
+
+    With ENV_POOL_SIZE > 0 the namespace is leased from a pool of
+    pre-started ones and given back to it (reset) once the test finishes,
+    instead of being created for and torn down after each test.
+    """
+    if ENV_POOL_SIZE > 0:
+        pool = container_factory.getPool(
+            setup, ENV_POOL_SIZE, ENV_POOL_MAX_RUNNING, **kwargs
+        )
+        env = pool.lease()
+        request.addfinalizer(lambda: pool.release(env))
+    else:
+        env = getattr(container_factory, setup)(**kwargs)
+        request.addfinalizer(env.teardown)
+        env.setup()
+    return env
+
 
 @pytest.fixture(scope="function")
 def standard_setup_one_client(request):
-    env = container_factory.getStandardSetup(num_clients=1)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getStandardSetup", num_clients=1)
 
     env.device = MenderDevice(env.get_mender_clients()[0])
     env.device.ssh_is_opened()
@@ -46,20 +76,14 @@ def standard_setup_one_client(request):
 
 @pytest.fixture(scope="function")
 def monitor_commercial_setup_no_client(request):
-    env = container_factory.getMonitorCommercialSetup(num_clients=0)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getMonitorCommercialSetup", num_clients=0)
     reset_mender_api(env)
 
     return env
 
 
 def standard_setup_one_client_bootstrapped_impl(request):
-    env = container_factory.getStandardSetup(num_clients=1)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getStandardSetup", num_clients=1)
 
     env.device = MenderDevice(env.get_mender_clients()[0])
     env.device.ssh_is_opened()
@@ -83,10 +107,7 @@ def class_persistent_standard_setup_one_client_bootstrapped(request):
 
 @pytest.fixture(scope="function")
 def standard_setup_one_client_bootstrapped_with_gateway(request):
-    env = container_factory.getStandardSetupWithGateway(num_clients=1)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getStandardSetupWithGateway", num_clients=1)
 
     env.device = MenderDevice(env.get_mender_clients(network="mender_local")[0])
     env.device.ssh_is_opened()
@@ -103,10 +124,7 @@ def standard_setup_one_client_bootstrapped_with_gateway(request):
 
 @pytest.fixture(scope="function")
 def standard_setup_two_clients_bootstrapped_with_gateway(request):
-    env = container_factory.getStandardSetupWithGateway(num_clients=2)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getStandardSetupWithGateway", num_clients=2)
 
     env.device_group = MenderDeviceGroup(env.get_mender_clients(network="mender_local"))
     env.device_group.ssh_is_opened()
@@ -124,10 +142,7 @@ def standard_setup_two_clients_bootstrapped_with_gateway(request):
 
 @pytest.fixture(scope="function")
 def standard_setup_one_rofs_client_bootstrapped(request):
-    env = container_factory.getRofsClientSetup()
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getRofsClientSetup")
 
     env.device = MenderDevice(env.get_mender_clients()[0])
     env.device.ssh_is_opened()
@@ -141,10 +156,7 @@ def standard_setup_one_rofs_client_bootstrapped(request):
 
 @pytest.fixture(scope="function")
 def standard_setup_one_docker_client_bootstrapped(request):
-    env = container_factory.getDockerClientSetup()
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getDockerClientSetup")
 
     env.device = MenderDevice(env.get_mender_clients()[0])
     env.device.ssh_is_opened()
@@ -158,10 +170,7 @@ def standard_setup_one_docker_client_bootstrapped(request):
 
 @pytest.fixture(scope="function")
 def standard_setup_two_clients_bootstrapped(request):
-    env = container_factory.getStandardSetup(num_clients=2)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getStandardSetup", num_clients=2)
 
     env.device_group = MenderDeviceGroup(env.get_mender_clients())
     env.device_group.ssh_is_opened()
@@ -175,10 +184,7 @@ def standard_setup_two_clients_bootstrapped(request):
 
 @pytest.fixture(scope="function")
 def standard_setup_without_client(request):
-    env = container_factory.getStandardSetup(num_clients=0)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getStandardSetup", num_clients=0)
     reset_mender_api(env)
 
     return env
@@ -193,10 +199,7 @@ def setup_with_legacy_client(request):
             "Test only works with qemux86-64, and this is %s" % conftest.machine_name
         )
 
-    env = container_factory.getLegacyClientSetup()
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getLegacyClientSetup")
 
     env.device = MenderDevice(env.get_mender_clients()[0])
     env.device.ssh_is_opened()
@@ -210,10 +213,7 @@ def setup_with_legacy_client(request):
 
 @pytest.fixture(scope="function")
 def standard_setup_with_signed_artifact_client(request):
-    env = container_factory.getSignedArtifactClientSetup()
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getSignedArtifactClientSetup")
 
     env.device = MenderDevice(env.get_mender_clients()[0])
     env.device.ssh_is_opened()
@@ -228,10 +228,7 @@ def standard_setup_with_signed_artifact_client(request):
 
 @pytest.fixture(scope="function")
 def standard_setup_with_short_lived_token(request):
-    env = container_factory.getShortLivedTokenSetup()
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getShortLivedTokenSetup")
 
     env.device = MenderDevice(env.get_mender_clients()[0])
     env.device.ssh_is_opened()
@@ -246,10 +243,7 @@ def standard_setup_with_short_lived_token(request):
 
 @pytest.fixture(scope="function")
 def setup_failover(request):
-    env = container_factory.getFailoverServerSetup()
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getFailoverServerSetup")
     reset_mender_api(env)
 
     env.device = MenderDevice(env.get_mender_clients()[0])
@@ -280,10 +274,7 @@ def running_custom_production_setup(request):
 
 @pytest.fixture(scope="function")
 def enterprise_no_client(request):
-    env = container_factory.getEnterpriseSetup(num_clients=0)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getEnterpriseSetup", num_clients=0)
     reset_mender_api(env)
 
     return env
@@ -291,10 +282,7 @@ def enterprise_no_client(request):
 
 @pytest.fixture(scope="function")
 def enterprise_one_client(request):
-    env = container_factory.getEnterpriseSetup(num_clients=0)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getEnterpriseSetup", num_clients=0)
     reset_mender_api(env)
 
     tenant = create_tenant(env)
@@ -305,10 +293,7 @@ def enterprise_one_client(request):
 
 
 def enterprise_one_client_bootstrapped_impl(request):
-    env = container_factory.getEnterpriseSetup(num_clients=0)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getEnterpriseSetup", num_clients=0)
     reset_mender_api(env)
 
     tenant = create_tenant(env)
@@ -335,10 +320,7 @@ def class_persistent_enterprise_one_client_bootstrapped(request):
 
 @pytest.fixture(scope="class")
 def enterprise_one_client_bootstrapped_with_gateway(request):
-    env = container_factory.getEnterpriseSetupWithGateway(num_clients=0)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getEnterpriseSetupWithGateway", num_clients=0)
     reset_mender_api(env)
 
     tenant = create_tenant(env)
@@ -363,10 +345,7 @@ def enterprise_one_client_bootstrapped_with_gateway(request):
 
 @pytest.fixture(scope="class")
 def enterprise_two_clients_bootstrapped_with_gateway(request):
-    env = container_factory.getEnterpriseSetupWithGateway(num_clients=0)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getEnterpriseSetupWithGateway", num_clients=0)
     reset_mender_api(env)
 
     tenant = create_tenant(env)
@@ -394,10 +373,7 @@ def enterprise_two_clients_bootstrapped_with_gateway(request):
 
 @pytest.fixture(scope="function")
 def enterprise_two_clients_bootstrapped(request):
-    env = container_factory.getEnterpriseSetup(num_clients=0)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getEnterpriseSetup", num_clients=0)
     reset_mender_api(env)
 
     tenant = create_tenant(env)
@@ -415,10 +391,7 @@ def enterprise_two_clients_bootstrapped(request):
 
 @pytest.fixture(scope="function")
 def enterprise_one_docker_client_bootstrapped(request):
-    env = container_factory.getEnterpriseDockerClientSetup(num_clients=0)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getEnterpriseDockerClientSetup", num_clients=0)
     reset_mender_api(env)
 
     tenant = create_tenant(env)
@@ -435,10 +408,7 @@ def enterprise_one_docker_client_bootstrapped(request):
 
 @pytest.fixture(scope="function")
 def enterprise_one_rofs_client_bootstrapped(request):
-    env = container_factory.getEnterpriseRofsClientSetup(num_clients=0)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getEnterpriseRofsClientSetup", num_clients=0)
     reset_mender_api(env)
 
     tenant = create_tenant(env)
@@ -455,25 +425,35 @@ def enterprise_one_rofs_client_bootstrapped(request):
 
 @pytest.fixture(scope="class")
 def enterprise_no_client_class(request):
-    env = container_factory.getEnterpriseSetup(num_clients=0)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getEnterpriseSetup", num_clients=0)
     reset_mender_api(env)
 
     return env
 
 
 def create_tenant(env):
-    uuidv4 = str(uuid.uuid4())
-    tname = "test.mender.io-{}".format(uuidv4)
-    email = "some.user+{}@example.com".format(uuidv4)
-    u = User("", email, "whatsupdoc")
-    cli = CliTenantadm(containers_namespace=env.name)
-    tid = cli.create_org(tname, u.name, u.pwd, plan="os")
-
-    tenant = cli.get_tenant(tid)
-    tenant = json.loads(tenant)
+    """Creates a tenant with one user, and authenticates env.auth as that user.
+
+    With pooling, the backend data right after the first tenant is created
+    on a namespace is snapshotted: the following tests leasing the namespace
+    restore it, instead of creating a tenant again.
+    """
+    if ENV_POOL_SIZE > 0 and env.name in _tenant_snapshots:
+        tenant, u = _tenant_snapshots[env.name]
+        env.restore(TENANT_SNAPSHOT)
+    else:
+        uuidv4 = str(uuid.uuid4())
+        tname = "test.mender.io-{}".format(uuidv4)
+        email = "some.user+{}@example.com".format(uuidv4)
+        u = User("", email, "whatsupdoc")
+        cli = CliTenantadm(containers_namespace=env.name)
+        tid = cli.create_org(tname, u.name, u.pwd, plan="os")
+
+        tenant = cli.get_tenant(tid)
+        tenant = json.loads(tenant)
+        if ENV_POOL_SIZE > 0:
+            env.snapshot(TENANT_SNAPSHOT)
+            _tenant_snapshots[env.name] = (tenant, u)
     env.tenant = tenant
 
     auth = authentication.Authentication(
@@ -488,10 +468,7 @@ def create_tenant(env):
 
 @pytest.fixture(scope="function")
 def enterprise_with_signed_artifact_client(request):
-    env = container_factory.getEnterpriseSignedArtifactClientSetup()
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getEnterpriseSignedArtifactClientSetup")
     reset_mender_api(env)
 
     tenant = create_tenant(env)
@@ -508,10 +485,7 @@ def enterprise_with_signed_artifact_client(request):
 
 @pytest.fixture(scope="function")
 def enterprise_with_short_lived_token(request):
-    env = container_factory.getEnterpriseShortLivedTokenSetup()
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getEnterpriseShortLivedTokenSetup")
     reset_mender_api(env)
 
     tenant = create_tenant(env)
@@ -528,10 +502,7 @@ def enterprise_with_short_lived_token(request):
 
 @pytest.fixture(scope="function")
 def enterprise_with_legacy_client(request):
-    env = container_factory.getEnterpriseLegacyClientSetup(num_clients=0)
-    request.addfinalizer(env.teardown)
-
-    env.setup()
+    env = get_setup(request, "getEnterpriseLegacyClientSetup", num_clients=0)
     reset_mender_api(env)
 
     tenant = create_tenant(env)
@@ -24,6 +24,7 @@ import filelock
 import pytest
 from testutils.infra.container_manager.base import BaseContainerManagerNamespace
 from testutils.infra.device import MenderDevice, MenderDeviceGroup
+from testutils.util.image import copy_image, patch_image, read_file
 
 from . import log
 from .tests.mendertesting import MenderTesting
@@ -64,36 +65,11 @@ def add_mender_conf_to_image(image, d, mender_conf):
     """Copy image to the dir 'd', and replace the images /etc/mender/mender.conf
     with the contents of the string 'mender_conf'"""
 
-    mender_conf_tmp = os.path.join(d, "mender.conf")
-
-    with open(mender_conf_tmp, "w") as f:
-        f.write(mender_conf)
-
     new_image = os.path.join(d, image)
-    shutil.copy(image, new_image)
-
-    instr_file = os.path.join(d, "write.instr")
-    with open(os.path.join(d, "write.instr"), "w") as f:
-        f.write(
-            """cd /etc/mender
-        rm mender.conf
-        write {local} mender.conf""".format(
-                local=mender_conf_tmp
-            )
-        )
-    subprocess.run(
-        ["debugfs", "-w", "-f", instr_file, new_image],
-        check=True,
-        stdout=subprocess.PIPE,
-    )
+    copy_image(image, new_image)
+    patch_image(new_image, {"/etc/mender/mender.conf": mender_conf})
 
-    res = subprocess.run(
-        ["debugfs", "-R", "cat /etc/mender/mender.conf", new_image],
-        check=True,
-        stdout=subprocess.PIPE,
-    )
-
-    assert "ServerURL" in res.stdout.decode()
+    assert "ServerURL" in read_file(new_image, "/etc/mender/mender.conf").decode()
 
     return new_image
 
@@ -242,6 +218,13 @@ def pytest_exception_interact(node, call, report):
             logger.info(line)
 
 
+def pytest_sessionfinish(session, exitstatus):
+    # imported here, common_setup itself depends on this module
+    from .common_setup import container_factory
+
+    container_factory.shutdownPools()
+
+
 def verify_sane_test_environment():
     # check if required tools are in PATH, add any other checks here
     if distutils.spawn.find_executable("mender-artifact") is None:
@@ -18,6 +18,7 @@ import pytest
 import json
 import time
 from . import conftest
+from testutils.util import image
 
 from .MenderAPI import devauth
 
@@ -31,16 +32,14 @@ class Helpers:
     @classmethod
     def yocto_id_from_ext4(self, filename):
         try:
-            cmd = "debugfs -R 'cat %s' %s| sed -n 's/^%s=//p'" % (
-                self.artifact_info_file,
-                filename,
-                self.artifact_prefix,
+            output = image.artifact_info(filename).get(self.artifact_prefix, "")
+            logger.info(
+                "Reading %s of %s returned: %s"
+                % (self.artifact_info_file, filename, output)
             )
-            output = subprocess.check_output(cmd, shell=True).decode().strip()
-            logger.info("Running: " + cmd + " returned: " + output)
             return output
 
-        except subprocess.CalledProcessError:
+        except (subprocess.CalledProcessError, FileNotFoundError):
             pytest.fail("Unable to read: %s, is it a broken image?" % (filename))
 
         except Exception as e:
@@ -13,12 +13,8 @@
 #    limitations under the License.
 #
 
-import hashlib
+from testutils.util.transfer import file_md5
 
 
 def md5sum(fname):
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    return file_md5(fname)
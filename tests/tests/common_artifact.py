@@ -15,6 +15,8 @@
 import subprocess
 import tempfile
 
+from testutils.util.artifact_cache import cache
+
 from ..MenderAPI import logger
 
 
@@ -32,7 +34,16 @@ def get_script_artifact(
         if extra_args is not None:
             cmd += f" {extra_args}"
 
-        logger.info(f"Executing command: {cmd}")
-        subprocess.check_call(cmd, shell=True)
+        def build(output):
+            logger.info(f"Executing command: {cmd}")
+            subprocess.check_call(cmd, shell=True)
 
-        return output_path
+        inputs = {"type": "script", "device_type": device_type}
+        if extra_args is not None:
+            # may sign the artifact or change its version, which prevents
+            # renaming it: the name is part of the key
+            inputs.update(extra_args=extra_args, artifact_name=artifact_name)
+            return cache.get(output_path, build, inputs, [script_path])
+        return cache.get(
+            output_path, build, inputs, [script_path], artifact_name=artifact_name
+        )
@@ -0,0 +1,195 @@
+# Copyright 2022 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import uuid
+
+import pytest
+
+from testutils.util.artifact_cache import cache
+
+from .. import conftest
+from ..MenderAPI import devauth, deploy, image, logger
+from .common_update import common_update_procedure
+
+DELTA_GENERATOR = "mender-binary-delta-generator"
+DELTA_MODULE = "/usr/share/mender/modules/v3/mender-binary-delta"
+
+# deployment statuses after which the device is done with a deployment
+FINISHED_STATUSES = (
+    "success",
+    "failure",
+    "noartifact",
+    "already-installed",
+    "aborted",
+    "decommissioned",
+)
+
+
+def make_delta_artifact(full_from, full_to, artifact_name, output_path):
+    """Generates the delta artifact updating from full_from to full_to"""
+
+    def build(output):
+        cmd = [DELTA_GENERATOR, "-n", artifact_name, "-o", output, full_from, full_to]
+        logger.info("Running: " + " ".join(cmd))
+        subprocess.check_call(cmd)
+
+    return cache.get(
+        output_path,
+        build,
+        {"type": "mender-binary-delta"},
+        [full_from, full_to],
+        artifact_name=artifact_name,
+        tools=(DELTA_GENERATOR,),
+    )
+
+
+def watch_deployment(deploy, deployment_id, max_wait=60 * 60, polling_frequency=0.5):
+    """
+    Waits for a single device deployment to finish.
+    :returns: dict of status: seconds at which it was first seen
+    """
+    started = time.monotonic()
+    if not deploy.watcher.wait(
+        deployment_id,
+        lambda _, stats: any(stats.get(status, 0) > 0 for status in FINISHED_STATUSES),
+        max_wait,
+        polling_frequency,
+    ):
+        pytest.fail("deployment %s did not finish in %ds" % (deployment_id, max_wait))
+    return {
+        status: max(timestamp - started, 0)
+        for status, timestamp in deploy.watcher.first_seen(deployment_id).items()
+    }
+
+
+def _timed_update(device, host_ip, make_artifact, devauth, deploy):
+    artifacts = {}
+
+    def make(artifact_file, artifact_name):
+        artifacts["path"] = make_artifact(artifact_file, artifact_name)
+        artifacts["size"] = os.path.getsize(artifacts["path"])
+        return artifacts["path"]
+
+    with device.get_reboot_detector(host_ip) as reboot:
+        deployment_id, artifact_name = common_update_procedure(
+            make_artifact=make, verify_status=False, devauth=devauth, deploy=deploy,
+        )
+        timeline = watch_deployment(deploy, deployment_id)
+        reboot.verify_reboot_performed()
+
+    deploy.check_expected_statistics(deployment_id, "success", 1)
+    assert device.yocto_id_installed_on_machine() == artifact_name
+
+    # the artifact is written (or patched) while it is downloaded
+    download_start = timeline.get("downloading", 0)
+    apply_end = timeline.get("rebooting", timeline["success"])
+    return {
+        "artifact_bytes": artifacts["size"],
+        "apply_time": apply_end - download_start,
+        "end_to_end": timeline["success"],
+        "timeline": timeline,
+    }
+
+
+def _update_to(device, host_ip, artifact_name, devauth, deploy):
+    """Deploys the uploaded artifact named artifact_name to the device"""
+    devices = [d["id"] for d in devauth.get_devices_status("accepted")]
+    with device.get_reboot_detector(host_ip) as reboot:
+        deployment_id = deploy.trigger_deployment(
+            name="Update to " + artifact_name,
+            artifact_name=artifact_name,
+            devices=devices,
+        )
+        watch_deployment(deploy, deployment_id)
+        reboot.verify_reboot_performed()
+
+    deploy.check_expected_statistics(deployment_id, "success", 1)
+    assert device.yocto_id_installed_on_machine() == artifact_name
+
+
+def compare_full_and_delta_update(
+    device,
+    host_ip,
+    image_from,
+    image_to,
+    device_type=conftest.machine_name,
+    devauth=devauth,
+    deploy=deploy,
+    output=None,
+):
+    """
+    Updates device from image_from to image_to, first with a full rootfs
+    artifact and then with a delta artifact, and reports the transferred
+    bytes, the device side apply time and the end to end duration of both.
+    The device is updated to the full artifact of image_from the delta is
+    generated from before each measured update, so that the delta applies
+    to the rootfs it was made for. Delta updates need a read-only rootfs.
+    :param output: path of the file the report is written to, as JSON
+    :returns: the report
+    """
+    if shutil.which(DELTA_GENERATOR) is None:
+        pytest.skip("%s is not installed" % DELTA_GENERATOR)
+    installed = device.run("test -x %s && echo yes || echo no" % DELTA_MODULE)
+    if installed.strip() != "yes":
+        pytest.skip("mender-binary-delta is not installed on the device")
+
+    def full_artifact(image_path):
+        return lambda artifact_file, artifact_name: image.make_rootfs_artifact(
+            image_path, device_type, artifact_name, artifact_file
+        )
+
+    from_name = "delta-from-%s" % uuid.uuid4().hex[:8]
+    with tempfile.TemporaryDirectory() as d:
+        full_from = full_artifact(image_from)(os.path.join(d, "from.mender"), from_name)
+        full_to = full_artifact(image_to)(os.path.join(d, "to.mender"), "delta-to")
+        deploy.upload_image(full_from)
+
+        def delta_artifact(artifact_file, artifact_name):
+            return make_delta_artifact(full_from, full_to, artifact_name, artifact_file)
+
+        report = {}
+        for kind, make_artifact in (
+            ("full", full_artifact(image_to)),
+            ("delta", delta_artifact),
+        ):
+            logger.info("updating to %s before the %s update" % (from_name, kind))
+            _update_to(device, host_ip, from_name, devauth, deploy)
+            report[kind] = _timed_update(
+                device, host_ip, make_artifact, devauth, deploy
+            )
+
+    report["savings"] = {
+        metric: 1 - report["delta"][metric] / report["full"][metric]
+        for metric in ("artifact_bytes", "apply_time", "end_to_end")
+        if report["full"][metric] > 0
+    }
+    logger.info(
+        "full vs delta update: %d vs %d bytes, %.1fs vs %.1fs apply time, "
+        "%.1fs vs %.1fs end to end"
+        % tuple(
+            report[kind][metric]
+            for metric in ("artifact_bytes", "apply_time", "end_to_end")
+            for kind in ("full", "delta")
+        )
+    )
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
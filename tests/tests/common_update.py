@@ -12,15 +12,106 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import json
+import os
+import re
 import tempfile
+import time
 import random
+from contextlib import contextmanager
 
 import pytest
 
 from .. import conftest
 from ..helpers import Helpers
 from ..MenderAPI import devauth, deploy, image, logger
-from . import artifact_lock
+
+# Directory to write the timelines of the updates to, as JSON files
+UPDATE_TIMELINE_DIR = os.environ.get("UPDATE_TIMELINE_DIR")
+
+
+class UpdateTimeline:
+    """
+    Timestamps the phases of an update: artifact creation, upload,
+    triggering, the statuses of the deployment and of the device, and the
+    reboots of the device.
+    """
+
+    def __init__(self, name=None):
+        if name is None:
+            name = os.environ.get("PYTEST_CURRENT_TEST", "update").split(" ")[0]
+        self.name = name
+        self.started = time.monotonic()
+        # (seconds since the start, event)
+        self.events = []
+        # phase: duration (s)
+        self.phases = {}
+
+    def event(self, name, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        self.events.append((timestamp - self.started, name))
+
+    @contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        self.event(name + " started", started)
+        try:
+            yield
+        finally:
+            self.phases[name] = time.monotonic() - started
+            self.event(name + " finished")
+
+    def add_deployment(self, deploy, deployment_id):
+        """Adds the status transitions seen by the deployment watcher"""
+        seen = set()
+        for timestamp, status, _ in deploy.watcher.transitions.get(deployment_id, []):
+            if status not in seen:
+                seen.add(status)
+                self.event("deployment " + status, timestamp)
+        for status, timestamp in deploy.watcher.first_seen(deployment_id).items():
+            self.event("device " + status, timestamp)
+
+    def add_reboots(self, reboot):
+        """Adds the shutdowns and startups seen by the RebootDetector"""
+        for timestamp, message in reboot.events:
+            self.event("device " + message, timestamp)
+
+    def report(self):
+        """Logs the timeline, and writes it to UPDATE_TIMELINE_DIR if set"""
+        events = sorted(self.events)
+        total = time.monotonic() - self.started
+        logger.info(
+            "update timeline of %s (%.1fs):\n%s\nphases:\n%s"
+            % (
+                self.name,
+                total,
+                "\n".join("%9.1fs  %s" % event for event in events),
+                "\n".join(
+                    "%9.1fs  %s" % (duration, phase)
+                    for phase, duration in self.phases.items()
+                ),
+            )
+        )
+        if UPDATE_TIMELINE_DIR is not None:
+            os.makedirs(UPDATE_TIMELINE_DIR, exist_ok=True)
+            path = os.path.join(
+                UPDATE_TIMELINE_DIR, re.sub(r"[^\w.-]", "_", self.name) + ".json"
+            )
+            with open(path, "w") as f:
+                json.dump(
+                    {
+                        "name": self.name,
+                        "total": total,
+                        "phases": self.phases,
+                        "events": [
+                            {"time": timestamp, "event": name}
+                            for timestamp, name in events
+                        ],
+                    },
+                    f,
+                    indent=2,
+                )
 
 
 def common_update_procedure(
@@ -39,17 +130,27 @@ def common_update_procedure(
     version=None,
     devauth=devauth,
     deploy=deploy,
+    timeline=None,
 ):
+    """
+    Creates and uploads an artifact, and deploys it. The phases are recorded
+    in timeline, and if none is given, in a timeline reported on return.
+    The deployment events of the timeline are the status transitions seen
+    by the deployment watcher, which only polls while verify_status waits.
+    """
+    report_timeline = timeline is None
+    if report_timeline:
+        timeline = UpdateTimeline()
 
-    with artifact_lock:
-        if regenerate_image_id:
-            artifact_name = "mender-%s" % str(random.randint(0, 99999999))
-            logger.debug("randomized image id: " + artifact_name)
-        else:
-            artifact_name = Helpers.yocto_id_from_ext4(install_image)
+    if regenerate_image_id:
+        artifact_name = "mender-%s" % str(random.randint(0, 99999999))
+        logger.debug("randomized image id: " + artifact_name)
+    else:
+        artifact_name = Helpers.yocto_id_from_ext4(install_image)
 
-        # create artifact
-        with tempfile.NamedTemporaryFile() as artifact_file:
+    # create artifact
+    with tempfile.NamedTemporaryFile() as artifact_file:
+        with timeline.phase("artifact creation"):
             if make_artifact:
                 created_artifact = make_artifact(artifact_file.name, artifact_name)
             else:
@@ -65,32 +166,42 @@ def common_update_procedure(
                     version=version,
                 )
 
-            if created_artifact:
-                pre_upload_callback()
+        if created_artifact:
+            pre_upload_callback()
+            with timeline.phase("upload"):
                 deploy.upload_image(created_artifact)
-                if devices is None:
-                    devices = list(
-                        set(
-                            [
-                                device["id"]
-                                for device in devauth.get_devices_status("accepted")
-                            ]
-                        )
+            if devices is None:
+                devices = list(
+                    set(
+                        [
+                            device["id"]
+                            for device in devauth.get_devices_status("accepted")
+                        ]
                     )
-                pre_deployment_callback()
+                )
+            pre_deployment_callback()
+            with timeline.phase("trigger"):
                 deployment_id = deploy.trigger_deployment(
                     name="New valid update",
                     artifact_name=artifact_name,
                     devices=devices,
                 )
-            else:
-                logger.warn("failed to create artifact")
-                pytest.fail("error creating artifact")
+        else:
+            logger.warn("failed to create artifact")
+            pytest.fail("error creating artifact")
 
     deployment_triggered_callback()
     # wait until deployment is in correct state
     if verify_status:
-        deploy.check_not_in_status("pending", deployment_id)
+        with timeline.phase("leaving pending"):
+            deploy.check_not_in_status("pending", deployment_id)
+
+    if report_timeline:
+        if not verify_status:
+            # nothing polled the deployment yet
+            deploy.watcher.poll(deployment_id)
+        timeline.add_deployment(deploy, deployment_id)
+        timeline.report()
 
     return deployment_id, artifact_name
 
@@ -121,6 +232,7 @@ def update_image(
         Logs will not be retrieved, and result in 404.
     """
 
+    timeline = UpdateTimeline()
     previous_inactive_part = device.get_passive_partition()
     with device.get_reboot_detector(host_ip) as reboot:
         deployment_id, expected_image_id = common_update_procedure(
@@ -137,8 +249,10 @@ def update_image(
             version=version,
             devauth=devauth,
             deploy=deploy,
+            timeline=timeline,
         )
-        reboot.verify_reboot_performed()
+        with timeline.phase("reboot"):
+            reboot.verify_reboot_performed()
 
         try:
             assert device.get_active_partition() == previous_inactive_part
@@ -152,16 +266,21 @@ def update_image(
                 % (logs)
             )
 
-        deploy.check_expected_statistics(
-            deployment_id, "success", expected_mender_clients
-        )
+        with timeline.phase("success"):
+            deploy.check_expected_statistics(
+                deployment_id, "success", expected_mender_clients
+            )
 
         for d in devauth.get_devices():
             deploy.get_logs(d["id"], deployment_id, expected_status=404)
 
     assert device.yocto_id_installed_on_machine() == expected_image_id
 
-    deploy.check_expected_status("finished", deployment_id)
+    with timeline.phase("finished"):
+        deploy.check_expected_status("finished", deployment_id)
+    timeline.add_deployment(deploy, deployment_id)
+    timeline.add_reboots(reboot)
+    timeline.report()
 
     # make sure backend recognizes signed and unsigned images
     artifact_name = deploy.get_deployment(deployment_id)["artifacts"][0]
@@ -192,10 +311,15 @@ def update_image_failed(
 
     original_image_id = device.yocto_id_installed_on_machine()
 
+    timeline = UpdateTimeline()
     previous_active_part = device.get_active_partition()
     with device.get_reboot_detector(host_ip) as reboot:
         deployment_id, _ = common_update_procedure(
-            install_image, make_artifact=make_artifact, devauth=devauth, deploy=deploy,
+            install_image,
+            make_artifact=make_artifact,
+            devauth=devauth,
+            deploy=deploy,
+            timeline=timeline,
         )
         # It will reboot twice. Once into the failed update, which the
         # bootloader will roll back, and therefore we will end up on the
@@ -205,19 +329,26 @@ def update_image_failed(
         # about where we would end up. However, with update modules we prefer to
         # be conservative, and reboot one more time after the rollback to make
         # *sure* we are in the correct partition.
-        reboot.verify_reboot_performed(number_of_reboots=expected_number_of_reboots)
+        with timeline.phase("reboot"):
+            reboot.verify_reboot_performed(number_of_reboots=expected_number_of_reboots)
+    timeline.add_reboots(reboot)
 
     with device.get_reboot_detector(host_ip) as reboot:
         assert device.get_active_partition() == previous_active_part
 
-        deploy.check_expected_statistics(
-            deployment_id, "failure", expected_mender_clients
-        )
+        with timeline.phase("failure"):
+            deploy.check_expected_statistics(
+                deployment_id, "failure", expected_mender_clients
+            )
 
         for d in devauth.get_devices():
             assert expected_log_message in deploy.get_logs(d["id"], deployment_id)
 
         assert device.yocto_id_installed_on_machine() == original_image_id
         reboot.verify_reboot_not_performed()
+    timeline.add_reboots(reboot)
 
-    deploy.check_expected_status("finished", deployment_id)
+    with timeline.phase("finished"):
+        deploy.check_expected_status("finished", deployment_id)
+    timeline.add_deployment(deploy, deployment_id)
+    timeline.report()
@@ -12,15 +12,17 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import json
 import uuid
 import time
 
 from .. import conftest
-from ..common_setup import enterprise_no_client
+from ..common_setup import enterprise_no_client, create_tenant
 from .common_update import update_image, common_update_procedure
-from ..MenderAPI import auth, devauth, logger, inv
+from ..MenderAPI import auth, authentication, devauth, logger, inv
 from .mendertesting import MenderTesting
 from testutils.common import new_tenant_client
+from testutils.infra.cli import CliTenantadm
 
 
 class TestMultiTenancyEnterprise(MenderTesting):
@@ -111,3 +113,32 @@ class TestMultiTenancyEnterprise(MenderTesting):
             update_image(
                 mender_device, host_ip, install_image=update_image_name,
             )
+
+    def test_snapshot_restore(self, enterprise_no_client):
+        """verify that restoring a snapshot of the backend data brings back
+        the tenants as they were when it was taken"""
+
+        env = enterprise_no_client
+        tenant = create_tenant(env)
+        env.snapshot("test-restore")
+        try:
+            uuidv4 = str(uuid.uuid4())
+            other = authentication.Authentication()
+            other.new_tenant(
+                "test.mender.io-" + uuidv4,
+                "some.user+" + uuidv4 + "@example.com",
+                "hunter2hunter2",
+            )
+            assert other._do_login(other.username, other.password).status_code == 200
+
+            env.restore("test-restore")
+        finally:
+            env.delete_snapshot("test-restore")
+
+        # the tenant created after the snapshot is gone, the one before is back
+        assert other._do_login(other.username, other.password).status_code == 401
+        assert (
+            env.auth._do_login(env.auth.username, env.auth.password).status_code == 200
+        )
+        restored = CliTenantadm(containers_namespace=env.name).get_tenant(tenant["id"])
+        assert json.loads(restored)["tenant_token"] == tenant["tenant_token"]
@@ -12,7 +12,6 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
-import shutil
 import os
 import time
 
@@ -39,6 +38,7 @@ from ..MenderAPI import (
     get_container_manager,
 )
 from .mendertesting import MenderTesting
+from testutils.util.image import copy_image
 
 
 class DeviceAuthFailover(DeviceAuthV2):
@@ -319,7 +319,7 @@ class TestBasicIntegrationOpenSource(BaseTestBasicIntegration):
         tmp_image = valid_image.split(".")[0] + "-failover-image.ext4"
         try:
             logger.info("Creating failover sample image.")
-            shutil.copy(valid_image, tmp_image)
+            copy_image(valid_image, tmp_image)
             conf = image.get_mender_conf(tmp_image)
 
             if conf is None:
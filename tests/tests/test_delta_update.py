@@ -0,0 +1,59 @@
+# Copyright 2022 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+import os
+import tempfile
+
+import pytest
+
+from testutils.util.image import copy_image, patch_image
+
+from ..common_setup import enterprise_one_rofs_client_bootstrapped
+from ..MenderAPI import DeviceAuthV2, Deployments
+from .common_delta import compare_full_and_delta_update
+from .mendertesting import MenderTesting
+
+
+class TestDeltaUpdateEnterprise(MenderTesting):
+    def test_full_and_delta_update(
+        self, enterprise_one_rofs_client_bootstrapped, valid_image_rofs_with_mender_conf
+    ):
+        """Compare a full and a delta update between two slightly different images"""
+        env = enterprise_one_rofs_client_bootstrapped
+        mender_device = env.device
+        devauth = DeviceAuthV2(env.auth)
+        deploy = Deployments(env.auth, devauth)
+
+        mender_conf = mender_device.run("cat /etc/mender/mender.conf")
+        image_from = valid_image_rofs_with_mender_conf(mender_conf)
+        if image_from is None:
+            pytest.skip("no R/O rootfs image available")
+
+        with tempfile.TemporaryDirectory() as d:
+            # the target image only differs by one new file
+            image_to = os.path.join(d, "delta-to.ext4")
+            copy_image(image_from, image_to)
+            patch_image(image_to, {"/etc/mender/delta-test": os.urandom(64 * 1024)})
+
+            report = compare_full_and_delta_update(
+                mender_device,
+                env.get_virtual_network_host_ip(),
+                image_from,
+                image_to,
+                devauth=devauth,
+                deploy=deploy,
+                output="delta-update-report.json",
+            )
+
+        assert report["delta"]["artifact_bytes"] < report["full"]["artifact_bytes"]
@@ -37,27 +37,55 @@ from ..MenderAPI import (
     logger,
 )
 from .common_connect import prepare_env_for_connect, wait_for_connect
-from .common import md5sum
 from .mendertesting import MenderTesting
 from testutils.infra.container_manager import factory
 from testutils.infra.device import MenderDevice
+from testutils.util import transfer
 
 
 container_factory = factory.get_factory()
 connect_service_name = "mender-connect"
 
 
-def download_file(path, devid, authtoken):
-    deviceconnect_url = (
-        "https://%s/api/management/v1/deviceconnect"
-        % get_container_manager().get_mender_gateway()
+def deviceconnect_url(devid, action):
+    return "https://%s/api/management/v1/deviceconnect/devices/%s/%s" % (
+        get_container_manager().get_mender_gateway(),
+        devid,
+        action,
     )
-    download_url = "%s/devices/%s/download" % (deviceconnect_url, devid)
-    download_url_with_path = download_url + "?path=" + urllib.parse.quote(path)
+
+
+def download_file(path, devid, authtoken, output=None):
+    """
+    Downloads the file at path from the device. If output is given, the
+    file is streamed into it, and the stats of the transfer are returned
+    along with the response.
+    """
+    download_url_with_path = (
+        deviceconnect_url(devid, "download") + "?path=" + urllib.parse.quote(path)
+    )
+    if output is not None:
+        return transfer.download(download_url_with_path, output, headers=authtoken)
     return requests.get(download_url_with_path, verify=False, headers=authtoken)
 
 
 def upload_file(path, file, devid, authtoken, mode="600", uid="0", gid="0"):
+    """Uploads file, a file object or the path of a local file to stream"""
+    upload_url = deviceconnect_url(devid, "upload")
+    if isinstance(file, str):
+        r, _ = transfer.upload(
+            "PUT",
+            upload_url,
+            [
+                ("path", path),
+                ("mode", mode),
+                ("uid", uid),
+                ("gid", gid),
+                ("file", (path, file, "application/octet-stream")),
+            ],
+            headers=authtoken,
+        )
+        return r
     files = (
         ("path", (None, path)),
         ("mode", (None, mode)),
@@ -65,11 +93,6 @@ def upload_file(path, file, devid, authtoken, mode="600", uid="0", gid="0"):
         ("gid", (None, gid)),
         ("file", (os.path.basename(path), file, "application/octet-stream"),),
     )
-    deviceconnect_url = (
-        "https://%s/api/management/v1/deviceconnect"
-        % get_container_manager().get_mender_gateway()
-    )
-    upload_url = "%s/devices/%s/upload" % (deviceconnect_url, devid)
     return requests.put(upload_url, verify=False, headers=authtoken, files=files)
 
 
@@ -138,9 +161,8 @@ class BaseTestFileTransfer(MenderTesting):
         try:
             # create a 40MB random file
             f = NamedTemporaryFile(delete=False)
-            for i in range(40 * 1024):
-                f.write(os.urandom(1024))
             f.close()
+            md5 = transfer.random_file(f.name, 40 * 1024 * 1024)
 
             # random uid and gid
             uid = random.randint(100, 200)
@@ -149,7 +171,7 @@ class BaseTestFileTransfer(MenderTesting):
             # upload the file
             r = upload_file(
                 "/tmp/random.bin",
-                open(f.name, "rb"),
+                f.name,
                 devid,
                 authtoken,
                 mode="600",
@@ -160,7 +182,8 @@ class BaseTestFileTransfer(MenderTesting):
 
             # download the file
             path = "/tmp/random.bin"
-            r = download_file(path, devid, authtoken)
+            filename_download = f.name + ".download"
+            r, stats = download_file(path, devid, authtoken, output=filename_download)
             assert r.status_code == 200, r.json()
             assert (
                 r.headers.get("Content-Disposition")
@@ -173,12 +196,8 @@ class BaseTestFileTransfer(MenderTesting):
             assert r.headers.get("X-Men-File-Path") == "/tmp/random.bin"
             assert r.headers.get("X-Men-File-Size") == str(40 * 1024 * 1024)
 
-            filename_download = f.name + ".download"
-            with open(filename_download, "wb") as fw:
-                fw.write(r.content)
-
             # verify the file is not corrupted
-            assert md5sum(filename_download) == md5sum(f.name)
+            assert stats["md5"] == md5
         finally:
             os.unlink(f.name)
             if os.path.isfile(f.name + ".download"):
@@ -228,10 +247,9 @@ class BaseTestFileTransfer(MenderTesting):
             "-- testcase: File Transfer limits: file outside chroot; upload forbidden"
         )
         f = NamedTemporaryFile(delete=False)
-        for i in range(40 * 1024):
-            f.write(os.urandom(1024))
         f.close()
-        r = upload_file("/usr/random.bin", open(f.name, "rb"), devid, authtoken,)
+        transfer.random_file(f.name, 40 * 1024 * 1024)
+        r = upload_file("/usr/random.bin", f.name, devid, authtoken,)
 
         assert r.status_code == 400, r.json()
         assert (
@@ -22,6 +22,7 @@ from ..common_setup import standard_setup_one_client_bootstrapped, enterprise_no
 from ..MenderAPI import authentication, get_container_manager, logger, DeviceAuthV2
 from .common_connect import prepare_env_for_connect, wait_for_connect
 from .common import md5sum
+from testutils.util.transfer import random_file
 from .mendertesting import MenderTesting
 
 
@@ -68,9 +69,8 @@ class BaseTestFileTransferCLI(MenderTesting):
         try:
             # create a 40MB random file
             f = NamedTemporaryFile(delete=False)
-            for i in range(40 * 1024):
-                f.write(os.urandom(1024))
             f.close()
+            random_file(f.name, 40 * 1024 * 1024)
 
             logger.info("created a 40MB random file: " + f.name)
 
@@ -12,7 +12,9 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import asyncio
 import json
+import os
 import pytest
 import time
 import uuid
@@ -34,6 +36,7 @@ from ..MenderAPI import (
     Authentication,
     DeviceConnect,
     get_container_manager,
+    logger,
 )
 from testutils.common import User, update_tenant
 from .common_connect import wait_for_connect
@@ -54,7 +57,7 @@ class _TestRemoteTerminalBase:
 
             # Drain any initial output from the prompt. It should end in either "# "
             # (root) or "$ " (user).
-            output = shell.recvOutput()
+            output = shell.recvOutput(timeout=10, until=proto_shell.promptReceived)
             assert shell.protomsg.props["status"] == protomsg.PROP_STATUS_NORMAL
             assert output[-2:].decode() in [
                 "# ",
@@ -75,7 +78,7 @@ class _TestRemoteTerminalBase:
 
             # Test if a simple command works.
             shell.sendInput("ls /\n".encode())
-            output = shell.recvOutput()
+            output = shell.recvOutput(timeout=10, until=proto_shell.promptReceived)
             assert shell.protomsg.props["status"] == protomsg.PROP_STATUS_NORMAL
             output = output.decode()
             assert "usr" in output
@@ -93,7 +96,7 @@ class _TestRemoteTerminalBase:
 
             # Make sure we can not send anything to the shell.
             shell.sendInput("ls /\n".encode())
-            output = shell.recvOutput()
+            output = shell.recvOutput(until=b"session not found")
             assert shell.protomsg.props["status"] == protomsg.PROP_STATUS_ERROR
             output = output.decode()
             assert "usr" not in output
@@ -106,7 +109,7 @@ class _TestRemoteTerminalBase:
 
             # Drain any initial output from the prompt. It should end in either "# "
             # (root) or "$ " (user).
-            output = shell.recvOutput()
+            output = shell.recvOutput(timeout=10, until=proto_shell.promptReceived)
             assert shell.protomsg.props["status"] == protomsg.PROP_STATUS_NORMAL
             assert output[-2:].decode() in [
                 "# ",
@@ -182,17 +185,21 @@ class _TestRemoteTerminalBase:
     def test_session_recording(self, docker_env):
         self.assert_env(docker_env)
 
-        def get_cmd(ws, timeout=1):
+        def get_cmd(ws, timeout=1, until=None):
             pmsg = protomsg.ProtoMsg(proto_shell.PROTO_TYPE_SHELL)
-            body = b""
+            body = bytearray()
             try:
-                while True:
+                while until is None or not until(body):
                     msg = ws.recv(timeout)
                     b = pmsg.decode(msg)
                     if pmsg.typ == proto_shell.MSG_TYPE_SHELL_COMMAND:
                         body += b
             except TimeoutError:
-                return body
+                pass
+            return bytes(body)
+
+        def get_cmd_output(ws):
+            return get_cmd(ws, timeout=10, until=proto_shell.promptReceived)
 
         session_id = ""
         session_bytes = b""
@@ -206,21 +213,25 @@ class _TestRemoteTerminalBase:
             assert shell.sid is not None
             session_id = shell.sid
 
+            # Drain the initial prompt, so that the output of every command
+            # ends with exactly one prompt.
+            session_bytes += get_cmd_output(ws)
+
             """ Record a series of commands """
             shell.sendInput("echo 'now you see me'\n".encode())
-            session_bytes += get_cmd(ws)
+            session_bytes += get_cmd_output(ws)
             # Disable echo
             shell.sendInput("stty -echo\n".encode())
-            session_bytes += get_cmd(ws)
+            session_bytes += get_cmd_output(ws)
             shell.sendInput('echo "now you don\'t" > /dev/null\n'.encode())
-            session_bytes += get_cmd(ws)
+            session_bytes += get_cmd_output(ws)
             shell.sendInput("# Invisible comment\n".encode())
-            session_bytes += get_cmd(ws)
+            session_bytes += get_cmd_output(ws)
             # Turn echo back on
             shell.sendInput("stty echo\n".encode())
-            session_bytes += get_cmd(ws)
+            session_bytes += get_cmd_output(ws)
             shell.sendInput("echo 'and now echo is back on'\n".encode())
-            session_bytes += get_cmd(ws)
+            session_bytes += get_cmd_output(ws)
 
             body = shell.stopShell()
             assert shell.protomsg.props["status"] == protomsg.PROP_STATUS_NORMAL
@@ -229,10 +240,20 @@ class _TestRemoteTerminalBase:
         # Sleep for a second to make sure the session log propagate to the DB.
         time.sleep(1)
 
-        playback_bytes = b""
-        with docker_env.devconnect.get_playback_websocket(session_id, sleep_ms=0) as ws:
-            playback_bytes = get_cmd(ws)
+        playback = docker_env.devconnect.get_playback(session_id)
+        playback_bytes = playback.output
+        logger.info(
+            "played back %d bytes, %d frames, recorded over %.1fs in %.1fs"
+            % (
+                playback.bytes,
+                len(playback.frames),
+                playback.duration,
+                playback.elapsed,
+            )
+        )
 
+        # the whole recording, up to its stop message, matches the session
+        assert playback.complete
         assert playback_bytes == session_bytes
 
         assert b"now you see me" in playback_bytes
@@ -284,6 +305,35 @@ class TestRemoteTerminal(
         env.devconnect = devconnect
         yield env
 
+    def test_session_manager(self, docker_env, tmpdir):
+        """Runs shells, file transfers and port forwards in concurrent sessions"""
+        devid = devauth.get_devices()[0]["id"]
+
+        async def workload(session):
+            await session.start_shell()
+            output = await session.run_command("echo hello-$((20 + 22))")
+            assert b"hello-42" in output
+            await session.stop_shell()
+
+            stats = await session.download(
+                "/etc/mender/mender.conf",
+                os.path.join(str(tmpdir), "mender.conf-%s" % uuid.uuid4()),
+            )
+            assert stats["bytes"] > 0
+
+            async with session.port_forward([(0, "127.0.0.1", 22)]) as pf:
+                reader, writer = await asyncio.open_connection("127.0.0.1", pf.ports[0])
+                banner = await asyncio.wait_for(reader.readline(), 30)
+                writer.close()
+            assert banner.startswith(b"SSH-")
+
+        report = docker_env.devconnect.get_session_manager().run(
+            [devid], workload, per_device=3
+        )
+        assert report["errors"] == 0
+        assert report["transfers"] == 3
+        assert report["latency_p95"] is not None
+
 
 class TestRemoteTerminal_1_0(_TestRemoteTerminalBase):
     """
@@ -15,7 +15,6 @@
 import os
 import pytest
 import shutil
-import subprocess
 import tempfile
 
 from .. import conftest
@@ -31,6 +30,7 @@ from ..MenderAPI import DeviceAuthV2, Deployments
 from .mendertesting import MenderTesting
 from ..helpers import Helpers
 from testutils.infra.device import MenderDeviceGroup
+from testutils.util.image import copy_image, patch_image
 
 
 @pytest.fixture(scope="function")
@@ -48,40 +48,14 @@ def image_with_mender_conf_and_mender_gateway_conf(request):
 
 
 def add_mender_conf_and_mender_gateway_conf(d, image, mender_conf, mender_gateway_conf):
-    mender_conf_tmp = os.path.join(d, "mender.conf")
-    with open(mender_conf_tmp, "w") as f:
-        f.write(mender_conf)
-    mender_gateway_conf_tmp = os.path.join(d, "mender-gateway.conf")
-    with open(mender_gateway_conf_tmp, "w") as f:
-        f.write(mender_gateway_conf)
     new_image = os.path.join(d, image)
-    shutil.copy(image, new_image)
-    instr_file = os.path.join(d, "write.instr")
-    with open(os.path.join(d, "write.instr"), "w") as f:
-        f.write(
-            """cd /etc/mender
-        rm mender.conf
-        rm mender-gateway.conf
-        write {local1} mender.conf
-        write {local2} mender-gateway.conf
-        """.format(
-                local1=mender_conf_tmp, local2=mender_gateway_conf_tmp,
-            )
-        )
-    subprocess.run(
-        ["debugfs", "-w", "-f", instr_file, new_image],
-        check=True,
-        stdout=subprocess.PIPE,
-    )
-    subprocess.run(
-        ["debugfs", "-R", "cat /etc/mender/mender.conf", new_image],
-        check=True,
-        stdout=subprocess.PIPE,
-    )
-    subprocess.run(
-        ["debugfs", "-R", "cat /etc/mender/mender-gateway.conf", new_image],
-        check=True,
-        stdout=subprocess.PIPE,
+    copy_image(image, new_image)
+    patch_image(
+        new_image,
+        {
+            "/etc/mender/mender.conf": mender_conf,
+            "/etc/mender/mender-gateway.conf": mender_gateway_conf,
+        },
     )
     return new_image
 
@@ -14,6 +14,7 @@
 #
 
 import os
+import socket
 import subprocess
 import time
 
@@ -24,10 +25,51 @@ from DNS import DnsRequest
 
 from ..common_setup import standard_setup_one_client_bootstrapped, enterprise_no_client
 from .common_connect import prepare_env_for_connect
-from ..MenderAPI import authentication, devauth, get_container_manager, logger
+from ..MenderAPI import (
+    authentication,
+    devauth,
+    get_container_manager,
+    logger,
+    DeviceConnect,
+)
 from .common_connect import wait_for_connect
 from .common import md5sum
 from .mendertesting import MenderTesting
+from testutils.util.transfer import random_file
+
+
+def wait_for_port(port, timeout=60):
+    """Waits until the local TCP port accepts connections"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("localhost", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def scp(port, src, dst):
+    p = subprocess.Popen(
+        [
+            "scp",
+            "-o",
+            "StrictHostKeyChecking=no",
+            "-o",
+            "UserKnownHostsFile=/dev/null",
+            "-P",
+            str(port),
+            src,
+            dst,
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    stdout, stderr = p.communicate()
+    exit_code = p.wait()
+    assert exit_code == 0, (stdout, stderr)
 
 
 class BaseTestPortForward(MenderTesting):
@@ -85,9 +127,8 @@ class BaseTestPortForward(MenderTesting):
         )
         pfw.start()
 
-        # wait a few seconds to let the port-forward start
-        logger.info("port-forward started, waiting a few seconds")
-        time.sleep(10)
+        logger.info("port-forward started, waiting for it to listen")
+        wait_for_port(9922)
 
         # verify the UDP port-forward querying the Google's DNS server
         logger.info("resolve mender.io (A record)")
@@ -104,53 +145,18 @@ class BaseTestPortForward(MenderTesting):
         try:
             # create a 40MB random file
             f = NamedTemporaryFile(delete=False)
-            for i in range(40 * 1024):
-                f.write(os.urandom(1024))
             f.close()
+            random_file(f.name, 40 * 1024 * 1024)
 
             logger.info("created a 40MB random file: " + f.name)
 
             # upload the file using scp
             logger.info("uploading the file to the device using scp")
-            p = subprocess.Popen(
-                [
-                    "scp",
-                    "-o",
-                    "StrictHostKeyChecking=no",
-                    "-o",
-                    "UserKnownHostsFile=/dev/null",
-                    "-P",
-                    "9922",
-                    f.name,
-                    "root@localhost:/tmp/random.bin",
-                ],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            stdout, stderr = p.communicate()
-            exit_code = p.wait()
-            assert exit_code == 0, (stdout, stderr)
+            scp(9922, f.name, "root@localhost:/tmp/random.bin")
 
             # download the file using scp
             logger.info("download the file from the device using scp")
-            p = subprocess.Popen(
-                [
-                    "scp",
-                    "-o",
-                    "StrictHostKeyChecking=no",
-                    "-o",
-                    "UserKnownHostsFile=/dev/null",
-                    "-P",
-                    "9922",
-                    "root@localhost:/tmp/random.bin",
-                    f.name + ".download",
-                ],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            stdout, stderr = p.communicate()
-            exit_code = p.wait()
-            assert exit_code == 0, (stdout, stderr)
+            scp(9922, "root@localhost:/tmp/random.bin", f.name + ".download")
 
             # assert the files are not corrupted
             logger.info("checking the checksums of the uploaded and downloaded files")
@@ -163,6 +169,38 @@ class BaseTestPortForward(MenderTesting):
         # stop the port-forwarding
         pfw.kill()
 
+    def do_test_portforward_client(self, auth, devid):
+        """Forwards a local port to ssh on the device with PortForward"""
+        wait_for_connect(auth, devid)
+
+        f = NamedTemporaryFile(delete=False)
+        f.close()
+        try:
+            md5 = random_file(f.name, 40 * 1024 * 1024)
+            devconnect = DeviceConnect(auth, devauth)
+            with devconnect.get_port_forward(devid, [(0, "127.0.0.1", 22)]) as pf:
+                port = pf.ports[0]
+                started = time.monotonic()
+                scp(port, f.name, "root@localhost:/tmp/random.bin")
+                scp(port, "root@localhost:/tmp/random.bin", f.name + ".download")
+                duration = time.monotonic() - started
+                stats = pf.stats()
+
+            logger.info(
+                "port forward: %d bytes sent, %d received in %.1fs (%.1f MB/s)"
+                % (
+                    stats["bytes_sent"],
+                    stats["bytes_received"],
+                    duration,
+                    (stats["bytes_sent"] + stats["bytes_received"]) / duration / 1e6,
+                )
+            )
+            assert md5sum(f.name + ".download") == md5
+        finally:
+            os.unlink(f.name)
+            if os.path.isfile(f.name + ".download"):
+                os.unlink(f.name + ".download")
+
 
 class TestPortForwardOpenSource(BaseTestPortForward):
     def test_portforward(self, standard_setup_one_client_bootstrapped):
@@ -176,6 +214,13 @@ class TestPortForwardOpenSource(BaseTestPortForward):
         auth = authentication.Authentication()
         self.do_test_portforward(standard_setup_one_client_bootstrapped, auth, devid)
 
+    def test_portforward_client(self, standard_setup_one_client_bootstrapped):
+        devices = devauth.get_devices_status("accepted")
+        assert 1 == len(devices)
+        devid = devices[0]["id"]
+        auth = authentication.Authentication()
+        self.do_test_portforward_client(auth, devid)
+
 
 class TestPortForwardEnterprise(BaseTestPortForward):
     def test_portforward(self, enterprise_no_client):
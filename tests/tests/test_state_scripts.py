@@ -27,9 +27,11 @@ from ..common_setup import (
 )
 from .common_update import common_update_procedure
 from ..helpers import Helpers
-from ..MenderAPI import DeviceAuthV2, Deployments, logger, image
+from ..MenderAPI import DeviceAuthV2, Deployments, logger, image, artifacts
 from .mendertesting import MenderTesting
 from testutils.infra.device import MenderDeviceGroup
+from testutils.util.artifact import ArtifactReader
+from testutils.util.artifact_cache import ArtifactCache
 
 
 @pytest.fixture(scope="class")
@@ -987,3 +989,51 @@ class TestStateScriptsEnterprise(BaseTestStateScripts):
             description,
             test_set,
         )
+
+
+class TestStateScriptsArtifactCache:
+    def test_scripts_directory(self, tmpdir, monkeypatch):
+        """Artifacts with a directory of scripts are cached by its contents"""
+        tmpdir = str(tmpdir)
+        scripts = os.path.join(tmpdir, "scripts")
+        os.mkdir(scripts)
+        script = os.path.join(scripts, "ArtifactInstall_Enter_00")
+        with open(script, "w") as fd:
+            fd.write("#!/bin/sh\ntrue\n")
+        os.chmod(script, 0o755)
+
+        cache = ArtifactCache(os.path.join(tmpdir, "cache"), 1024 * 1024 * 1024)
+        monkeypatch.setattr(artifacts, "cache", cache)
+
+        def make_artifact(artifact_name):
+            path = image.make_module_artifact(
+                "module-state-scripts-test",
+                conftest.machine_name,
+                artifact_name,
+                os.path.join(tmpdir, artifact_name + ".mender"),
+                scripts=[scripts],
+            )
+            with open(path, "rb") as fd:
+                assert ArtifactReader(fd).artifact_name == artifact_name
+
+        def entries():
+            return {e for e in os.listdir(cache.path) if e.endswith(".mender")}
+
+        make_artifact("scripts-dir-1")
+        cached = entries()
+        assert len(cached) == 1
+        # cache hit, renamed
+        make_artifact("scripts-dir-2")
+        assert entries() == cached
+
+        # the modes and contents of the scripts are part of the key
+        key = cache.key({}, [scripts])
+        os.chmod(script, 0o644)
+        assert cache.key({}, [scripts]) != key
+        os.chmod(script, 0o755)
+        assert cache.key({}, [scripts]) == key
+
+        with open(script, "a") as fd:
+            fd.write("echo changed\n")
+        make_artifact("scripts-dir-3")
+        assert len(entries()) == 2
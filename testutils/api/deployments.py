@@ -26,3 +26,7 @@ URL_DEPLOYMENTS_STATISTICS = "/deployments/{id}/statistics"
 URL_DEPLOYMENTS_ARTIFACTS = "/artifacts"
 URL_DEPLOYMENTS_ARTIFACTS_GET = "/artifacts/{id}"
 URL_DEPLOYMENTS_ARTIFACTS_GENERATE = "/artifacts/generate"
+URL_DEPLOYMENTS_ARTIFACTS_DIRECT_UPLOAD = "/artifacts/directupload"
+URL_DEPLOYMENTS_ARTIFACTS_DIRECT_UPLOAD_COMPLETE = (
+    "/artifacts/directupload/{id}/complete"
+)
@@ -0,0 +1,84 @@
+# Copyright 2022 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Reader of recorded sessions, as played back by deviceconnect: shell
+# messages, with "delay" messages standing for the idle time between them,
+# and a "stop" message at the end.
+
+import collections
+import time
+
+import websockets
+
+from . import protomsg, proto_shell
+
+MSG_TYPE_DELAY = "delay"
+PROP_DELAY_VALUE = "delay_value"
+
+# offset: recorded time of the frame from the start of the session (s)
+Frame = collections.namedtuple("Frame", ["offset", "typ", "data", "props"])
+
+
+class Playback:
+    def __init__(self, ws):
+        """:param ws: connected playback Websocket"""
+        self.ws = ws
+        self.frames = []
+        self.bytes = 0
+        self.duration = 0.0
+        self.elapsed = None
+        # whether the stop message at the end of the recording was received
+        self.complete = False
+
+    def iterFrames(self, timeout=5):
+        """
+        Yields the frames of the recording as they are received, until the
+        end of the playback, or until none is received for timeout seconds.
+        """
+        pmsg = protomsg.ProtoMsg(proto_shell.PROTO_TYPE_SHELL)
+        started = time.monotonic()
+        try:
+            while True:
+                try:
+                    msg = self.ws.recv(timeout)
+                except (TimeoutError, websockets.ConnectionClosed):
+                    return
+                self.bytes += len(msg)
+                body = pmsg.decode(msg)
+                if pmsg.typ == MSG_TYPE_DELAY:
+                    self.duration += (pmsg.props or {}).get(PROP_DELAY_VALUE, 0) / 1000
+                    continue
+                if pmsg.typ == proto_shell.MSG_TYPE_STOP_SHELL:
+                    self.complete = True
+                    return
+                frame = Frame(self.duration, pmsg.typ, body, pmsg.props)
+                self.frames.append(frame)
+                yield frame
+        finally:
+            self.elapsed = time.monotonic() - started
+
+    def read(self, timeout=5):
+        """Reads the whole recording, returns self"""
+        for _ in self.iterFrames(timeout):
+            pass
+        return self
+
+    @property
+    def output(self):
+        """The output of the shell over the whole recording"""
+        return b"".join(
+            frame.data
+            for frame in self.frames
+            if frame.typ == proto_shell.MSG_TYPE_SHELL_COMMAND
+        )
@@ -0,0 +1,237 @@
+# Copyright 2022 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Port forward client over a deviceconnect session, as `mender-cli
+# port-forward` does: every local TCP connection is a stream of the session,
+# identified by its connection_id, and every forwarded chunk is acknowledged
+# by the receiver. At most `window` chunks per stream are unacknowledged.
+
+import asyncio
+import functools
+import logging
+import time
+import uuid
+
+import msgpack
+import websockets
+
+from testutils.util.websockets import AsyncWebsocket, background_loop
+from . import protomsg
+
+logger = logging.getLogger("root")
+
+PROTO_TYPE_PORTFORWARD = 3
+
+MSG_TYPE_PORT_FORWARD_NEW = "new"
+MSG_TYPE_PORT_FORWARD_STOP = "stop"
+MSG_TYPE_PORT_FORWARD = "forward"
+MSG_TYPE_PORT_FORWARD_ACK = "ack"
+MSG_TYPE_ERROR = "error"
+
+PROP_CONNECTION_ID = "connection_id"
+
+
+class _Stream:
+    def __init__(self, reader, writer, window):
+        self.id = str(uuid.uuid4())
+        self.reader = reader
+        self.writer = writer
+        self.window = asyncio.Semaphore(window)
+        self.opened = asyncio.Event()
+        self.error = None
+        # chunks received from the device, None once it stopped the stream
+        self.incoming = asyncio.Queue()
+        self.started = time.monotonic()
+        self.open_latency = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.duration = None
+
+    def stats(self):
+        return {
+            "connection_id": self.id,
+            "error": self.error,
+            "open_latency": self.open_latency,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "duration": self.duration,
+        }
+
+
+class PortForward:
+    """
+    Forwards local TCP ports to hosts and ports reachable by a device. It is
+    ready, listening on the local ports, as soon as the session is connected.
+
+        with devconnect.get_port_forward(devid, [(0, "127.0.0.1", 22)]) as pf:
+            subprocess.check_call(["ssh", "-p", str(pf.ports[0]), ...])
+    """
+
+    def __init__(
+        self, url, headers, mappings, window=16, chunk_size=32 * 1024, timeout=30
+    ):
+        """
+        :param mappings:   list of (local port, remote host, remote port), a
+                           local port 0 picks any free port
+        :param window:     maximum number of unacknowledged chunks per stream
+        :param chunk_size: maximum size of the forwarded chunks
+        :param timeout:    time to wait for the device to open a stream
+        """
+        self.ws = AsyncWebsocket(url, headers, insecure=True)
+        self.mappings = mappings
+        self.window = window
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.sid = None
+        self.ports = []
+        self.streams = {}
+        self._msg = protomsg.ProtoMsg(PROTO_TYPE_PORTFORWARD)
+        self._servers = []
+        self._tasks = set()
+        self._reader = None
+
+    async def start(self):
+        await self.ws.connect()
+        self._reader = asyncio.ensure_future(self._read())
+        for local_port, host, port in self.mappings:
+            server = await asyncio.start_server(
+                functools.partial(self._accept, host, port), "127.0.0.1", local_port
+            )
+            self._servers.append(server)
+            self.ports.append(server.sockets[0].getsockname()[1])
+        logger.info(
+            "port forward ready: %s"
+            % ", ".join(
+                "%d -> %s:%d" % (local, host, port)
+                for local, (_, host, port) in zip(self.ports, self.mappings)
+            )
+        )
+        return self
+
+    async def stop(self):
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        for stream in self.streams.values():
+            stream.writer.close()
+        for task in list(self._tasks):
+            task.cancel()
+        await self.ws.close()
+        await self._reader
+
+    def __enter__(self):
+        asyncio.run_coroutine_threadsafe(self.start(), background_loop()).result()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        asyncio.run_coroutine_threadsafe(self.stop(), background_loop()).result()
+
+    async def _send(self, typ, stream, body=None):
+        self._msg.clear()
+        self._msg.setTyp(typ)
+        self._msg.setSid(self.sid)
+        self._msg.setProps({PROP_CONNECTION_ID: stream.id})
+        await self.ws.send(self._msg.encode(body))
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _accept(self, host, port, reader, writer):
+        stream = _Stream(reader, writer, self.window)
+        self.streams[stream.id] = stream
+        self._spawn(self._write(stream))
+        await self._send(
+            MSG_TYPE_PORT_FORWARD_NEW,
+            stream,
+            msgpack.packb(
+                {"protocol": "tcp", "remote_host": host, "remote_port": port}
+            ),
+        )
+        try:
+            await asyncio.wait_for(stream.opened.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            stream.error = "timeout opening the stream"
+        if stream.error is not None:
+            logger.error("port forward to %s:%d: %s" % (host, port, stream.error))
+            writer.close()
+            return
+
+        while True:
+            try:
+                data = await reader.read(self.chunk_size)
+            except ConnectionError:
+                break
+            if len(data) == 0 or stream.duration is not None:
+                break
+            await stream.window.acquire()
+            await self._send(MSG_TYPE_PORT_FORWARD, stream, data)
+            stream.bytes_sent += len(data)
+        if stream.duration is None:
+            await self._send(MSG_TYPE_PORT_FORWARD_STOP, stream)
+            stream.incoming.put_nowait(None)
+
+    async def _write(self, stream):
+        """Writes what the device sends to the local connection"""
+        while True:
+            data = await stream.incoming.get()
+            if data is None:
+                break
+            stream.writer.write(data)
+            await stream.writer.drain()
+            stream.bytes_received += len(data)
+            await self._send(MSG_TYPE_PORT_FORWARD_ACK, stream)
+        stream.duration = time.monotonic() - stream.started
+        stream.writer.close()
+
+    async def _read(self):
+        msg = protomsg.ProtoMsg(PROTO_TYPE_PORTFORWARD)
+        while True:
+            try:
+                data = await self.ws.ws.recv()
+            except websockets.ConnectionClosed:
+                return
+            try:
+                body = msg.decode(data)
+            except TypeError as e:
+                logger.error("port forward: unexpected message: %s" % e)
+                continue
+            self.sid = msg.sid
+            stream = self.streams.get((msg.props or {}).get(PROP_CONNECTION_ID))
+            if stream is None:
+                continue
+
+            if msg.typ == MSG_TYPE_PORT_FORWARD_NEW:
+                stream.open_latency = time.monotonic() - stream.started
+                stream.opened.set()
+            elif msg.typ == MSG_TYPE_PORT_FORWARD:
+                stream.incoming.put_nowait(body)
+            elif msg.typ == MSG_TYPE_PORT_FORWARD_ACK:
+                stream.window.release()
+            elif msg.typ == MSG_TYPE_PORT_FORWARD_STOP:
+                stream.incoming.put_nowait(None)
+            elif msg.typ == MSG_TYPE_ERROR:
+                stream.error = msg.body if body else "error"
+                stream.opened.set()
+                stream.incoming.put_nowait(None)
+
+    def stats(self):
+        """Returns the stats of every stream, and the total bytes forwarded"""
+        streams = [stream.stats() for stream in self.streams.values()]
+        return {
+            "streams": streams,
+            "bytes_sent": sum(s["bytes_sent"] for s in streams),
+            "bytes_received": sum(s["bytes_received"] for s in streams),
+        }
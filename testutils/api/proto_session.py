@@ -0,0 +1,374 @@
+# Copyright 2022 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Concurrent deviceconnect sessions, to load test deviceconnect with many
+# terminals, file transfers and port forwards at once. A Session stands for
+# the work of one user with a device:
+# - shells run over its management connection, a deviceconnect session with
+#   the session ID (sid) the server assigns to it, by which sessions are
+#   tracked,
+# - file transfers go through the deviceconnect download/upload endpoints,
+# - port forwards open their own connection, as `mender-cli port-forward`.
+# All the sessions run on a single event loop.
+
+import asyncio
+import contextlib
+import logging
+import time
+import urllib.parse
+import uuid
+
+from testutils.util import transfer
+from testutils.util.stats import percentile
+from testutils.util.websockets import AsyncWebsocket
+from . import deviceconnect, protomsg, proto_shell
+from .proto_portforward import PortForward
+
+logger = logging.getLogger("root")
+
+
+class Session:
+    def __init__(self, device_id, gateway, headers, connecting):
+        """
+        :param gateway:    address of the API gateway
+        :param headers:    headers (authorization) of the requests
+        :param connecting: semaphore bounding the connections being
+                           established at once
+        """
+        self.device_id = device_id
+        self.gateway = gateway
+        self.headers = headers
+        self.ws = AsyncWebsocket(
+            "wss://%s%s%s"
+            % (
+                gateway,
+                deviceconnect.URL_MGMT,
+                deviceconnect.URL_MGMT_CONNECT.format(id=device_id),
+            ),
+            headers,
+            insecure=True,
+        )
+        self.sid = None
+        self.latencies = []
+        self.transfers = []
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.started = None
+        self.ended = None
+        self.error = None
+        self._connecting = connecting
+
+    async def open(self):
+        self.started = time.monotonic()
+
+    async def close(self):
+        if self.ws.ws is not None:
+            await self.ws.close()
+        self.ended = time.monotonic()
+
+    async def _connect(self):
+        """Connects the management connection, on first use"""
+        if self.ws.ws is None:
+            async with self._connecting:
+                await self.ws.connect()
+
+    async def send(self, proto, typ, body=b"", props=None):
+        msg = protomsg.ProtoMsg(proto)
+        msg.setTyp(typ)
+        msg.setSid(self.sid)
+        msg.setProps(props)
+        data = msg.encode(body)
+        self.bytes_sent += len(data)
+        await self._connect()
+        await self.ws.send(data)
+
+    async def recv(self, proto, timeout=20):
+        """Receives the next message, returns it and its body"""
+        await self._connect()
+        data = await self.ws.recv(timeout)
+        self.bytes_received += len(data)
+        msg = protomsg.ProtoMsg(proto)
+        body = msg.decode(data)
+        if self.sid is None:
+            self.sid = msg.sid
+        elif msg.sid != self.sid:
+            raise ValueError(
+                "session %s received a message of session %s" % (self.sid, msg.sid)
+            )
+        return msg, body
+
+    async def request(self, proto, typ, body=b"", props=None, timeout=20):
+        """
+        Sends a message and waits for the reply of the same type, skipping
+        other messages, and records the round trip time.
+        :returns: the reply and its body
+        """
+        started = time.monotonic()
+        await self.send(proto, typ, body, props)
+        while True:
+            remaining = max(started + timeout - time.monotonic(), 0)
+            msg, reply = await self.recv(proto, remaining)
+            if msg.typ == typ:
+                self.latencies.append(time.monotonic() - started)
+                return msg, reply
+
+    async def start_shell(self):
+        msg, body = await self.request(
+            proto_shell.PROTO_TYPE_SHELL, proto_shell.MSG_TYPE_SPAWN_SHELL
+        )
+        if msg.props["status"] != protomsg.PROP_STATUS_NORMAL:
+            raise RuntimeError(
+                "failed to start shell on %s: %s" % (self.device_id, body)
+            )
+
+    async def stop_shell(self):
+        await self.request(
+            proto_shell.PROTO_TYPE_SHELL, proto_shell.MSG_TYPE_STOP_SHELL
+        )
+
+    async def run_command(self, command, timeout=20):
+        """
+        Runs command in the shell, and waits until it finished. The latency
+        recorded is the time until the first output (usually the echo).
+        :returns: the output of the shell, including the echo of the input
+        """
+        # printed in two halves, so that the echo of the input does not match
+        marker = uuid.uuid4().hex
+        sentinel = marker.encode()
+        line = "%s; printf '%%s%%s\\n' %s %s\n" % (command, marker[:16], marker[16:])
+
+        started = time.monotonic()
+        await self.send(
+            proto_shell.PROTO_TYPE_SHELL,
+            proto_shell.MSG_TYPE_SHELL_COMMAND,
+            line.encode(),
+        )
+        output = bytearray()
+        while sentinel not in output:
+            remaining = max(started + timeout - time.monotonic(), 0)
+            msg, body = await self.recv(proto_shell.PROTO_TYPE_SHELL, remaining)
+            if msg.typ != proto_shell.MSG_TYPE_SHELL_COMMAND:
+                continue
+            if len(output) == 0:
+                self.latencies.append(time.monotonic() - started)
+            output += body
+        return bytes(output)
+
+    def _url(self, path, **query):
+        url = "https://%s%s%s" % (
+            self.gateway,
+            deviceconnect.URL_MGMT,
+            path.format(id=self.device_id),
+        )
+        if query:
+            url += "?" + urllib.parse.urlencode(query)
+        return url
+
+    async def _transfer(self, func, *args, **kwargs):
+        """Runs the blocking transfer func in a thread, records its stats"""
+        r, stats = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: func(*args, **kwargs)
+        )
+        if stats is None or r.status_code >= 300:
+            raise RuntimeError(
+                "file transfer with %s failed: %d %s"
+                % (self.device_id, r.status_code, r.text)
+            )
+        self.transfers.append(stats)
+        return stats
+
+    async def download(self, path, output):
+        """
+        Downloads the file at path from the device into the file output.
+        :returns: the stats of the transfer, see transfer.download()
+        """
+        stats = await self._transfer(
+            transfer.download,
+            self._url(deviceconnect.URL_MGMT_FDOWNLOAD, path=path),
+            output,
+            headers=self.headers,
+        )
+        self.bytes_received += stats["bytes"]
+        return stats
+
+    async def upload(self, path, file, mode="600", uid="0", gid="0"):
+        """
+        Uploads the local file at path file to path on the device.
+        :returns: the stats of the transfer, see transfer.upload()
+        """
+        stats = await self._transfer(
+            transfer.upload,
+            "PUT",
+            self._url(deviceconnect.URL_MGMT_FUPLOAD),
+            [
+                ("path", path),
+                ("mode", mode),
+                ("uid", uid),
+                ("gid", gid),
+                ("file", (path, file, "application/octet-stream")),
+            ],
+            headers=self.headers,
+        )
+        self.bytes_sent += stats["bytes"]
+        return stats
+
+    @contextlib.asynccontextmanager
+    async def port_forward(self, mappings, **kwargs):
+        """
+        Forwards local ports to the device while in the context, see
+        PortForward for mappings and the other arguments. The time to open
+        every forwarded connection is recorded as a latency.
+        """
+        pf = PortForward(self.ws.url, self.headers, mappings, **kwargs)
+        async with self._connecting:
+            await pf.start()
+        try:
+            yield pf
+        finally:
+            await pf.stop()
+            stats = pf.stats()
+            self.bytes_sent += stats["bytes_sent"]
+            self.bytes_received += stats["bytes_received"]
+            self.latencies += [
+                s["open_latency"]
+                for s in stats["streams"]
+                if s["open_latency"] is not None
+            ]
+
+    def stats(self):
+        duration = (self.ended or time.monotonic()) - (self.started or time.monotonic())
+        return {
+            "device_id": self.device_id,
+            "sid": self.sid,
+            "error": self.error,
+            "duration": duration,
+            "requests": len(self.latencies),
+            "transfers": len(self.transfers),
+            "latency_mean": sum(self.latencies) / len(self.latencies)
+            if len(self.latencies) > 0
+            else None,
+            "latency_max": max(self.latencies) if len(self.latencies) > 0 else None,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "throughput": (self.bytes_sent + self.bytes_received) / duration
+            if duration > 0
+            else None,
+        }
+
+
+class SessionManager:
+    """
+    Runs a workload, a coroutine function taking a Session, concurrently in
+    sessions to many devices. Example, with 100 users of each device running
+    commands, downloading a file and forwarding a port:
+
+        async def workload(session):
+            await session.start_shell()
+            for _ in range(10):
+                await session.run_command("ls /")
+            await session.stop_shell()
+            await session.download("/etc/mender/mender.conf", output)
+            async with session.port_forward([(0, "127.0.0.1", 22)]) as pf:
+                ...
+
+        report = devconnect.get_session_manager().run(device_ids, workload, 100)
+    """
+
+    def __init__(self, gateway, headers, max_connecting=50):
+        """
+        :param gateway:        address of the API gateway
+        :param headers:        headers (authorization) of the requests
+        :param max_connecting: maximum number of connections being
+                               established at once
+        """
+        self.gateway = gateway
+        self.headers = headers
+        self.max_connecting = max_connecting
+        self.sessions = []
+
+    def session(self, sid):
+        """Returns the session with the given sid"""
+        for session in self.sessions:
+            if session.sid == sid:
+                return session
+        raise KeyError(sid)
+
+    async def _run_session(self, session, workload):
+        try:
+            await session.open()
+            try:
+                await workload(session)
+            finally:
+                await session.close()
+        except Exception as e:
+            logger.error(
+                "session %s to %s failed: %r" % (session.sid, session.device_id, e)
+            )
+            session.error = repr(e)
+
+    async def run_async(self, device_ids, workload, per_device=1):
+        connecting = asyncio.Semaphore(self.max_connecting)
+        sessions = [
+            Session(device_id, self.gateway, self.headers, connecting)
+            for device_id in device_ids
+            for _ in range(per_device)
+        ]
+        self.sessions += sessions
+        started = time.monotonic()
+        await asyncio.gather(
+            *(self._run_session(session, workload) for session in sessions)
+        )
+        return self.report(sessions, time.monotonic() - started)
+
+    def run(self, device_ids, workload, per_device=1):
+        """
+        Runs workload in per_device sessions to each of the devices.
+        :returns: the report, see report()
+        """
+        return asyncio.run(self.run_async(device_ids, workload, per_device))
+
+    def report(self, sessions=None, wall_time=None):
+        """
+        :returns: dict with the stats of every session, by sid, and the
+                  latency percentiles and aggregate throughput of all of them
+        """
+        if sessions is None:
+            sessions = self.sessions
+        latencies = [latency for s in sessions for latency in s.latencies]
+        total = sum(s.bytes_sent + s.bytes_received for s in sessions)
+        report = {
+            "sessions": {
+                s.sid or "unknown-%d" % i: s.stats() for i, s in enumerate(sessions)
+            },
+            "errors": len([s for s in sessions if s.error is not None]),
+            "requests": len(latencies),
+            "bytes": total,
+            "transfers": sum(len(s.transfers) for s in sessions),
+            "wall_time": wall_time,
+        }
+        for p in (50, 95, 99):
+            report["latency_p%d" % p] = percentile(latencies, p)
+        if wall_time:
+            report["throughput"] = total / wall_time
+        logger.info(
+            "%d deviceconnect sessions, %d errors: %d requests, p95 latency %s, %d bytes"
+            % (
+                len(sessions),
+                report["errors"],
+                report["requests"],
+                report["latency_p95"],
+                total,
+            )
+        )
+        return report
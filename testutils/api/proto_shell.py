@@ -22,6 +22,14 @@ MSG_TYPE_STOP_SHELL = "stop"
 
 MSG_BODY_SHELL_STARTED = b"Shell started"
 
+# The shell prompt ends in either "# " (root) or "$ " (user).
+PROMPTS = (b"# ", b"$ ")
+
+
+def promptReceived(output):
+    """Tells whether output ends with a shell prompt"""
+    return bytes(output[-2:]) in PROMPTS
+
 
 class ProtoShell:
     def __init__(self, ws):
@@ -52,19 +60,42 @@ class ProtoShell:
         msg = self.protomsg.encode(data)
         self.ws.send(msg)
 
-    def recvOutput(self, timeout=1):
-        body = b""
-        try:
-            while True:
+    def iterOutput(self, timeout=1):
+        """
+        Yields the output of the shell as it is received, until none is
+        received for timeout seconds.
+        """
+        while True:
+            try:
                 msg = self.ws.recv(timeout)
-                body += self.protomsg.decode(msg)
-                assert self.protomsg.protoType == PROTO_TYPE_SHELL
-                assert (
-                    self.protomsg.typ == MSG_TYPE_SHELL_COMMAND
-                ), "Did not receive shell output."
-        except TimeoutError:
-            return body
-        raise RuntimeError("Should never get here")
+            except TimeoutError:
+                return
+            body = self.protomsg.decode(msg)
+            assert self.protomsg.protoType == PROTO_TYPE_SHELL
+            assert (
+                self.protomsg.typ == MSG_TYPE_SHELL_COMMAND
+            ), "Did not receive shell output."
+            yield body
+
+    def recvOutput(self, timeout=1, until=None):
+        """
+        Receives the output of the shell until none is received for timeout
+        seconds or, if given, until it is complete.
+        :param until: bytes marking the end of the output (e.g. printed by
+                      the last command), or callable(output) telling whether
+                      it is complete, such as promptReceived.
+        """
+        output = bytearray()
+        for body in self.iterOutput(timeout):
+            output += body
+            if isinstance(until, bytes):
+                # only search the part which can contain a new match
+                start = max(len(output) - len(body) - len(until) + 1, 0)
+                if output.find(until, start) >= 0:
+                    break
+            elif until is not None and until(output):
+                break
+        return bytes(output)
 
     def stopShell(self):
         self.protomsg.clear()
@@ -23,10 +23,15 @@ except ModuleNotFoundError:
     print("Please run `python3 -m pip install msgpack`.")
     sys.exit(1)
 
+_NOT_DECODED = object()
+
 
 class ProtoMsg:
     def __init__(self, protoType):
         self.protoType = protoType
+        # reused for every message, instead of one packer per packb() call
+        self._packer = msgpack.Packer()
+        self._unpacker = None
 
         self.clearAll()
 
@@ -39,6 +44,8 @@ class ProtoMsg:
     def clearAll(self):
         self.clear()
         self.sid = None
+        self._body = b""
+        self._body_obj = _NOT_DECODED
 
     def setTyp(self, typ):
         self.typ = typ
@@ -60,25 +67,40 @@ class ProtoMsg:
             },
             "body": obj,
         }
-        return msgpack.packb(protomsg)
+        return self._packer.pack(protomsg)
 
     # Returns body, attributes can be fetched from the ProtoMsg object.
     def decode(self, buf):
-
-        obj = msgpack.unpackb(buf)
-        if type(obj.get("hdr")) is not dict:
+        return self._decoded(msgpack.unpackb(buf))
+
+    def decode_stream(self, data):
+        """
+        Feeds raw bytes, which may hold any number of messages or parts of
+        them, and yields the body of every message completed so far. The
+        attributes of the ProtoMsg object are those of the message yielded
+        last.
+        """
+        if self._unpacker is None:
+            self._unpacker = msgpack.Unpacker()
+        self._unpacker.feed(data)
+        for obj in self._unpacker:
+            yield self._decoded(obj)
+
+    def _decoded(self, obj):
+        if type(obj) is not dict or type(obj.get("hdr")) is not dict:
             raise TypeError("Malformed protomsg received.")
 
         hdr = obj["hdr"]
         if hdr.get("proto") != self.protoType:
             raise TypeError(
-                f'Decoded message is not the right type, expected {self.protoType}, got {obj.get("proto")}'
+                f'Decoded message is not the right type, expected {self.protoType}, got {hdr.get("proto")}'
             )
 
         self.typ = hdr.get("typ")
         self.sid = hdr.get("sid")
         self.props = hdr.get("props")
         self._body = obj.get("body", b"")
+        self._body_obj = _NOT_DECODED
 
         return obj.get("body")
 
@@ -86,6 +108,14 @@ class ProtoMsg:
     def body_raw(self) -> bytes:
         return self._body
 
+    @property
+    def body_view(self) -> memoryview:
+        """The raw body, to slice or write out without copying it"""
+        return memoryview(self._body or b"")
+
     @property
     def body(self) -> dict:
-        return msgpack.loads(self._body)
+        # decoded once per message, however many times it is accessed
+        if self._body_obj is _NOT_DECODED:
+            self._body_obj = msgpack.loads(self._body)
+        return self._body_obj
@@ -22,6 +22,9 @@ URL_MGMT_DEVICES_SEARCH = "/devices/search"
 
 REPORTING_DATA_PROPAGATION_SLEEP_TIME_SECS = 4.0
 
-ELASTICSEARCH_DELETE_URL = (
-    "http://mender-elasticsearch:9200/devices/_delete_by_query?conflicts=proceed"
+ELASTICSEARCH_HOST = "mender-elasticsearch:9200"
+ELASTICSEARCH_DEVICES_INDEX = "devices"
+ELASTICSEARCH_DELETE_PATH = (
+    "/" + ELASTICSEARCH_DEVICES_INDEX + "/_delete_by_query?conflicts=proceed"
 )
+ELASTICSEARCH_DELETE_URL = "http://" + ELASTICSEARCH_HOST + ELASTICSEARCH_DELETE_PATH
@@ -0,0 +1,223 @@
+# Copyright 2022 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+"""Artifact download throughput benchmark.
+
+Simulated devices fetch artifacts concurrently through the same flow as the
+client: poll deployments/next, download the artifact from the (presigned)
+storage link, and report the deployment as successful. The storage backend
+is whatever the running setup uses (MinIO, S3, behind the storage-proxy or
+not): the results record the host of the storage links the artifacts were
+downloaded from. Example, from a backend test with a tenant user token:
+
+    results = run_download_benchmark(
+        user.utoken,
+        tenant.tenant_token,
+        sizes=(1024 * 1024, 64 * 1024 * 1024),
+        concurrency=(1, 8, 32),
+        output="download-benchmark.json",
+    )
+"""
+
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+
+import testutils.api.deviceauth as deviceauth
+import testutils.api.deployments as deployments
+from testutils.api.client import ApiClient
+from testutils.common import get_mender_artifact, make_accepted_device
+from testutils.util.multipart import MultipartEncoder
+from testutils.util.stats import summary
+
+logger = logging.getLogger("root")
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadBenchmark:
+    def __init__(self, utoken, tenant_token="", device_type="benchmark"):
+        """
+        :param utoken:       token of the user (of the tenant) deploying
+        :param tenant_token: tenant token of the simulated devices
+        :param device_type:  device type of the devices and artifacts
+        """
+        self.utoken = utoken
+        self.tenant_token = tenant_token
+        self.device_type = device_type
+        self.devices = []
+
+    def add_devices(self, count):
+        """Makes sure count accepted devices are available"""
+        devauthd = ApiClient(deviceauth.URL_DEVICES)
+        devauthm = ApiClient(deviceauth.URL_MGMT)
+        while len(self.devices) < count:
+            self.devices.append(
+                make_accepted_device(devauthd, devauthm, self.utoken, self.tenant_token)
+            )
+
+    def upload_artifact(self, size):
+        """Uploads an artifact with a payload of size bytes, returns its name"""
+        artifact_name = "benchmark-%d-%s" % (size, uuid.uuid4())
+        with get_mender_artifact(
+            artifact_name=artifact_name, device_types=(self.device_type,), size=size
+        ) as artifact:
+            body = MultipartEncoder(
+                [
+                    ("description", "download benchmark"),
+                    ("size", str(os.path.getsize(artifact))),
+                    ("artifact", (artifact, artifact, "application/octet-stream")),
+                ]
+            )
+            with body:
+                api_client = ApiClient(deployments.URL_MGMT)
+                api_client.headers = {}
+                r = api_client.with_auth(self.utoken).call(
+                    "POST",
+                    deployments.URL_DEPLOYMENTS_ARTIFACTS,
+                    data=body,
+                    headers={"Content-Type": body.content_type},
+                )
+        assert r.status_code == 201, r.text
+        return artifact_name
+
+    def deploy(self, artifact_name, devices):
+        api_client = ApiClient(deployments.URL_MGMT)
+        r = api_client.with_auth(self.utoken).call(
+            "POST",
+            deployments.URL_DEPLOYMENTS,
+            body={
+                "name": artifact_name,
+                "artifact_name": artifact_name,
+                "devices": [device.id for device in devices],
+            },
+        )
+        assert r.status_code == 201, r.text
+
+    def download(self, device):
+        """
+        Runs the deployment flow of one device.
+        :returns: dict with the downloaded bytes, time to first byte and
+                  duration of the download (s), or the error.
+        """
+        api_client = ApiClient(deployments.URL_DEVICES)
+        api_client.with_auth(device.token)
+        r = api_client.call(
+            "GET",
+            deployments.URL_NEXT,
+            qs_params={"artifact_name": "benchmark", "device_type": self.device_type},
+        )
+        if r.status_code != 200:
+            return {"error": "next returned %d" % r.status_code}
+        deployment = r.json()
+
+        uri = deployment["artifact"]["source"]["uri"]
+        started = time.monotonic()
+        ttfb = None
+        downloaded = 0
+        with requests.get(uri, verify=False, stream=True) as r:
+            if r.status_code != 200:
+                return {"error": "download returned %d" % r.status_code}
+            for chunk in r.iter_content(_CHUNK_SIZE):
+                if ttfb is None:
+                    ttfb = time.monotonic() - started
+                downloaded += len(chunk)
+        duration = time.monotonic() - started
+
+        api_client.call(
+            "PUT",
+            deployments.URL_STATUS.format(id=deployment["id"]),
+            body={"status": "success"},
+        )
+        return {
+            "bytes": downloaded,
+            "ttfb": ttfb,
+            "duration": duration,
+            "storage": urlparse(uri).netloc,
+        }
+
+    def run(self, size, concurrency):
+        """Downloads an artifact of size bytes by concurrency devices at once"""
+        self.add_devices(concurrency)
+        devices = self.devices[:concurrency]
+        artifact_name = self.upload_artifact(size)
+        self.deploy(artifact_name, devices)
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            downloads = list(executor.map(self.download, devices))
+        wall_time = time.monotonic() - started
+
+        errors = [d["error"] for d in downloads if "error" in d]
+        done = [d for d in downloads if "error" not in d]
+        total = sum(d["bytes"] for d in done)
+        result = {
+            "artifact_size": size,
+            "concurrency": concurrency,
+            "storage": sorted(set(d["storage"] for d in done)),
+            "downloads": len(done),
+            "errors": errors,
+            "bytes": total,
+            "wall_time": wall_time,
+            "aggregate_mbps": total / wall_time / 1e6 if wall_time > 0 else None,
+            "device_mbps": summary(
+                [d["bytes"] / d["duration"] / 1e6 for d in done if d["duration"] > 0]
+            ),
+            "ttfb": summary([d["ttfb"] for d in done if d["ttfb"] is not None]),
+            "duration": summary([d["duration"] for d in done]),
+        }
+        logger.info(
+            "download benchmark: %d bytes x %d devices: %.1f MB/s aggregate, "
+            "p99 duration %.2fs, %d errors"
+            % (
+                size,
+                concurrency,
+                result["aggregate_mbps"] or 0,
+                result["duration"]["p99"] or 0,
+                len(errors),
+            )
+        )
+        return result
+
+
+def run_download_benchmark(
+    utoken,
+    tenant_token="",
+    sizes=(1024 * 1024,),
+    concurrency=(1, 4, 16),
+    storage=None,
+    output=None,
+):
+    """
+    Benchmarks artifact downloads for every combination of artifact size
+    (bytes) and concurrency (number of devices downloading at once).
+    :param storage: name of the storage backend recorded in the results, by
+                    default the hosts of the storage links
+    :param output:  path of the file the results are written to, as JSON
+    :returns: the results
+    """
+    benchmark = DownloadBenchmark(utoken, tenant_token)
+    results = [benchmark.run(size, n) for size in sizes for n in concurrency]
+    if storage is None:
+        storage = ", ".join(sorted(set(h for r in results for h in r["storage"])))
+    results = {"storage": storage, "results": results}
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
@@ -20,10 +20,10 @@ import tempfile
 import uuid
 import os
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 
 import docker
-import redo
 import requests
 
 import testutils.api.deviceauth as deviceauth
@@ -32,6 +32,7 @@ import testutils.api.reporting as reporting
 import testutils.api.tenantadm as tenantadm
 import testutils.api.useradm as useradm
 import testutils.util.crypto
+from testutils.util.artifact_cache import cache as artifact_cache
 from testutils.api.client import ApiClient, GATEWAY_HOSTNAME
 from testutils.infra.container_manager.kubernetes_manager import isK8S
 from testutils.infra.mongo import MongoClient
@@ -53,10 +54,12 @@ def clean_mongo(mongo):
     yield mongo.client
 
 
-def elasticsearch_cleanup():
+def elasticsearch_cleanup(host=reporting.ELASTICSEARCH_HOST):
     try:
         requests.post(
-            reporting.ELASTICSEARCH_DELETE_URL, json={"query": {"match_all": {}}}
+            "http://" + host + reporting.ELASTICSEARCH_DELETE_PATH,
+            json={"query": {"match_all": {}}},
+            timeout=60,
         )
     except requests.RequestException:
         pass
@@ -365,37 +368,46 @@ def get_mender_artifact(
     depends=(),
     provides=(),
 ):
-    data = "".join(random.choices(string.ascii_uppercase + string.digits, k=size))
-    f = tempfile.NamedTemporaryFile(delete=False)
-    f.write(data.encode("utf-8"))
-    f.close()
-    #
-    filename = f.name
-    artifact = "%s.mender" % filename
-    args = [
-        "mender-artifact",
-        "write",
-        "module-image",
-        "-o",
-        artifact,
-        "--artifact-name",
-        artifact_name,
-        "-T",
-        update_module,
-        "-f",
-        filename,
-    ]
-    for device_type in device_types:
-        args.extend(["-t", device_type])
-    for depend in depends:
-        args.extend(["--depends", depend])
-    for provide in provides:
-        args.extend(["--provides", provide])
+    artifact = os.path.join(tempfile.gettempdir(), "%s.mender" % uuid.uuid4())
+
+    def build(output):
+        data = "".join(random.choices(string.ascii_uppercase + string.digits, k=size))
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(data.encode("utf-8"))
+            f.flush()
+            args = [
+                "mender-artifact",
+                "write",
+                "module-image",
+                "-o",
+                output,
+                "--artifact-name",
+                artifact_name,
+                "-T",
+                update_module,
+                "-f",
+                f.name,
+            ]
+            for device_type in device_types:
+                args.extend(["-t", device_type])
+            for depend in depends:
+                args.extend(["--depends", depend])
+            for provide in provides:
+                args.extend(["--provides", provide])
+            subprocess.call(args)
+
+    # the payload is random data, only its size matters
+    inputs = {
+        "type": update_module,
+        "device_types": list(device_types),
+        "size": size,
+        "depends": list(depends),
+        "provides": list(provides),
+    }
     try:
-        subprocess.call(args)
+        artifact_cache.get(artifact, build, inputs, artifact_name=artifact_name)
         yield artifact
     finally:
-        os.unlink(filename)
         os.path.exists(artifact) and os.unlink(artifact)
 
 
@@ -403,9 +415,13 @@ def wait_until_healthy(compose_project: str = "", timeout: int = 60):
     """
     wait_until_healthy polls all running containers health check
     endpoints until they return a non-error status code.
+    All services are probed concurrently against a shared deadline, each
+    one reusing a single pooled connection for its probes.
     :param compose_project: the docker-compose project ID, if empty it
                             checks all running containers.
     :param timeout: timeout in seconds.
+    :return: dict mapping container names to the number of seconds it
+             took for them to become healthy.
     """
     client = docker.from_env()
     kwargs = {}
@@ -426,6 +442,7 @@ def wait_until_healthy(compose_project: str = "", timeout: int = 60):
         "minio": "/minio/health/live",
     }
 
+    probes = {}
     containers = client.containers.list(all=True, **kwargs)
     for container in containers:
 
@@ -447,18 +464,38 @@ def wait_until_healthy(compose_project: str = "", timeout: int = 60):
             continue
         port = 8080 if service != "minio" else 9000
 
-        for _ in redo.retrier(attempts=timeout, sleeptime=1):
-            try:
-                rsp = requests.request("GET", f"http://{container_ip}:{port}{path}")
-            except requests.exceptions.ConnectionError:
-                # A ConnectionError is expected if the service is not running yet
-                continue
-            if rsp.status_code < 300:
-                break
-        else:
-            raise TimeoutError(
-                f"Timed out waiting for service '{service}' to become healthy"
-            )
+        probes[container.name] = (service, f"http://{container_ip}:{port}{path}")
+
+    start = time.monotonic()
+    deadline = start + timeout
+
+    def probe(service, url):
+        with requests.Session() as session:
+            while True:
+                remaining = deadline - time.monotonic()
+                try:
+                    rsp = session.get(url, timeout=max(min(remaining, 5), 1))
+                    if rsp.status_code < 300:
+                        return time.monotonic() - start
+                except requests.exceptions.RequestException:
+                    # A ConnectionError is expected if the service is not running yet
+                    pass
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(
+                        f"Timed out waiting for service '{service}' to become healthy"
+                    )
+                time.sleep(min(1, remaining))
+
+    if len(probes) == 0:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=len(probes)) as executor:
+        futures = {
+            name: executor.submit(probe, service, url)
+            for name, (service, url) in probes.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
 
 
 def update_tenant(tid, addons=None, plan=None, container_manager=None):
@@ -37,6 +37,19 @@ class BaseContainerManagerNamespace:
         """Stops the running containers"""
         raise NotImplementedError
 
+    def reset(self):
+        """Brings an already set up namespace back to a clean state
+        without recreating the backend containers"""
+        raise NotImplementedError
+
+    def snapshot(self, name):
+        """Captures the backend data under the given name"""
+        raise NotImplementedError
+
+    def restore(self, name):
+        """Replaces the backend data with the given snapshot"""
+        raise NotImplementedError
+
     def execute(self, container_id, cmd):
         """Executes the given cmd on an specific container"""
         raise NotImplementedError
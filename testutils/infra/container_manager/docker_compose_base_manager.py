@@ -18,14 +18,39 @@ import subprocess
 import filelock
 import logging
 import copy
+import collections
+import contextlib
+import threading
 import redo
 
 from .docker_manager import DockerNamespace
 
 logger = logging.getLogger("root")
 
-# Global lock to synchronize calls to docker-compose
+# Global lock to synchronize the docker operations which conflict across
+# namespaces: network creation/removal and image pulls. The file lock
+# synchronizes processes (e.g. xdist workers), the thread lock synchronizes
+# threads of the same process, which would otherwise share the file lock.
 docker_lock = filelock.FileLock("docker_lock")
+_docker_thread_lock = threading.RLock()
+
+# Per namespace locks, operations on different namespaces run concurrently
+_namespace_locks = collections.defaultdict(threading.RLock)
+
+
+@contextlib.contextmanager
+def timed_lock(name, *locks):
+    """Acquires the given locks in order, reporting how long it waited"""
+    start = time.monotonic()
+    with contextlib.ExitStack() as stack:
+        for lock in locks:
+            stack.enter_context(lock)
+        waited = time.monotonic() - start
+        if waited >= 1:
+            logger.info("waited %.2fs for the %s lock" % (waited, name))
+        else:
+            logger.debug("waited %.2fs for the %s lock" % (waited, name))
+        yield waited
 
 
 class DockerComposeBaseNamespace(DockerNamespace):
@@ -37,6 +62,9 @@ class DockerComposeBaseNamespace(DockerNamespace):
     def __init__(self, name=None, extra_files=[]):
         DockerNamespace.__init__(self, name)
         self.extra_files = copy.copy(extra_files)
+        self._mender_gateway = None
+        # accumulated time spent waiting for docker locks
+        self.lock_wait_time = 0.0
 
     @property
     def docker_compose_files(self):
@@ -45,6 +73,10 @@ class DockerComposeBaseNamespace(DockerNamespace):
     def teardown(self):
         self._debug_log_containers_logs()
         self._stop_docker_compose()
+        logger.info(
+            "namespace %s waited %.2fs in total for docker locks"
+            % (self.name, self.lock_wait_time)
+        )
 
     def get_mender_clients(self, network="mender"):
         """Returns IP address(es) of mender-client container(s)"""
@@ -116,14 +148,21 @@ class DockerComposeBaseNamespace(DockerNamespace):
         """Returns IP address of mender-api-gateway service
         Has internal retry - upon setup 'up', the gateway
         will not be available for a while.
+
+        The address is cached on the namespace until refresh_mender_gateway()
+        is called (implicitly on setup, restart_service and teardown).
         """
+        if self._mender_gateway is not None:
+            return self._mender_gateway
+
         for _ in redo.retrier(attempts=10, sleeptime=1):
             gateway = self.get_ip_of_service("mender-api-gateway")
 
             if len(gateway) != 1:
                 continue
             else:
-                return gateway[0]
+                self._mender_gateway = gateway[0]
+                return self._mender_gateway
         else:
             assert (
                 False
@@ -131,8 +170,14 @@ class DockerComposeBaseNamespace(DockerNamespace):
                 len(gateway)
             )
 
+    def refresh_mender_gateway(self):
+        """Drops the cached mender-api-gateway address, so that the next
+        call to get_mender_gateway() resolves it again."""
+        self._mender_gateway = None
+
     def restart_service(self, service):
         """Restarts a service."""
+        self.refresh_mender_gateway()
         self._docker_compose_cmd("scale %s=0" % service)
         self._docker_compose_cmd("scale %s=1" % service)
 
@@ -140,14 +185,41 @@ class DockerComposeBaseNamespace(DockerNamespace):
         container_id = super().getid([container_name])
         return super().execute(container_id, ["cat", path])
 
+    @contextlib.contextmanager
+    def _locked(self, global_lock=False):
+        """Serializes operations on this namespace and, when global_lock is
+        set, also the ones which conflict with other namespaces."""
+        locks = [_namespace_locks[self.name]]
+        name = "namespace " + self.name
+        if global_lock:
+            locks += [_docker_thread_lock, docker_lock]
+            name = "global docker"
+        with timed_lock(name, *locks) as waited:
+            self.lock_wait_time += waited
+            yield
+
     def _debug_log_containers_logs(self):
         logs = self._docker_compose_cmd("logs --no-color")
         for line in logs.split("\n"):
             logger.debug(self._re_newlines_sub("", line))
 
-    def _docker_compose_cmd(self, arg_list, env=None):
+    def _docker_compose_up(self, arg_list="", env=None):
+        """Run docker-compose up -d with the given arguments
+
+        The images are pulled and the networks created by a first
+        `up --no-start`, which holds the global lock. Starting the containers
+        then only holds the namespace lock, so that namespaces are brought up
+        concurrently.
+        """
+        self._docker_compose_cmd("up --no-start " + arg_list, env, global_lock=True)
+        self._docker_compose_cmd("up -d " + arg_list, env)
+
+    def _docker_compose_cmd(self, arg_list, env=None, global_lock=False):
         """Run docker-compose command using self.docker_compose_files
 
+        global_lock must be set for the commands which may create networks or
+        pull images, which conflict with the other namespaces.
+
         It will retry a few times due to https://github.com/opencontainers/runc/issues/1326
         """
         files_args = "".join([" -f %s" % file for file in self.docker_compose_files])
@@ -161,7 +233,7 @@ class DockerComposeBaseNamespace(DockerNamespace):
             penv.update(env)
 
         for count in range(1, 6):
-            with docker_lock:
+            with self._locked(global_lock):
                 try:
                     return subprocess.check_output(
                         cmd, stderr=subprocess.STDOUT, shell=True, env=penv
@@ -180,11 +252,13 @@ class DockerComposeBaseNamespace(DockerNamespace):
         raise Exception("failed to start docker-compose (called: %s)" % cmd)
 
     def _stop_docker_compose(self):
-        with docker_lock:
+        self.refresh_mender_gateway()
+        with self._locked():
             # Take down all docker instances in this namespace.
             cmd = "docker ps -aq -f name=%s | xargs -r docker rm -fv" % self.name
             logger.info("running %s" % cmd)
             subprocess.check_call(cmd, shell=True)
+        with self._locked(global_lock=True):
             cmd = (
                 "docker network list -q -f name=%s | xargs -r docker network rm"
                 % self.name
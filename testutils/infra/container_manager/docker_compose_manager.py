@@ -15,12 +15,22 @@ import time
 import socket
 import subprocess
 import logging
-from testutils.common import wait_until_healthy
+import requests
+import testutils.api.reporting as reporting
+from testutils.common import (
+    wait_until_healthy,
+    elasticsearch_cleanup,
+    mongo_cleanup,
+)
+from testutils.infra.mongo import MongoClient, PRESERVED_DBS
 
-from .docker_compose_base_manager import DockerComposeBaseNamespace, docker_lock
+from .docker_compose_base_manager import DockerComposeBaseNamespace
 
 logger = logging.getLogger("root")
 
+# timeout (s) of the Elasticsearch requests of snapshot/restore
+ELASTICSEARCH_TIMEOUT = 60
+
 
 class DockerComposeNamespace(DockerComposeBaseNamespace):
     COMPOSE_FILES_PATH = DockerComposeBaseNamespace.COMPOSE_FILES_PATH
@@ -99,18 +109,111 @@ class DockerComposeNamespace(DockerComposeBaseNamespace):
     ]
 
     def setup(self):
-        self._docker_compose_cmd("up -d")
+        self._docker_compose_up()
         self._wait_for_containers()
 
+    # services whose containers are recreated from scratch on reset()
+    RESET_SERVICES_PREFIXES = ("mender-client", "mender-gateway")
+
+    def reset(self):
+        """Wipes the namespace for reuse by another test:
+        - removes the devices (mender-client/mender-gateway containers) and
+          all one-off containers, e.g. those created by new_tenant_client,
+        - drops the databases and the reporting index,
+        - runs setup() again, which re-provisions the devices while leaving
+          the already running backend containers untouched.
+        """
+        self.refresh_mender_gateway()
+        output = subprocess.check_output(
+            [
+                "docker",
+                "ps",
+                "-a",
+                "--filter=label=com.docker.compose.project=" + self.name,
+                '--format={{.ID}} {{.Label "com.docker.compose.service"}} '
+                '{{.Label "com.docker.compose.oneoff"}}',
+            ]
+        ).decode()
+        containers = []
+        for line in output.splitlines():
+            container_id, service, oneoff = (line.split() + ["", ""])[:3]
+            if oneoff == "True" or service.startswith(self.RESET_SERVICES_PREFIXES):
+                containers.append(container_id)
+        if len(containers) > 0:
+            with self._locked():
+                subprocess.check_call(["docker", "rm", "-fv"] + containers)
+
+        for ip in self.get_ip_of_service("mender-mongo"):
+            with MongoClient(ip + ":27017") as mongo:
+                mongo_cleanup(mongo)
+        for ip in self.get_ip_of_service("mender-elasticsearch"):
+            elasticsearch_cleanup(ip + ":9200")
+
+        self.setup()
+
+    def snapshot(self, name):
+        """Captures the backend data: the Mongo databases (except for the ones
+        preserved by cleanup) are dumped inside the mender-mongo container and
+        the reporting index, if any, is copied into a snapshot index.
+
+        Meant to be taken after an expensive setup (tenants, users, devices),
+        so that following tests can restore() it instead of redoing it.
+        """
+        mongo = self.getid(["mender-mongo"])
+        args = ["mongodump", "--quiet", "--gzip", "--archive=%s" % _archive(name)]
+        args += ["--nsExclude=%s.*" % db for db in PRESERVED_DBS]
+        self.execute(mongo, args)
+
+        for ip in self.get_ip_of_service("mender-elasticsearch"):
+            index = _snapshot_index(name)
+            requests.delete(
+                "http://%s:9200/%s" % (ip, index), timeout=ELASTICSEARCH_TIMEOUT
+            )
+            _es_reindex(ip, reporting.ELASTICSEARCH_DEVICES_INDEX, index)
+
+    def restore(self, name):
+        """Replaces the backend data with a snapshot taken with snapshot().
+        Databases created after the snapshot was taken are dropped.
+        """
+        for ip in self.get_ip_of_service("mender-mongo"):
+            with MongoClient(ip + ":27017") as mongo:
+                mongo_cleanup(mongo)
+        mongo = self.getid(["mender-mongo"])
+        self.execute(
+            mongo,
+            ["mongorestore", "--quiet", "--gzip", "--archive=%s" % _archive(name)],
+        )
+
+        for ip in self.get_ip_of_service("mender-elasticsearch"):
+            elasticsearch_cleanup(ip + ":9200")
+            _es_reindex(
+                ip, _snapshot_index(name), reporting.ELASTICSEARCH_DEVICES_INDEX
+            )
+
+    def delete_snapshot(self, name):
+        """Removes a snapshot taken with snapshot()"""
+        mongo = self.getid(["mender-mongo"])
+        self.execute(mongo, ["rm", "-f", _archive(name)])
+        for ip in self.get_ip_of_service("mender-elasticsearch"):
+            requests.delete(
+                "http://%s:9200/%s" % (ip, _snapshot_index(name)),
+                timeout=ELASTICSEARCH_TIMEOUT,
+            )
+
     def _wait_for_containers(self):
-        wait_until_healthy(self.name, timeout=60 * 5)
+        # containers may have been (re)created, forget the old gateway address
+        self.refresh_mender_gateway()
+        timeline = wait_until_healthy(self.name, timeout=60 * 5)
+        for container, elapsed in sorted(timeline.items(), key=lambda t: t[1]):
+            logger.info("%s healthy after %.2fs" % (container, elapsed))
 
     def teardown_exclude(self, exclude=[]):
         """
         Take down all docker instances in this namespace, except for 'exclude'd container names.
         'exclude' doesn't need exact names, it's a verbatim grep regex.
         """
-        with docker_lock:
+        self.refresh_mender_gateway()
+        with self._locked():
             cmd = "docker ps -aq -f name=%s  | xargs -r docker rm -fv" % self.name
 
             # exclude containers by crude grep -v and awk'ing out the id
@@ -127,8 +230,9 @@ class DockerComposeNamespace(DockerComposeBaseNamespace):
             logger.info("running %s" % cmd)
             subprocess.check_call(cmd, shell=True)
 
-            # if we're preserving some containers, don't destroy the network (will error out on exit)
-            if len(exclude) == 0:
+        # if we're preserving some containers, don't destroy the network (will error out on exit)
+        if len(exclude) == 0:
+            with self._locked(global_lock=True):
                 cmd = (
                     "docker network list -q -f name=%s | xargs -r docker network rm"
                     % self.name
@@ -137,6 +241,30 @@ class DockerComposeNamespace(DockerComposeBaseNamespace):
                 subprocess.check_call(cmd, shell=True)
 
 
+def _archive(snapshot):
+    return "/tmp/snapshot-%s.archive.gz" % snapshot
+
+
+def _snapshot_index(snapshot):
+    return "snapshot-%s-%s" % (snapshot.lower(), reporting.ELASTICSEARCH_DEVICES_INDEX)
+
+
+def _es_reindex(ip, source, dest):
+    """Bulk copies the documents of the source index into dest, a missing
+    source index (nothing indexed yet) is not an error"""
+    rsp = requests.head(
+        "http://%s:9200/%s" % (ip, source), timeout=ELASTICSEARCH_TIMEOUT
+    )
+    if rsp.status_code == 404:
+        return
+    rsp = requests.post(
+        "http://%s:9200/_reindex?refresh=true" % ip,
+        json={"source": {"index": source}, "dest": {"index": dest}},
+        timeout=ELASTICSEARCH_TIMEOUT,
+    )
+    assert rsp.status_code == 200, rsp.text
+
+
 class DockerComposeStandardSetup(DockerComposeNamespace):
     def __init__(self, name, num_clients=1):
         self.num_clients = num_clients
@@ -146,7 +274,7 @@ class DockerComposeStandardSetup(DockerComposeNamespace):
             DockerComposeNamespace.__init__(self, name, self.QEMU_CLIENT_FILES)
 
     def setup(self):
-        self._docker_compose_cmd("up -d --scale mender-client=%d" % self.num_clients)
+        self._docker_compose_up("--scale mender-client=%d" % self.num_clients)
         self._wait_for_containers()
 
 
@@ -161,7 +289,7 @@ class DockerComposeStandardSetupWithGateway(DockerComposeNamespace):
             )
 
     def setup(self):
-        self._docker_compose_cmd("up -d --scale mender-client=%d" % self.num_clients)
+        self._docker_compose_up("--scale mender-client=%d" % self.num_clients)
         self._wait_for_containers()
 
 
@@ -178,10 +306,10 @@ class DockerComposeMonitorCommercialSetup(DockerComposeNamespace):
             )
 
     def setup(self, recreate=True, env=None):
-        cmd = "up -d"
+        args = ""
         if not recreate:
-            cmd += " --no-recreate"
-        self._docker_compose_cmd(cmd, env=env)
+            args += " --no-recreate"
+        self._docker_compose_up(args, env=env)
         self._wait_for_containers()
 
     def new_tenant_client(self, name, tenant):
@@ -191,6 +319,7 @@ class DockerComposeMonitorCommercialSetup(DockerComposeNamespace):
         self._docker_compose_cmd(
             "run -d --name=%s_%s mender-client" % (self.name, name),
             env={"TENANT_TOKEN": "%s" % tenant},
+            global_lock=True,
         )
         time.sleep(45)
 
@@ -201,6 +330,7 @@ class DockerComposeMonitorCommercialSetup(DockerComposeNamespace):
         self._docker_compose_cmd(
             "run -d --name=%s_%s mender-client" % (self.name, name),
             env={"TENANT_TOKEN": "%s" % tenant},
+            global_lock=True,
         )
         time.sleep(5)
 
@@ -264,10 +394,10 @@ class DockerComposeEnterpriseSetup(DockerComposeNamespace):
             DockerComposeNamespace.__init__(self, name, self.ENTERPRISE_FILES)
 
     def setup(self, recreate=True, env=None):
-        cmd = "up -d"
+        args = ""
         if not recreate:
-            cmd += " --no-recreate"
-        self._docker_compose_cmd(cmd, env=env)
+            args += " --no-recreate"
+        self._docker_compose_up(args, env=env)
         self._wait_for_containers()
 
     def new_tenant_client(self, name, tenant):
@@ -277,6 +407,7 @@ class DockerComposeEnterpriseSetup(DockerComposeNamespace):
         self._docker_compose_cmd(
             "run -d --name=%s_%s mender-client" % (self.name, name),
             env={"TENANT_TOKEN": "%s" % tenant},
+            global_lock=True,
         )
         time.sleep(45)
 
@@ -287,6 +418,7 @@ class DockerComposeEnterpriseSetup(DockerComposeNamespace):
         self._docker_compose_cmd(
             "run -d --name=%s_%s mender-client" % (self.name, name),
             env={"TENANT_TOKEN": "%s" % tenant},
+            global_lock=True,
         )
         time.sleep(5)
 
@@ -304,9 +436,7 @@ class DockerComposeEnterpriseSetupWithGateway(DockerComposeEnterpriseSetup):
             )
 
     def setup(self):
-        self._docker_compose_cmd(
-            "up -d --scale mender-gateway=0 --scale mender-client=0",
-        )
+        self._docker_compose_up("--scale mender-gateway=0 --scale mender-client=0")
         self._wait_for_containers()
 
     def new_tenant_client(self, name, tenant):
@@ -316,12 +446,13 @@ class DockerComposeEnterpriseSetupWithGateway(DockerComposeEnterpriseSetup):
         self._docker_compose_cmd(
             "run -d --name=%s_%s mender-client" % (self.name, name),
             env={"TENANT_TOKEN": "%s" % tenant},
+            global_lock=True,
         )
         time.sleep(45)
 
     def start_tenant_mender_gateway(self, tenant):
-        self._docker_compose_cmd(
-            "up -d --scale mender-gateway=1  --scale mender-client=0",
+        self._docker_compose_up(
+            "--scale mender-gateway=1  --scale mender-client=0",
             env={"TENANT_TOKEN": "%s" % tenant},
         )
         time.sleep(45)
@@ -336,6 +467,7 @@ class DockerComposeEnterpriseSignedArtifactClientSetup(DockerComposeEnterpriseSe
         self._docker_compose_cmd(
             "run -d --name=%s_%s mender-client" % (self.name, name),
             env={"TENANT_TOKEN": "%s" % tenant},
+            global_lock=True,
         )
         time.sleep(45)
 
@@ -392,14 +524,13 @@ class DockerComposeEnterpriseDockerClientSetup(DockerComposeEnterpriseSetup):
             )
 
     def setup(self):
-        compose_args = "up -d --scale mender-client=0"
-        self._docker_compose_cmd(compose_args)
+        self._docker_compose_up("--scale mender-client=0")
         self._wait_for_containers()
 
     def new_tenant_docker_client(self, name, tenant):
         logger.info("creating docker client connected to tenant: " + tenant)
-        self._docker_compose_cmd(
-            "up -d --scale mender-client=1", env={"TENANT_TOKEN": "%s" % tenant},
+        self._docker_compose_up(
+            "--scale mender-client=1", env={"TENANT_TOKEN": "%s" % tenant},
         )
         time.sleep(5)
 
@@ -421,10 +552,10 @@ class DockerComposeCompatibilitySetup(DockerComposeNamespace):
         return clients
 
     def setup(self):
-        compose_args = "up -d " + " ".join(
+        compose_args = " ".join(
             ["--scale %s=0" % service for service in self.client_services()]
         )
-        self._docker_compose_cmd(compose_args)
+        self._docker_compose_up(compose_args)
         self._wait_for_containers()
 
     def populate_clients(self, name=None, tenant_token="", replicas=1):
@@ -439,7 +570,9 @@ class DockerComposeCompatibilitySetup(DockerComposeNamespace):
 
         for i in range(replicas):
             for service in client_services:
-                self._docker_compose_cmd(compose_cmd.format(service=service))
+                self._docker_compose_cmd(
+                    compose_cmd.format(service=service), global_lock=True
+                )
 
     def get_mender_clients(self, network="mender"):
         cmd = [
@@ -470,28 +603,29 @@ class DockerComposeMTLSSetup(DockerComposeNamespace):
 
     def setup(self):
         host_ip = socket.gethostbyname(socket.gethostname())
-        self._docker_compose_cmd(
-            "up -d --scale mtls-ambassador=0 --scale mender-client=0",
+        self._docker_compose_up(
+            "--scale mtls-ambassador=0 --scale mender-client=0",
             env={"HOST_IP": host_ip},
         )
         self._wait_for_containers()
 
     def start_api_gateway(self):
+        self.refresh_mender_gateway()
         self._docker_compose_cmd("scale mender-api-gateway=1")
 
     def stop_api_gateway(self):
+        self.refresh_mender_gateway()
         self._docker_compose_cmd("scale mender-api-gateway=0")
 
     def start_mtls_ambassador(self):
-        self._docker_compose_cmd(
-            "up -d --scale mtls-ambassador=1 --scale mender-client=0"
-        )
+        self._docker_compose_up("--scale mtls-ambassador=1 --scale mender-client=0")
         self._wait_for_containers()
 
     def new_mtls_client(self, name, tenant):
         self._docker_compose_cmd(
             "run -d --name=%s_%s mender-client" % (self.name, name),
             env={"TENANT_TOKEN": "%s" % tenant},
+            global_lock=True,
         )
         logger.info("creating client connected to tenant: " + tenant)
         time.sleep(45)
@@ -517,6 +651,7 @@ class DockerComposeMenderClient_2_5(DockerComposeCompatibilitySetup):
         self._docker_compose_cmd(
             "run -d --name=%s_%s mender-client-2-5" % (self.name, name),
             env={"TENANT_TOKEN": "%s" % tenant},
+            global_lock=True,
         )
         time.sleep(45)
 
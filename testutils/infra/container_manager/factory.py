@@ -40,9 +40,36 @@ from .kubernetes_manager import (
     KubernetesEnterpriseMonitorCommercialSetup,
     isK8S,
 )
+from .pool import NamespaceLimit, NamespacePool
 
 
 class ContainerManagerFactory:
+    def __init__(self):
+        self._pools = {}
+        self._pool_limit = NamespaceLimit(1)
+
+    def getPool(self, setup, size=1, max_running=None, **kwargs):
+        """Pool of `size` pre-started namespaces of the given setup type
+
+        setup is the name of the factory method creating the namespaces
+        (e.g. "getStandardSetup") and kwargs are passed on to it. The pool is
+        created on first use and shared by all subsequent callers.
+        max_running bounds the namespaces running at once across all the
+        pools (default: size), see NamespaceLimit.
+        """
+        self._pool_limit.max_running = max_running or size
+        key = (setup, tuple(sorted(kwargs.items())))
+        if key not in self._pools:
+            create = lambda: getattr(self, setup)(**kwargs)
+            self._pools[key] = NamespacePool(create, size, self._pool_limit)
+        return self._pools[key]
+
+    def shutdownPools(self):
+        """Tears down the namespaces of all the pools"""
+        pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            pool.shutdown()
+
     def getStandardSetup(self, name=None, num_clients=1):
         """Standard setup consisting on all core backend services and optionally clients
 
@@ -89,6 +89,7 @@ class KubernetesEnterpriseSetup(KubernetesNamespace):
                 "SERVER_URL": "https://%s" % self.get_mender_gateway(),
                 "TENANT_TOKEN": "%s" % tenant,
             },
+            global_lock=True,
         )
         time.sleep(45)
 
@@ -102,6 +103,7 @@ class KubernetesEnterpriseSetup(KubernetesNamespace):
                 "SERVER_URL": "https://%s" % self.get_mender_gateway(),
                 "TENANT_TOKEN": "%s" % tenant,
             },
+            global_lock=True,
         )
         time.sleep(5)
 
@@ -0,0 +1,219 @@
+# Copyright 2022 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+"""pools of pre-started namespaces of the same setup type"""
+
+import collections
+import copy
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from testutils.infra.device import MenderDevice, MenderDeviceGroup
+
+logger = logging.getLogger("root")
+
+
+class NamespaceLimit:
+    """Bounds the number of namespaces running at once across all the pools
+    sharing it.
+
+    Before a namespace is started beyond the limit, idle namespaces of the
+    other pools are torn down. If there are none, the start waits until a
+    namespace is torn down, so the limit must be at least the number of
+    namespaces leased at once.
+    """
+
+    def __init__(self, max_running):
+        self.max_running = max_running
+        self._running = 0
+        self._pools = []
+        self._cond = threading.Condition()
+
+    def register(self, pool):
+        self._pools.append(pool)
+
+    def acquire(self, pool):
+        """Waits until a namespace of pool may be started"""
+        while True:
+            with self._cond:
+                if self._running < self.max_running:
+                    self._running += 1
+                    return
+            # tearing down takes a while, not under the lock
+            if not any(
+                other.evict_idle() for other in self._pools if other is not pool
+            ):
+                with self._cond:
+                    self._cond.wait_for(
+                        lambda: self._running < self.max_running, timeout=10
+                    )
+
+    def release(self):
+        """Tells that a namespace was torn down"""
+        with self._cond:
+            self._running -= 1
+            self._cond.notify_all()
+
+
+class NamespacePool:
+    """Keeps up to `size` namespaces of one setup type running in the
+    background.
+
+    lease() hands out a namespace which is already set up, and release()
+    gives it back: the namespace is then reset() in the background instead
+    of being torn down, so that the next lease does not pay for a full
+    docker-compose up. The namespaces running across all the pools are
+    bounded by their NamespaceLimit, which may tear down idle namespaces of
+    the pool; they are started again on lease. A namespace which fails to
+    start or to reset is torn down and replaced by a freshly created one.
+    """
+
+    # attempts of lease() at getting a namespace which started successfully
+    LEASE_ATTEMPTS = 3
+
+    def __init__(self, create, size=1, limit=None):
+        """create is a callable returning a new (not yet set up) namespace"""
+        self._create = create
+        self._size = size
+        self._limit = limit or NamespaceLimit(size)
+        self._limit.register(self)
+        self._executor = ThreadPoolExecutor(max_workers=size)
+        self._cond = threading.Condition()
+        # futures of the namespaces being started or reset, or idle
+        self._ready = collections.deque()
+        # number of namespaces of the pool, whether starting, idle or leased
+        self._count = 0
+        self._all = []
+        # attributes of each namespace right after setup(), restored on reset
+        self._initial_state = {}
+        for _ in range(size):
+            self._reserve()
+            self._ready.append(self._executor.submit(self._start))
+
+    def _reserve(self):
+        with self._cond:
+            self._count += 1
+
+    def _start(self):
+        self._limit.acquire(self)
+        try:
+            env = self._create()
+        except Exception:
+            self._forget(None)
+            raise
+        with self._cond:
+            self._all.append(env)
+        try:
+            env.setup()
+        except Exception:
+            self._discard(env)
+            raise
+        self._initial_state[env.name] = copy.deepcopy(env.__dict__)
+        return env
+
+    def _reset(self, env):
+        initial_state = self._initial_state[env.name]
+        try:
+            # drop whatever the previous test attached (devices, tenant, auth...)
+            self._close_devices(env)
+            env.__dict__.clear()
+            env.__dict__.update(copy.deepcopy(initial_state))
+            env.reset()
+            return env
+        except Exception as e:
+            logger.warning(
+                "failed to reset namespace %s, replacing it: %s" % (env.name, e)
+            )
+            self._discard(env)
+            self._reserve()
+            return self._start()
+
+    def _close_devices(self, env):
+        """Closes the SSH connections of the devices attached to env"""
+        for value in env.__dict__.values():
+            if isinstance(value, (MenderDevice, MenderDeviceGroup)):
+                try:
+                    value.close()
+                except Exception as e:
+                    logger.warning(
+                        "failed to close device of namespace %s: %s" % (env.name, e)
+                    )
+
+    def _discard(self, env):
+        try:
+            self._close_devices(env)
+            env.teardown()
+        finally:
+            self._forget(env)
+
+    def _forget(self, env):
+        with self._cond:
+            if env is not None:
+                self._all.remove(env)
+                self._initial_state.pop(env.name, None)
+            self._count -= 1
+            self._cond.notify_all()
+        self._limit.release()
+
+    def _next(self):
+        """Returns the future of the next namespace to lease"""
+        with self._cond:
+            while len(self._ready) == 0 and self._count >= self._size:
+                self._cond.wait()
+            if len(self._ready) > 0:
+                return self._ready.popleft()
+            self._count += 1
+        return self._executor.submit(self._start)
+
+    def evict_idle(self):
+        """Tears down an idle namespace, returns whether there was one"""
+        with self._cond:
+            for future in self._ready:
+                if future.done() and future.exception() is None:
+                    self._ready.remove(future)
+                    break
+            else:
+                return False
+        env = future.result()
+        logger.info("evicting idle namespace %s" % env.name)
+        self._discard(env)
+        return True
+
+    def lease(self):
+        """Returns a namespace which is set up and clean"""
+        for attempt in range(1, self.LEASE_ATTEMPTS + 1):
+            future = self._next()
+            try:
+                return future.result()
+            except Exception as e:
+                logger.warning(
+                    "namespace of the pool failed to start (attempt %d of %d): %s"
+                    % (attempt, self.LEASE_ATTEMPTS, e)
+                )
+        raise RuntimeError(
+            "no namespace of the pool started in %d attempts" % self.LEASE_ATTEMPTS
+        )
+
+    def release(self, env):
+        """Gives back a leased namespace, which is reset in the background"""
+        future = self._executor.submit(self._reset, env)
+        with self._cond:
+            self._ready.append(future)
+            self._cond.notify_all()
+
+    def shutdown(self):
+        """Tears down all the namespaces of the pool"""
+        self._executor.shutdown(wait=True)
+        for env in list(self._all):
+            self._discard(env)
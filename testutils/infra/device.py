@@ -73,6 +73,10 @@ class MenderDevice:
     def host_string(self):
         return "%s:%s" % (self.host, self.port)
 
+    def close(self):
+        """Closes the SSH connection, it is reopened on the next command"""
+        self._conn.close()
+
     def run(self, cmd, **kw) -> str:
         """Run given cmd in remote SSH host
 
@@ -147,6 +151,8 @@ class RebootDetector:
         self.host_ip = host_ip
         self.device = device
         self.server = None
+        # (time.monotonic(), "shutdown" or "startup") of every message received
+        self.events = []
 
     def __enter__(self):
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -200,6 +206,7 @@ class RebootDetector:
 
             message = connection.recv(4096).decode().strip()
             connection.close()
+            self.events.append((time.monotonic(), message))
 
             if message == "shutdown":
                 logger.debug("Got shutdown message from client")
@@ -266,6 +273,11 @@ class MenderDeviceGroup:
     def __getitem__(self, idx):
         return self._devices[idx]
 
+    def close(self):
+        """Closes the SSH connections of all devices in group"""
+        for dev in self._devices:
+            dev.close()
+
     def append(self, new_device: MenderDevice):
         """Append new_device to the group."""
         assert isinstance(new_device, MenderDevice)
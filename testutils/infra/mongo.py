@@ -15,15 +15,27 @@
 from pymongo import MongoClient as PyMongoClient
 from testutils.infra.container_manager.kubernetes_manager import isK8S
 
+# databases which are never dropped by cleanup()
+PRESERVED_DBS = ["local", "admin", "config", "workflows"]
+
 
 class MongoClient:
     def __init__(self, addr="mender-mongo:27017"):
         self.client = PyMongoClient(addr)
 
+    def close(self):
+        self.client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
     def cleanup(self):
         if isK8S():
             return
         dbs = self.client.list_database_names()
-        dbs = [d for d in dbs if d not in ["local", "admin", "config", "workflows"]]
+        dbs = [d for d in dbs if d not in PRESERVED_DBS]
         for d in dbs:
             self.client.drop_database(d)
@@ -12,12 +12,46 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import collections
+import gzip
 import io
+import lzma
 import os
 import random
 import tarfile
+import tempfile
 import hashlib
 import json
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Size of the chunks in which payloads are read, hashed and compressed
+_BUFSIZE = 1024 * 1024
+
+# Compressed payloads larger than this are spooled to disk
+_SPOOL_SIZE = 16 * 1024 * 1024
+
+# Compression types, named after the mender-artifact --compression values,
+# and the suffix of the tar files they produce
+_COMPRESSIONS = {
+    "none": ".tar",
+    "gzip": ".tar.gz",
+    "lzma": ".tar.xz",
+    "zstd_fast": ".tar.zst",
+    "zstd_better": ".tar.zst",
+    "zstd_best": ".tar.zst",
+}
+_ZSTD_LEVELS = {"zstd_fast": 3, "zstd_better": 9, "zstd_best": 19}
+
+# gzip data is compressed in parallel in blocks of this size, each block being
+# a gzip member of its own: concatenated members make a valid gzip stream
+_GZIP_BLOCK_SIZE = 4 * 1024 * 1024
+
+_WORKERS = os.cpu_count() or 1
 
 # Valid state-script states
 _valid_states = (
@@ -39,15 +73,193 @@ _valid_states = (
 )
 
 
+class _ChecksumReader:
+    """
+    Wraps a readable file object, computing the SHA-256 checksum of all
+    the data read through it.
+    """
+
+    def __init__(self, fd):
+        self._fd = fd
+        self.sha = hashlib.sha256()
+
+    def read(self, size=-1):
+        buf = self._fd.read(size)
+        self.sha.update(buf)
+        return buf
+
+
+class _CompressingWriter:
+    """
+    Write-only file object compressing all the data written to it into
+    fileobj. gzip data is split in blocks which are compressed concurrently
+    by executor, if any; zstd uses the multi-threading of the library.
+    """
+
+    def __init__(self, fileobj, compression, executor=None):
+        self._fileobj = fileobj
+        self._compression = compression
+        self._executor = executor
+        self._buf = bytearray()
+        self._pending = collections.deque()
+        self._compressor = None
+        if compression == "lzma":
+            self._compressor = lzma.LZMACompressor(format=lzma.FORMAT_XZ)
+        elif compression in _ZSTD_LEVELS:
+            if zstandard is None:
+                raise ValueError("%s compression requires zstandard" % compression)
+            self._compressor = zstandard.ZstdCompressor(
+                level=_ZSTD_LEVELS[compression], threads=-1
+            ).compressobj()
+
+    def write(self, data):
+        if self._compression == "none":
+            self._fileobj.write(data)
+        elif self._compression == "gzip":
+            self._buf += data
+            while len(self._buf) >= _GZIP_BLOCK_SIZE:
+                self._compress_block(bytes(self._buf[:_GZIP_BLOCK_SIZE]))
+                del self._buf[:_GZIP_BLOCK_SIZE]
+        else:
+            self._fileobj.write(self._compressor.compress(data))
+        return len(data)
+
+    def _compress_block(self, block):
+        if self._executor is None:
+            self._fileobj.write(gzip.compress(block, compresslevel=6, mtime=0))
+            return
+        self._pending.append(
+            self._executor.submit(gzip.compress, block, compresslevel=6, mtime=0)
+        )
+        # write out completed blocks in order, bounding the ones held in memory
+        while len(self._pending) > 0 and (
+            self._pending[0].done() or len(self._pending) > 2 * _WORKERS
+        ):
+            self._fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        """Flushes the compressed data, fileobj itself is left open"""
+        if self._compression == "gzip":
+            if len(self._buf) > 0 or len(self._pending) == 0:
+                self._compress_block(bytes(self._buf))
+                self._buf = bytearray()
+            while len(self._pending) > 0:
+                self._fileobj.write(self._pending.popleft().result())
+        elif self._compressor is not None:
+            self._fileobj.write(self._compressor.flush())
+
+
+def _open_tar_stream(fileobj, name):
+    """
+    Opens the tar called name, compressed according to its suffix, for
+    reading in stream mode (fileobj does not need to be seekable).
+    """
+    if name.endswith(".tar.gz"):
+        fileobj = gzip.GzipFile(fileobj=fileobj, mode="rb")
+    elif name.endswith(".tar.xz"):
+        fileobj = lzma.LZMAFile(fileobj)
+    elif name.endswith(".tar.zst"):
+        if zstandard is None:
+            raise ValueError("reading %s requires zstandard" % name)
+        fileobj = zstandard.ZstdDecompressor().stream_reader(
+            fileobj, read_across_frames=True
+        )
+    elif not name.endswith(".tar"):
+        raise ValueError("unsupported compression for %s" % name)
+    return tarfile.open(fileobj=fileobj, mode="r|")
+
+
+def set_artifact_name(src, dst, artifact_name):
+    """
+    set_artifact_name copies the (version 3, unsigned) artifact at path src
+    to path dst, renaming it to artifact_name. Only the header is rewritten,
+    the payloads are copied as they are without being recompressed.
+    Provides of the payloads which were set to the former artifact name
+    (e.g. the default rootfs-image.version) are renamed as well, but not the
+    name written into the payloads themselves: the /etc/mender/artifact_info
+    of a rootfs image keeps the former name.
+    :param src: path of the artifact to rename
+    :param dst: path of the renamed artifact
+    :param artifact_name: new artifact name
+    """
+    with open(src, "rb") as fd_in, open(dst, "wb") as fd_out:
+        tar_in = tarfile.open(fileobj=fd_in, mode="r|")
+        tar_out = tarfile.open(fileobj=fd_out, mode="w|", copybufsize=_BUFSIZE)
+        manifest = None
+        for member in tar_in:
+            if member.name == "manifest.sig":
+                raise ValueError("renaming would invalidate the artifact signature")
+            elif member.name == "version":
+                data = tar_in.extractfile(member).read()
+                if json.loads(data).get("version") != 3:
+                    raise ValueError("unsupported artifact version: %s" % data)
+                tar_out.addfile(member, io.BytesIO(data))
+            elif member.name == "manifest":
+                manifest = tar_in.extractfile(member).read().decode().splitlines()
+            elif member.name.startswith("header.tar"):
+                if manifest is None:
+                    raise ValueError("not a mender artifact: manifest missing")
+                data = _rename_header(
+                    tar_in.extractfile(member), member.name, artifact_name
+                )
+                shasum = hashlib.sha256(data).hexdigest()
+                manifest = [
+                    "%s  %s" % (shasum, member.name)
+                    if line.split()[-1] == member.name
+                    else line
+                    for line in manifest
+                    if line.strip() != ""
+                ]
+                manifest_bin = ("\n".join(manifest) + "\n").encode()
+                tarhdr = tarfile.TarInfo("manifest")
+                tarhdr.size = len(manifest_bin)
+                tar_out.addfile(tarhdr, io.BytesIO(manifest_bin))
+                member.size = len(data)
+                tar_out.addfile(member, io.BytesIO(data))
+            else:
+                tar_out.addfile(member, tar_in.extractfile(member))
+        tar_out.close()
+
+
+def _rename_header(fileobj, name, artifact_name):
+    suffix = name[len("header") :]
+    compression = [c for c, s in _COMPRESSIONS.items() if s == suffix][0]
+    hdr_in = _open_tar_stream(fileobj, name)
+    hdr_tarbin = io.BytesIO()
+    hdr_writer = _CompressingWriter(hdr_tarbin, compression)
+    hdr_out = tarfile.open(fileobj=hdr_writer, mode="w|")
+    former_name = None
+    for info in hdr_in:
+        if not info.isfile():
+            hdr_out.addfile(info)
+            continue
+        data = hdr_in.extractfile(info).read()
+        if info.name == "header-info":
+            header_info = json.loads(data)
+            former_name = header_info["artifact_provides"]["artifact_name"]
+            header_info["artifact_provides"]["artifact_name"] = artifact_name
+            data = json.dumps(header_info).encode()
+        elif info.name.endswith("/type-info") and former_name is not None:
+            type_info = json.loads(data)
+            provides = type_info.get("artifact_provides") or {}
+            for key, value in provides.items():
+                if value == former_name:
+                    provides[key] = artifact_name
+            data = json.dumps(type_info).encode()
+        info.size = len(data)
+        hdr_out.addfile(info, io.BytesIO(data))
+    hdr_out.close()
+    hdr_writer.close()
+    return hdr_tarbin.getvalue()
+
+
 class Artifact:
     """
     Artifact provides a very simplistic implementation of mender artifact
-    that allows creating simple buffered artifact file objects that
-    resides in memory.
+    that allows creating simple artifact file objects, either buffered in
+    memory (make) or streamed to any writable file object (write).
     """
 
-    _dummySHA = "%064d" % 0
-
     def __init__(
         self,
         artifact_name,
@@ -57,12 +269,16 @@ class Artifact:
         payload_type="rootfs-image",
         provides=None,
         depends=None,
+        compression="gzip",
     ):
         """
         :param artifact_name: name of the artifact (str)
         :param device_types:  list of compatible device types (list)
         :param payload:       optional payload to initialize the payload
                               section (file, io.IOBase, str, bytes)
+        :param compression:   compression of the header and payloads, as for
+                              mender-artifact: none, gzip, lzma, zstd_fast,
+                              zstd_better or zstd_best (str)
         """
         if not isinstance(artifact_name, str):
             raise TypeError("artifact_name must be type str")
@@ -70,8 +286,12 @@ class Artifact:
             raise TypeError("device_types must be a list of strings")
         elif len(device_types) == 0:
             raise ValueError("device_types cannot be empty")
+        if compression not in _COMPRESSIONS:
+            raise ValueError("unsupported compression: %s" % compression)
 
-        self._filenames = ["version", "header.tar.gz"]
+        self._compression = compression
+        self._suffix = _COMPRESSIONS[compression]
+        self._filenames = ["version", "header" + self._suffix]
         self._payloads = {}
         self._provides = {"header-info": {"artifact_name": artifact_name}}
         self._provide_keys = ["artifact_name"]
@@ -152,23 +372,47 @@ class Artifact:
         file object with the raw binary artifact.
         :returns: artifact (io.BytesIO)
         """
-        self._artifact = io.BytesIO()
-        self._tarfact = tarfile.open(fileobj=self._artifact, mode="w")
-        self._add_version()
-        self._initialize_manifest()
-        self._add_header()
-        self._add_payloads()
-        self._complete_manifest()
-        self._artifact.seek(0)
-        return self._artifact
+        artifact = io.BytesIO()
+        self.write(artifact)
+        artifact.seek(0)
+        return artifact
+
+    def write(self, fileobj):
+        """
+        write streams the artifact at the current state to fileobj, which
+        only needs to be writable (file, pipe, socket.makefile("wb"), ...).
+        Payloads are first compressed into temporary files, computing their
+        checksums in the same pass, so that the manifest can be written
+        upfront and memory usage stays bounded whatever the payload sizes.
+        :param fileobj: writable file object receiving the artifact
+        """
+        payloads = self._compress_payloads()
+        try:
+            tar = tarfile.open(fileobj=fileobj, mode="w|", copybufsize=_BUFSIZE)
+            version = self._make_version()
+            header = self._make_header()
+            self._add_file(tar, "version", version)
+            self._add_file(tar, "manifest", self._make_manifest())
+            self._add_file(tar, "header" + self._suffix, header)
+            for name, payload_tarbin in payloads:
+                self._add_file(tar, name, payload_tarbin)
+            tar.close()
+        finally:
+            for _, payload_tarbin in payloads:
+                payload_tarbin.close()
+
+    def _add_file(self, tar, name, fd):
+        tarhdr = tarfile.TarInfo(name)
+        tarhdr.size = fd.seek(0, io.SEEK_END)
+        fd.seek(0)
+        tar.addfile(tarhdr, fd)
 
     def _compute_checksum(self, filename, fd):
         fd.seek(0)
-        BUFSIZE = 1024 * 1024
         sha = hashlib.sha256()
         while True:
             # Digest a MiB at the time
-            buf = fd.read(BUFSIZE)
+            buf = fd.read(_BUFSIZE)
             if len(buf) == 0:
                 break
             sha.update(buf)
@@ -178,70 +422,79 @@ class Artifact:
         fd.seek(0)
         return size
 
-    def _initialize_manifest(self):
+    def _make_manifest(self):
         """
-        This is sort of cheating: this function initialize the manifest
-        bogus checksums. Later, _complete_manifest will seek to the stored
-        checksum offsets and overwrite these checksums with the correct
-        one.
+        The manifest lists the checksums of all the other files, hence it
+        can only be made once the header and the payloads are completed.
         """
-        tmp_manifest = io.BytesIO()
-        self._manifest_offsets = {}
-        for filename in self._filenames[::-1]:
-            self._manifest_offsets[filename] = tmp_manifest.tell()
-            tmp_manifest.write(("%s  %s\n" % (self._dummySHA, filename)).encode())
-        size = tmp_manifest.tell()
-        tarhdr = tarfile.TarInfo("manifest")
-        tarhdr.size = size
-        tmp_manifest.seek(0)
-        self._tarfact.addfile(tarhdr, fileobj=tmp_manifest)
-
-    def _complete_manifest(self):
-        self._artifact.seek(0)
-        rdtar = tarfile.open(fileobj=self._artifact, mode="r")
-        manifest_hdr = rdtar.getmember("manifest")
-        offset = manifest_hdr.offset_data
+        manifest = io.BytesIO()
         for filename in self._filenames[::-1]:
-            offset_sha = offset + self._manifest_offsets[filename]
-            self._artifact.seek(offset_sha)
-            self._artifact.write(self._shasums[filename].encode())
+            manifest.write(("%s  %s\n" % (self._shasums[filename], filename)).encode())
+        return manifest
 
-    def _add_payloads(self):
+    def _compress_payloads(self):
         """
-        Adds all the stored payload to artifact.
-        Each payload is itself a compressed tar.
+        Compresses all the stored payloads in parallel into (spooled)
+        temporary files, each payload is itself a compressed tar. The
+        checksums of the payloads are computed while compressing them.
+        :returns: list of (artifact member name, temporary file) tuples
         """
-        filenames = sorted(list(self._payloads.keys()))
-        for filename in filenames:
-            fd = self._payloads[filename]
-
-            size = fd.seek(0, io.SEEK_END)
-            fd.seek(0)
+        filenames = sorted(self._payloads.keys())
+        compressed = []
+        error = None
+        with ThreadPoolExecutor(max_workers=_WORKERS) as blocks:
+            with ThreadPoolExecutor(max_workers=max(len(filenames), 1)) as payloads:
+                futures = [
+                    payloads.submit(self._compress_payload, filename, blocks)
+                    for filename in filenames
+                ]
+                for filename, future in zip(filenames, futures):
+                    try:
+                        compressed.append(
+                            (os.path.dirname(filename) + self._suffix, future.result())
+                        )
+                    except Exception as e:
+                        error = error or e
+        if error is not None:
+            for _, payload_tarbin in compressed:
+                payload_tarbin.close()
+            raise error
+        return compressed
+
+    def _compress_payload(self, filename, executor):
+        fd = self._payloads[filename]
+
+        size = fd.seek(0, io.SEEK_END)
+        fd.seek(0)
 
-            payload_tarbin = io.BytesIO()
-            payload_tar = tarfile.open(fileobj=payload_tarbin, mode="w:gz")
+        payload_tarbin = tempfile.SpooledTemporaryFile(max_size=_SPOOL_SIZE)
+        try:
+            writer = _CompressingWriter(payload_tarbin, self._compression, executor)
+            payload_tar = tarfile.open(fileobj=writer, mode="w|", copybufsize=_BUFSIZE)
             tarhdr = tarfile.TarInfo(os.path.basename(filename))
             tarhdr.size = size
-            payload_tar.addfile(tarhdr, fd)
+            reader = _ChecksumReader(fd)
+            payload_tar.addfile(tarhdr, reader)
             payload_tar.close()
+            writer.close()
+        except Exception:
+            payload_tarbin.close()
+            raise
 
-            tarhdr = tarfile.TarInfo(os.path.dirname(filename) + ".tar.gz")
-            tarhdr.size = payload_tarbin.tell()
-            self._compute_checksum(filename, fd)
-            payload_tarbin.seek(0)
-            self._tarfact.addfile(tarhdr, payload_tarbin)
+        self._shasums[filename] = reader.sha.hexdigest()
+        fd.seek(0)
+        return payload_tarbin
 
-    def _add_version(self):
+    def _make_version(self):
         version = {"format": "mender", "version": 3}
         fd = io.BytesIO(json.dumps(version).encode())
-        size = self._compute_checksum("version", fd)
-        tarhdr = tarfile.TarInfo("version")
-        tarhdr.size = size
-        self._tarfact.addfile(tarhdr, fd)
+        self._compute_checksum("version", fd)
+        return fd
 
-    def _add_header(self):
+    def _make_header(self):
         hdr_tarbin = io.BytesIO()
-        hdr_tar = tarfile.open(fileobj=hdr_tarbin, mode="w:gz")
+        hdr_writer = _CompressingWriter(hdr_tarbin, self._compression)
+        hdr_tar = tarfile.open(fileobj=hdr_writer, mode="w|")
         header_info = {
             "payloads": [
                 {
@@ -289,10 +542,9 @@ class Artifact:
 
         # Complete tar padding
         hdr_tar.close()
-        size = self._compute_checksum("header.tar.gz", hdr_tarbin)
-        tarhdr = tarfile.TarInfo("header.tar.gz")
-        tarhdr.size = size
-        self._tarfact.addfile(tarhdr, hdr_tarbin)
+        hdr_writer.close()
+        self._compute_checksum("header" + self._suffix, hdr_tarbin)
+        return hdr_tarbin
 
     def __del__(self):
         """
@@ -304,3 +556,147 @@ class Artifact:
                 del self._payloads[filename]
             except Exception:
                 pass
+
+
+class ArtifactReader:
+    """
+    ArtifactReader parses a mender artifact (version 3) in a single pass over
+    its tar stream, without extracting anything, and verifies the checksums
+    listed in the manifest on the way. The fileobj only needs to be readable
+    (file, pipe, HTTP response raw stream...).
+
+    Everything but the payloads (version, manifest, header) is parsed on
+    creation. Payloads are processed lazily by iterating payloads(), or all
+    at once by read().
+    """
+
+    def __init__(self, fileobj, verify=True):
+        """
+        :param fileobj: readable file object containing the artifact
+        :param verify:  whether checksums are verified (bool)
+        """
+        self.version = None
+        self.manifest = None
+        self.header_info = None
+        self.scripts = []
+        self.type_info = {}
+        self.meta_data = {}
+        self.payload_sizes = {}
+
+        self._verify = verify
+        self._shasums = {}
+        self._tar = tarfile.open(fileobj=fileobj, mode="r|")
+        self._members = iter(self._tar)
+
+        for member in self._members:
+            if member.name == "version":
+                reader = _ChecksumReader(self._tar.extractfile(member))
+                self.version = json.loads(reader.read())
+                self._check(member.name, reader.sha.hexdigest())
+            elif member.name == "manifest":
+                self._read_manifest(self._tar.extractfile(member).read())
+            elif member.name.startswith("header.tar"):
+                self._read_header(member)
+                break
+        if self.version is None or self.header_info is None:
+            raise ValueError("not a mender artifact: version or header missing")
+        if self.version.get("version") != 3:
+            raise ValueError("unsupported artifact version: %s" % self.version)
+
+    @property
+    def artifact_name(self):
+        return self.header_info["artifact_provides"]["artifact_name"]
+
+    @property
+    def device_types(self):
+        return self.header_info["artifact_depends"]["device_type"]
+
+    @property
+    def provides(self):
+        return self.header_info["artifact_provides"]
+
+    @property
+    def depends(self):
+        return self.header_info["artifact_depends"]
+
+    def payloads(self):
+        """
+        payloads streams through the payload section of the artifact,
+        verifying the checksum of every file on the way.
+        :returns: generator of (filename, size) for every payload file, the
+                  filename being the one listed in the manifest.
+        """
+        for member in self._members:
+            if not member.name.startswith("data/"):
+                continue
+            index = os.path.basename(member.name).split(".")[0]
+            payload = _open_tar_stream(self._tar.extractfile(member), member.name)
+            for info in payload:
+                filename = "data/%s/%s" % (index, info.name)
+                if self._verify:
+                    reader = _ChecksumReader(payload.extractfile(info))
+                    while len(reader.read(_BUFSIZE)) > 0:
+                        pass
+                    self._check(filename, reader.sha.hexdigest())
+                self.payload_sizes[filename] = info.size
+                yield filename, info.size
+
+        if self._verify:
+            missing = set(self.manifest) - set(self._shasums)
+            if len(missing) > 0:
+                raise ValueError("files missing from the artifact: %s" % missing)
+
+    def read(self):
+        """
+        read processes the whole artifact.
+        :returns: the reader itself
+        """
+        for _ in self.payloads():
+            pass
+        return self
+
+    def _check(self, filename, shasum):
+        self._shasums[filename] = shasum
+        if not self._verify or self.manifest is None:
+            # verified once the manifest is read
+            return
+        expected = self.manifest.get(filename)
+        if expected is None:
+            raise ValueError("%s is not listed in the manifest" % filename)
+        if expected != shasum:
+            raise ValueError(
+                "checksum mismatch for %s: expected %s, got %s"
+                % (filename, expected, shasum)
+            )
+
+    def _read_manifest(self, data):
+        self.manifest = {}
+        for line in data.decode().splitlines():
+            if line.strip() == "":
+                continue
+            shasum, filename = line.split()
+            self.manifest[filename] = shasum
+        for filename, shasum in list(self._shasums.items()):
+            self._check(filename, shasum)
+
+    def _read_header(self, member):
+        reader = _ChecksumReader(self._tar.extractfile(member))
+        header = _open_tar_stream(reader, member.name)
+        for info in header:
+            if not info.isfile():
+                continue
+            if info.name == "header-info":
+                self.header_info = json.loads(header.extractfile(info).read())
+            elif info.name.startswith("scripts/"):
+                self.scripts.append(os.path.basename(info.name))
+            elif info.name.startswith("headers/"):
+                index = info.name.split("/")[1]
+                data = header.extractfile(info).read()
+                if info.name.endswith("/type-info"):
+                    self.type_info[index] = json.loads(data)
+                elif info.name.endswith("/meta-data"):
+                    self.meta_data[index] = json.loads(data) if data else None
+        # digest the remaining tar padding as well
+        while len(reader.read(_BUFSIZE)) > 0:
+            pass
+        self._check(member.name, reader.sha.hexdigest())
@@ -0,0 +1,245 @@
+# Copyright 2022 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Content-addressed cache of built artifacts, shared by all the test processes
+# of the host, and kept across test runs. Artifacts are looked up by a digest
+# of everything they are built from (input files contents, device types,
+# provides/depends, scripts, compression, signing key, version, version of the
+# tools building them...) so that every build runs once per set of inputs.
+#
+# The cache is configured with:
+#  ARTIFACT_CACHE_DIR:  directory of the cache (default: <tmp>/mender-artifact-cache)
+#  ARTIFACT_CACHE_SIZE: maximum size of the cache in MiB, least recently used
+#                       artifacts are evicted beyond it; 0 disables the cache
+#                       (default: 4096)
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+import filelock
+
+from .artifact import set_artifact_name
+from .image import reflink
+
+logger = logging.getLogger("root")
+
+_BUFSIZE = 1024 * 1024
+
+
+def _clone(src, dst):
+    """
+    Makes dst a copy of src as cheaply as the filesystem allows: reflink,
+    else plain copy. Never a hard link: a test modifying the artifact it was
+    handed out would otherwise modify the cached one as well.
+    """
+    tmp = "%s.%d.tmp" % (dst, os.getpid())
+    try:
+        reflink(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class ArtifactCache:
+    def __init__(self, path, max_size):
+        """
+        :param path:     directory of the cache
+        :param max_size: maximum size of the cache in bytes, 0 disables it
+        """
+        self.path = path
+        self.max_size = max_size
+        # digests of input files by (path, inode, size, mtime)
+        self._digests = {}
+        self._digests_lock = threading.Lock()
+        # versions of the tools building the artifacts, by tool
+        self._versions = {}
+        if self.enabled:
+            os.makedirs(self.path, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def file_digest(self, path):
+        """
+        Returns the sha256 of the contents of the file at path, or of the
+        relative paths, modes and contents of all the files below it if it
+        is a directory.
+        """
+        if os.path.isdir(path):
+            return self._dir_digest(path)
+        st = os.stat(path)
+        key = (os.path.realpath(path), st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._digests_lock:
+            if key in self._digests:
+                return self._digests[key]
+        sha = hashlib.sha256()
+        with open(path, "rb") as fd:
+            for buf in iter(lambda: fd.read(_BUFSIZE), b""):
+                sha.update(buf)
+        with self._digests_lock:
+            self._digests[key] = sha.hexdigest()
+        return self._digests[key]
+
+    def _dir_digest(self, path):
+        # not memoized: the directory is unchanged when the files in it are
+        sha = hashlib.sha256()
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for name in sorted(names):
+                file = os.path.join(root, name)
+                sha.update(
+                    json.dumps(
+                        [os.path.relpath(file, path), os.stat(file).st_mode]
+                    ).encode()
+                )
+                sha.update(self.file_digest(file).encode())
+        return sha.hexdigest()
+
+    def tool_version(self, tool):
+        """
+        Returns the output of `tool --version`, or the digest of the tool
+        if it has no such option.
+        """
+        with self._digests_lock:
+            if tool in self._versions:
+                return self._versions[tool]
+        try:
+            version = subprocess.run(
+                [tool, "--version"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                check=True,
+            ).stdout.decode()
+        except (OSError, subprocess.CalledProcessError):
+            path = shutil.which(tool)
+            version = self.file_digest(path) if path is not None else None
+        with self._digests_lock:
+            self._versions[tool] = version
+        return version
+
+    def key(self, inputs, files=(), tools=()):
+        """
+        Returns the cache key of an artifact.
+        :param inputs: JSON serializable description of the build (flags,
+                       device types, provides/depends...)
+        :param files:  paths of the files the artifact is built from; their
+                       contents are part of the key, not their paths.
+        :param tools:  command line tools building the artifact; their
+                       versions are part of the key.
+        """
+        sha = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode())
+        for tool in tools:
+            sha.update(json.dumps([tool, self.tool_version(tool)]).encode())
+        for path in files:
+            sha.update(self.file_digest(path).encode())
+        return sha.hexdigest()
+
+    def get(
+        self,
+        output,
+        build,
+        inputs,
+        files=(),
+        artifact_name=None,
+        tools=("mender-artifact",),
+    ):
+        """
+        Makes the artifact described by inputs and files at path output,
+        either from the cache or by calling build(output) and then storing
+        its result.
+        :param tools:         command line tools build() runs, see key()
+        :param artifact_name: name of the artifact, when it is not part of
+                              inputs: cached artifacts built with another name
+                              are then renamed by patching their header. Only
+                              unsigned version 3 artifacts can be renamed, and
+                              only the header is: the name must be part of
+                              inputs when it is written into the payloads too.
+        :returns: output
+        """
+        if not self.enabled:
+            build(output)
+            return output
+
+        key = self.key(inputs, files, tools)
+        entry = os.path.join(self.path, key + ".mender")
+        with filelock.FileLock(entry + ".lock"):
+            if os.path.exists(entry):
+                logger.info("artifact cache hit: %s" % key)
+                os.utime(entry)
+                if artifact_name is None or self._name(entry) == artifact_name:
+                    _clone(entry, output)
+                else:
+                    set_artifact_name(entry, output, artifact_name)
+                return output
+
+            logger.info("artifact cache miss: %s" % key)
+            build(output)
+            if not os.path.exists(output):
+                # the build failed, let the caller deal with it
+                return output
+            _clone(output, entry)
+            if artifact_name is not None:
+                with open(entry + ".name", "w") as fd:
+                    fd.write(artifact_name)
+        self.evict()
+        return output
+
+    def _name(self, entry):
+        try:
+            with open(entry + ".name") as fd:
+                return fd.read()
+        except FileNotFoundError:
+            return None
+
+    def evict(self):
+        """Removes the least recently used artifacts beyond max_size"""
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".mender"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            entry = os.path.join(self.path, name)
+            try:
+                with filelock.FileLock(entry + ".lock", timeout=0):
+                    logger.info("artifact cache eviction: %s" % name)
+                    os.unlink(entry)
+                    os.path.exists(entry + ".name") and os.unlink(entry + ".name")
+                    total -= size
+            except (filelock.Timeout, FileNotFoundError):
+                # in use by another process, or evicted by it already
+                continue
+
+
+cache = ArtifactCache(
+    os.getenv(
+        "ARTIFACT_CACHE_DIR",
+        os.path.join(tempfile.gettempdir(), "mender-artifact-cache"),
+    ),
+    int(os.getenv("ARTIFACT_CACHE_SIZE", "4096")) * 1024 * 1024,
+)
@@ -0,0 +1,201 @@
+# Copyright 2022 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Helpers for the (mostly sparse, multi-GiB) filesystem images used by tests.
+
+import errno
+import fcntl
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+# ioctl cloning the extents of a file (reflink) on btrfs, xfs...
+_FICLONE = 0x40049409
+
+_BUFSIZE = 1024 * 1024
+
+# Files read from images, by (image identity, path)
+_read_cache = {}
+_read_cache_lock = threading.Lock()
+
+
+def reflink(src, dst):
+    """
+    Makes dst a reflink of src: both share their data until either of them
+    is modified. Raises OSError if the filesystem does not support it.
+    """
+    with open(src, "rb") as fd_in, open(dst, "wb") as fd_out:
+        try:
+            fcntl.ioctl(fd_out.fileno(), _FICLONE, fd_in.fileno())
+        except OSError:
+            fd_out.close()
+            os.unlink(dst)
+            raise
+
+
+def sparse_copy(src, dst):
+    """Copies src to dst, skipping the holes of src"""
+    with open(src, "rb") as fd_in, open(dst, "wb") as fd_out:
+        size = os.fstat(fd_in.fileno()).st_size
+        offset = 0
+        while offset < size:
+            try:
+                data = os.lseek(fd_in.fileno(), offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # only a hole left
+                    break
+                if e.errno != errno.EINVAL:
+                    raise
+                # holes not supported by the filesystem: copy everything
+                data = offset
+                hole = size
+            else:
+                hole = os.lseek(fd_in.fileno(), data, os.SEEK_HOLE)
+            fd_in.seek(data)
+            fd_out.seek(data)
+            remaining = hole - data
+            while remaining > 0:
+                buf = fd_in.read(min(_BUFSIZE, remaining))
+                if len(buf) == 0:
+                    break
+                fd_out.write(buf)
+                remaining -= len(buf)
+            offset = hole
+        fd_out.truncate(size)
+    shutil.copymode(src, dst)
+
+
+def copy_image(src, dst):
+    """
+    Copies the image src to dst as cheaply as possible: a reflink if the
+    filesystem supports it, a sparse copy otherwise. Either way, dst can be
+    modified without affecting src (copy-on-write).
+    """
+    try:
+        reflink(src, dst)
+    except OSError:
+        sparse_copy(src, dst)
+
+
+def _identity(image):
+    """Identifies the current contents of image without reading it"""
+    st = os.stat(image)
+    return (os.path.realpath(image), st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _quote(path):
+    return '"%s"' % path
+
+
+def debugfs(image, writes={}, reads=()):
+    """
+    Runs a single debugfs session on the ext4 image, first writing files
+    into it and then reading files from it.
+    :param writes: dict of path in the image: contents (bytes), existing
+                   files are replaced
+    :param reads:  paths in the image to read
+    :returns: dict of path: contents (bytes, or None if missing) for reads
+    """
+    with tempfile.TemporaryDirectory() as d:
+        cmds = []
+        for i, (path, data) in enumerate(writes.items()):
+            local = os.path.join(d, "write-%d" % i)
+            with open(local, "wb") as fd:
+                fd.write(data)
+            cmds.append("cd %s" % _quote(os.path.dirname(path) or "/"))
+            cmds.append("rm %s" % _quote(os.path.basename(path)))
+            cmds.append("write %s %s" % (_quote(local), _quote(os.path.basename(path))))
+        for i, path in enumerate(reads):
+            cmds.append("dump %s %s" % (_quote(path), _quote(os.path.join(d, str(i)))))
+        instr_file = os.path.join(d, "cmds")
+        with open(instr_file, "w") as fd:
+            fd.write("\n".join(cmds) + "\n")
+
+        args = ["debugfs"] + (["-w"] if len(writes) > 0 else [])
+        subprocess.run(
+            args + ["-f", instr_file, image],
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+        result = {}
+        for i, path in enumerate(reads):
+            try:
+                with open(os.path.join(d, str(i)), "rb") as fd:
+                    result[path] = fd.read()
+            except FileNotFoundError:
+                result[path] = None
+
+    identity = _identity(image)
+    with _read_cache_lock:
+        for path, data in result.items():
+            _read_cache[(identity, path)] = data
+    return result
+
+
+def read_files(image, paths):
+    """
+    Reads the files at paths from the ext4 image, in a single debugfs
+    session for those which were not read from this image before.
+    :returns: dict of path: contents (bytes, or None if missing)
+    """
+    identity = _identity(image)
+    with _read_cache_lock:
+        result = {
+            path: _read_cache[(identity, path)]
+            for path in paths
+            if (identity, path) in _read_cache
+        }
+    missing = [path for path in paths if path not in result]
+    if len(missing) > 0:
+        result.update(debugfs(image, reads=missing))
+    return result
+
+
+def read_file(image, path):
+    """Reads the file at path from the ext4 image, None if missing"""
+    return read_files(image, [path])[path]
+
+
+def patch_image(image, files):
+    """
+    Replaces files of the ext4 image, in a single debugfs session which
+    also reads them back to verify them.
+    :param files: dict of path in the image: contents (bytes or str)
+    """
+    files = {
+        path: data.encode() if isinstance(data, str) else data
+        for path, data in files.items()
+    }
+    result = debugfs(image, writes=files, reads=list(files))
+    for path, data in files.items():
+        if result[path] != data:
+            raise RuntimeError("failed to write %s into %s" % (path, image))
+
+
+def artifact_info(image):
+    """Returns /etc/mender/artifact_info of the ext4 image as a dict"""
+    info = {}
+    data = read_file(image, "/etc/mender/artifact_info")
+    if data is None:
+        raise FileNotFoundError("no /etc/mender/artifact_info in %s" % image)
+    for line in data.decode().splitlines():
+        key, sep, value = line.partition("=")
+        if sep == "=":
+            info[key.strip()] = value.strip()
+    return info
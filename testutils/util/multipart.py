@@ -0,0 +1,176 @@
+# Copyright 2022 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Streaming multipart/form-data encoder. requests builds multipart bodies in
+# memory when given files=, which does not scale to multi-GiB artifacts.
+
+import io
+import os
+import time
+import uuid
+
+_BUFSIZE = 1024 * 1024
+
+
+class MultipartEncoder(io.RawIOBase):
+    """
+    Read-only file object streaming a multipart/form-data body, to be passed
+    as data= to requests along with the content_type header. The length of
+    the body is known upfront (Content-Length instead of chunked encoding),
+    and the body can be rewound with seek(), which urllib3 does to replay it
+    on retries.
+    """
+
+    def __init__(self, fields, progress=None):
+        """
+        :param fields:   list of (name, value) tuples, value being either a
+                         string or a (filename, path, content type) tuple for
+                         file fields, whose contents are read from path.
+        :param progress: optional callable(bytes read, total bytes), called
+                         while the body is read.
+        """
+        self.boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary=" + self.boundary
+        self.progress = progress
+        # parts are either bytes, or (path, size) of file contents
+        self._parts = []
+        for name, value in fields:
+            if isinstance(value, tuple):
+                filename, path, content_type = value
+                self._add(
+                    '--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                    "Content-Type: %s\r\n\r\n"
+                    % (self.boundary, name, os.path.basename(filename), content_type)
+                )
+                self._parts.append((path, os.path.getsize(path)))
+                self._add("\r\n")
+            else:
+                self._add(
+                    '--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+                    % (self.boundary, name, value)
+                )
+        self._add("--%s--\r\n" % self.boundary)
+        self.len = sum(self._size(part) for part in self._parts)
+        self._pos = 0
+        self._fd = None
+        self.started = None
+
+    def _add(self, data):
+        self._parts.append(data.encode())
+
+    @staticmethod
+    def _size(part):
+        return len(part) if isinstance(part, bytes) else part[1]
+
+    def __len__(self):
+        return self.len
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.len
+        self._pos = max(0, min(offset, self.len))
+        return self._pos
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[: len(data)] = data
+        return len(data)
+
+    def read(self, size=-1):
+        if self.started is None:
+            self.started = time.monotonic()
+        if size is None or size < 0:
+            size = self.len - self._pos
+        out = bytearray()
+        start = 0
+        for part in self._parts:
+            part_size = self._size(part)
+            end = start + part_size
+            if self._pos < end and len(out) < size:
+                offset = self._pos - start
+                length = min(part_size - offset, size - len(out))
+                if isinstance(part, bytes):
+                    out += part[offset : offset + length]
+                else:
+                    out += self._read_file(part[0], offset, length)
+                self._pos += length
+            start = end
+        if self.progress is not None and len(out) > 0:
+            self.progress(self._pos, self.len)
+        return bytes(out)
+
+    def _read_file(self, path, offset, length):
+        if self._fd is None or self._fd.name != path:
+            self.close_file()
+            self._fd = open(path, "rb")
+        return os.pread(self._fd.fileno(), length, offset)
+
+    def close_file(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+    def close(self):
+        self.close_file()
+        super().close()
+
+    def throughput(self):
+        """Returns the average read throughput so far, in MiB/s"""
+        if self.started is None:
+            return 0.0
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return self._pos / elapsed / 1024 / 1024
+
+
+def progress_reporter(log, name, step=10, interval=5):
+    """
+    Returns a progress callable for MultipartEncoder, which reports through
+    log (e.g. logger.info) every step percents of the upload of name, at
+    most once every interval seconds but for the end of the upload.
+    """
+    state = {"reported": -step, "started": time.monotonic(), "logged": None}
+
+    def progress(done, total):
+        percent = 100 * done // max(total, 1)
+        now = time.monotonic()
+        if percent < state["reported"]:
+            # rewound for a retry
+            state["reported"] = -step
+            state["started"] = now
+            state["logged"] = None
+        if done < total:
+            if percent < state["reported"] + step:
+                return
+            if state["logged"] is not None and now - state["logged"] < interval:
+                return
+        state["reported"] = percent - percent % step
+        state["logged"] = now
+        elapsed = max(now - state["started"], 1e-6)
+        log(
+            "uploading %s: %d%% (%d/%d bytes, %.1f MiB/s)"
+            % (name, percent, done, total, done / elapsed / 1024 / 1024)
+        )
+
+    return progress
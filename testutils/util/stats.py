@@ -0,0 +1,37 @@
+# Copyright 2022 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Summaries of the measurements (latencies, throughputs...) of the benchmarks.
+
+import math
+
+
+def percentile(values, p):
+    """Nearest-rank percentile p (0-100) of values, None if there is none"""
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summary(values):
+    """Returns the min, mean, p50, p95, p99 and max of values"""
+    return {
+        "min": min(values) if len(values) > 0 else None,
+        "mean": sum(values) / len(values) if len(values) > 0 else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if len(values) > 0 else None,
+    }
@@ -0,0 +1,112 @@
+# Copyright 2022 Northern.tech AS
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Streaming file transfers: test files, uploads and downloads are processed
+# in large chunks and hashed on the fly, never held in memory as a whole, so
+# that transfer tests can use GB-sized files and report their throughput.
+
+import hashlib
+import logging
+import random
+import time
+
+import requests
+
+from testutils.util.multipart import MultipartEncoder
+
+logger = logging.getLogger("root")
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def random_file(path, size, seed=None):
+    """
+    Writes size bytes of pseudo random data to path. The data only depends
+    on the seed, a random one by default.
+    :returns: the MD5 hex digest of the data
+    """
+    rand = random.Random(seed)
+    md5 = hashlib.md5()
+    with open(path, "wb") as fd:
+        remaining = size
+        while remaining > 0:
+            n = min(_CHUNK_SIZE, remaining)
+            chunk = rand.getrandbits(n * 8).to_bytes(n, "little")
+            md5.update(chunk)
+            fd.write(chunk)
+            remaining -= n
+    return md5.hexdigest()
+
+
+def file_md5(path):
+    """Returns the MD5 hex digest of the file at path"""
+    md5 = hashlib.md5()
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(_CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _stats(what, size, duration, md5=None):
+    stats = {
+        "bytes": size,
+        "duration": duration,
+        "mbps": size / duration / 1e6 if duration > 0 else None,
+        "md5": md5,
+    }
+    logger.info(
+        "%s: %d bytes in %.2fs (%.1f MB/s)" % (what, size, duration, stats["mbps"] or 0)
+    )
+    return stats
+
+
+def download(url, path, headers={}, **kwargs):
+    """
+    GETs url, streaming a successful response into the file at path.
+    :returns: the response, and the stats of the download (bytes, duration,
+              throughput in MB/s and MD5 hex digest of the file), None if
+              the request failed
+    """
+    started = time.monotonic()
+    r = requests.get(url, headers=headers, verify=False, stream=True, **kwargs)
+    if r.status_code != 200:
+        return r, None
+    md5 = hashlib.md5()
+    size = 0
+    with r, open(path, "wb") as fd:
+        for chunk in r.iter_content(_CHUNK_SIZE):
+            md5.update(chunk)
+            fd.write(chunk)
+            size += len(chunk)
+    return (
+        r,
+        _stats("downloaded " + url, size, time.monotonic() - started, md5.hexdigest()),
+    )
+
+
+def upload(method, url, fields, headers={}, **kwargs):
+    """
+    Sends a multipart/form-data request, streaming the file fields from disk.
+    :param fields: fields of the form, see MultipartEncoder
+    :returns: the response, and the stats of the upload (bytes, duration and
+              throughput in MB/s)
+    """
+    started = time.monotonic()
+    with MultipartEncoder(fields) as body:
+        headers = dict(headers, **{"Content-Type": body.content_type})
+        r = requests.request(
+            method, url, data=body, headers=headers, verify=False, **kwargs
+        )
+        size = body.len
+    return r, _stats("uploaded to " + url, size, time.monotonic() - started)
@@ -12,75 +12,179 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
-# Synchronous wrapper around websockets. In tests it is more useful to have a
-# synchronous API.
+# Wrappers around websockets. In tests it is more useful to have a synchronous
+# API: Websocket runs its connection on a background event loop thread, shared
+# by all the Websocket objects, and receives frames into a queue so that they
+# keep being received while the test is busy. AsyncWebsocket is the asyncio
+# API, to drive many concurrent sessions from a single coroutine.
 
 import asyncio
+import collections
+import queue
 import ssl
+import threading
 import time
 import websockets
 
+_loop = None
+_loop_lock = threading.Lock()
 
-class Websocket:
+
+def background_loop():
+    """Returns the event loop the websockets run on, starting it if needed"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_loop.run_forever, name="websockets", daemon=True
+            ).start()
+    return _loop
+
+
+def _run(coro):
+    """Runs coro on the background loop, and waits for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, background_loop()).result()
+
+
+class AsyncWebsocket:
     def __init__(self, url, headers=[], insecure=False, retry_connect=True):
         self.url = url
         self.headers = headers
         self.insecure = insecure
         self.retry_connect = retry_connect
+        self.ws = None
 
-    def __enter__(self):
-        ssl_context = ssl.create_default_context()
-        if self.insecure:
-            ssl_context.check_hostname = False
-            ssl_context.verify_mode = ssl.CERT_NONE
-
-        async def connect():
-            self.ws = await websockets.connect(
-                self.url, extra_headers=self.headers, ssl=ssl_context
-            )
+    async def connect(self):
+        ssl_context = None
+        if self.url.startswith("wss://"):
+            ssl_context = ssl.create_default_context()
+            if self.insecure:
+                ssl_context.check_hostname = False
+                ssl_context.verify_mode = ssl.CERT_NONE
 
         attempts = 5
         while True:
             try:
-                asyncio.get_event_loop().run_until_complete(connect())
-                break
+                self.ws = await websockets.connect(
+                    self.url, extra_headers=self.headers, ssl=ssl_context
+                )
+                return self
             except websockets.InvalidStatusCode:
                 if self.retry_connect and attempts > 0:
                     attempts -= 1
-                    time.sleep(5)
+                    await asyncio.sleep(5)
                 else:
                     raise
 
-        return self
+    async def close(self):
+        await self.ws.close()
 
-    def __exit__(self, exception_type, exception_value, traceback):
-        async def close():
-            await self.ws.close()
+    async def __aenter__(self):
+        return await self.connect()
 
-        asyncio.get_event_loop().run_until_complete(close())
+    async def __aexit__(self, exception_type, exception_value, traceback):
+        await self.close()
 
-    def send(self, msg):
-        async def send():
+    async def send(self, msg):
+        await self.ws.send(msg)
+
+    async def send_many(self, msgs):
+        for msg in msgs:
             await self.ws.send(msg)
 
-        asyncio.get_event_loop().run_until_complete(send())
+    async def recv(self, timeout=20):
+        try:
+            return await asyncio.wait_for(self.ws.recv(), timeout=timeout)
+        except asyncio.TimeoutError as e:
+            raise TimeoutError(e)
 
-    def recv(self, timeout=20):
-        result = None
+    async def recv_until(self, predicate, timeout=20):
+        """
+        Receives frames until predicate(frame) is true, for up to timeout
+        seconds in total.
+        :returns: the frames received, the matching one last
+        """
+        deadline = time.monotonic() + timeout
+        frames = []
+        while True:
+            frames.append(await self.recv(max(deadline - time.monotonic(), 0)))
+            if predicate(frames[-1]):
+                return frames
 
-        async def recv():
-            nonlocal result
 
-            async def recv2():
-                nonlocal result
-                result = await self.ws.recv()
+class Websocket:
+    def __init__(self, url, headers=[], insecure=False, retry_connect=True):
+        self.url = url
+        self.headers = headers
+        self.insecure = insecure
+        self.retry_connect = retry_connect
+        self.ws = None
+        # frames handed back by a recv_until() which timed out
+        self._pending = collections.deque()
+        self._queue = queue.Queue()
+        self._reader = None
+
+    async def _connect(self):
+        self.ws = await AsyncWebsocket(
+            self.url, self.headers, self.insecure, self.retry_connect
+        ).connect()
+        self._reader = asyncio.ensure_future(self._read())
+
+    async def _read(self):
+        while True:
+            try:
+                msg = await self.ws.ws.recv()
+            except websockets.ConnectionClosed as e:
+                # raised by recv() once the frames before it were received
+                self._queue.put(e)
+                return
+            self._queue.put(msg)
+
+    async def _close(self):
+        await self.ws.close()
+        await self._reader
+
+    def __enter__(self):
+        _run(self._connect())
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        _run(self._close())
+
+    def send(self, msg):
+        _run(self.ws.send(msg))
 
-            await asyncio.wait_for(recv2(), timeout=timeout)
+    def send_many(self, msgs):
+        """Sends all msgs, in order, in a single round trip to the loop"""
+        _run(self.ws.send_many(list(msgs)))
 
+    def recv(self, timeout=20):
+        if len(self._pending) > 0:
+            return self._pending.popleft()
         try:
-            asyncio.get_event_loop().run_until_complete(recv())
-        except asyncio.TimeoutError as e:
+            msg = self._queue.get(timeout=timeout)
+        except queue.Empty as e:
             raise TimeoutError(e)
-
-        assert result is not None
-        return result
+        if isinstance(msg, websockets.ConnectionClosed):
+            self._queue.put(msg)
+            raise msg
+        return msg
+
+    def recv_until(self, predicate, timeout=20):
+        """
+        Receives frames until predicate(frame) is true, for up to timeout
+        seconds in total. On timeout, the frames received so far are kept
+        for the next recv calls.
+        :returns: the frames received, the matching one last
+        """
+        deadline = time.monotonic() + timeout
+        frames = []
+        try:
+            while True:
+                frames.append(self.recv(max(deadline - time.monotonic(), 0)))
+                if predicate(frames[-1]):
+                    return frames
+        except (TimeoutError, websockets.ConnectionClosed):
+            self._pending.extendleft(reversed(frames))
+            raise